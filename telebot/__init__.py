@@ -4,6 +4,7 @@ from datetime import datetime
 import logging
 import re
 import sys
+import itertools
 import threading
 import time
 import traceback
@@ -29,8 +30,6 @@ formatter = logging.Formatter(
     '%(asctime)s (%(filename)s:%(lineno)d %(threadName)s) %(levelname)s - %(name)s: "%(message)s"'
 )
 
-import inspect
-
 console_output_handler = logging.StreamHandler(sys.stderr)
 console_output_handler.setFormatter(formatter)
 logger.addHandler(console_output_handler)
@@ -40,9 +39,15 @@ logger.setLevel(logging.ERROR)
 from telebot import apihelper, util, types
 from telebot.handler_backends import (
     HandlerBackend, MemoryHandlerBackend, FileHandlerBackend, BaseMiddleware,
-    CancelUpdate, SkipHandler, State, ContinueHandling
+    CancelUpdate, SkipHandler, State, ContinueHandling, UpdateDeduplicator
+)
+from telebot.custom_filters import (
+    SimpleCustomFilter, AdvancedCustomFilter, TextMatchFilter, TextContainsFilter, TextStartsFilter, StateFilter
 )
-from telebot.custom_filters import SimpleCustomFilter, AdvancedCustomFilter
+from telebot.handler_index import DispatchContext, HandlerIndex, HandlerList, build_middleware_chain, iter_update_parts
+from telebot.process_pool import ProcessPool, is_process_handler
+from telebot.states import NOT_MEMOIZED, get_memoized_state, memoize_state, resolve_cached_context
+from telebot.text_matching import COMPILED_FILTER, UNCOMPILED
 
 
 REPLY_MARKUP_TYPES = Union[
@@ -119,10 +124,12 @@ class TeleBot:
     :param num_threads: Number of maximum parallel threads, defaults to 2
     :type num_threads: :obj:`int`, optional
 
-    :param next_step_backend: Next step backend class, defaults to None
+    :param next_step_backend: Next step backend class, defaults to None. Pass e.g.
+        MemoryHandlerBackend(ttl=3600, max_entries=100000) to drop abandoned next step handlers.
     :type next_step_backend: :class:`telebot.handler_backends.HandlerBackend`, optional
 
-    :param reply_backend: Reply step handler class, defaults to None
+    :param reply_backend: Reply step handler class, defaults to None. Pass e.g.
+        MemoryHandlerBackend(ttl=86400, max_memory=64 * 1024 * 1024) to drop reply handlers of unanswered messages.
     :type reply_backend: :class:`telebot.handler_backends.HandlerBackend`, optional
 
     :param exception_handler: Exception handler to handle errors, defaults to None
@@ -158,6 +165,30 @@ class TeleBot:
     :param validate_token: Validate token, defaults to True;
     :type validate_token: :obj:`bool`, optional
 
+    :param worker_pool_class: Worker pool class for threaded mode, called as ``worker_pool_class(bot, num_threads=num_threads)``,
+        defaults to :class:`telebot.util.ThreadPool`. Use :class:`telebot.util.ShardedThreadPool` to process updates
+        of each chat in order, :class:`telebot.util.ElasticThreadPool` to scale the number of threads with the load,
+        :class:`telebot.util.FuturesThreadPool` for the lowest per-task overhead.
+    :type worker_pool_class: :obj:`type`, optional
+
+    :param max_queue_size: Maximum number of updates waiting for a worker thread, defaults to None (no limit).
+        Processing new updates blocks while the queue is full.
+    :type max_queue_size: :obj:`int`, optional
+
+    :param queue_high_water_mark: Number of waiting updates from which polling pauses requesting new updates,
+        defaults to max_queue_size. Queue depth and wait time statistics are available from ``bot.worker_pool.stats``.
+    :type queue_high_water_mark: :obj:`int`, optional
+
+    :param process_pool_workers: Number of processes for handlers marked with :func:`telebot.process_pool.run_in_process`,
+        defaults to the number of CPUs. The pool is created when the first such handler is used, the worker pool
+        then gets one more thread per process.
+    :type process_pool_workers: :obj:`int`, optional
+
+    :param update_deduplicator: Drops updates whose update_id was already processed, e.g. webhook redeliveries,
+        defaults to None. Use :class:`telebot.handler_backends.MemoryUpdateDeduplicator` or, for several
+        bot instances, :class:`telebot.handler_backends.RedisUpdateDeduplicator`.
+    :type update_deduplicator: :class:`telebot.handler_backends.UpdateDeduplicator`, optional
+
     :raises ImportError: If coloredlogs module is not installed and colorful_logs is True
     :raises ValueError: If token is invalid
     """
@@ -174,13 +205,19 @@ class TeleBot:
             protect_content: Optional[bool]=None,
             allow_sending_without_reply: Optional[bool]=None,
             colorful_logs: Optional[bool]=False,
-            validate_token: Optional[bool]=True
+            validate_token: Optional[bool]=True,
+            worker_pool_class: Optional[type]=None,
+            max_queue_size: Optional[int]=None,
+            queue_high_water_mark: Optional[int]=None,
+            process_pool_workers: Optional[int]=None,
+            update_deduplicator: Optional[UpdateDeduplicator]=None
     ):
 
         # update-related
         self.token = token
         self.skip_pending = skip_pending # backward compatibility
         self.last_update_id = last_update_id
+        self.update_deduplicator = update_deduplicator
 
         # properties
         self.suppress_middleware_excepions = suppress_middleware_excepions
@@ -214,6 +251,9 @@ class TeleBot:
 
         # states & register_next_step_handler
         self.current_states = state_storage
+        # advanced whenever states may have changed, see _get_update_state
+        self._state_generations = itertools.count(1)
+        self._state_generation = 0
         self.next_step_backend = next_step_backend
         if not self.next_step_backend:
             self.next_step_backend = MemoryHandlerBackend()
@@ -226,35 +266,42 @@ class TeleBot:
         self.exception_handler = exception_handler
         self.update_listener = []
 
-        self.message_handlers = []
-        self.edited_message_handlers = []
-        self.channel_post_handlers = []
-        self.edited_channel_post_handlers = []
-        self.message_reaction_handlers = []
-        self.message_reaction_count_handlers = []
-        self.inline_handlers = []
-        self.chosen_inline_handlers = []
-        self.callback_query_handlers = []
-        self.shipping_query_handlers = []
-        self.pre_checkout_query_handlers = []
-        self.poll_handlers = []
-        self.poll_answer_handlers = []
-        self.my_chat_member_handlers = []
-        self.chat_member_handlers = []
-        self.chat_join_request_handlers = []
-        self.chat_boost_handlers = []
-        self.removed_chat_boost_handlers = []
-        self.business_connection_handlers = []
-        self.business_message_handlers = []
-        self.edited_business_message_handlers = []
-        self.deleted_business_messages_handlers = []
-        self.purchased_paid_media_handlers = []
-        self.managed_bot_handlers = []
-        self.guest_message_handlers = []
-        self.subscription_handlers = []
+        self.message_handlers = HandlerList()
+        self.edited_message_handlers = HandlerList()
+        self.channel_post_handlers = HandlerList()
+        self.edited_channel_post_handlers = HandlerList()
+        self.message_reaction_handlers = HandlerList()
+        self.message_reaction_count_handlers = HandlerList()
+        self.inline_handlers = HandlerList()
+        self.chosen_inline_handlers = HandlerList()
+        self.callback_query_handlers = HandlerList()
+        self.shipping_query_handlers = HandlerList()
+        self.pre_checkout_query_handlers = HandlerList()
+        self.poll_handlers = HandlerList()
+        self.poll_answer_handlers = HandlerList()
+        self.my_chat_member_handlers = HandlerList()
+        self.chat_member_handlers = HandlerList()
+        self.chat_join_request_handlers = HandlerList()
+        self.chat_boost_handlers = HandlerList()
+        self.removed_chat_boost_handlers = HandlerList()
+        self.business_connection_handlers = HandlerList()
+        self.business_message_handlers = HandlerList()
+        self.edited_business_message_handlers = HandlerList()
+        self.deleted_business_messages_handlers = HandlerList()
+        self.purchased_paid_media_handlers = HandlerList()
+        self.managed_bot_handlers = HandlerList()
+        self.guest_message_handlers = HandlerList()
+        self.subscription_handlers = HandlerList()
 
         self.custom_filters = {}
         self.state_handlers = []
+        self._handler_indexes = {}
+        self._middleware_chains = {}
+        # collects unhandled exceptions while a worker dispatches a message, see _process_message_in_order
+        self._inline_tasks = threading.local()
+        self.process_pool = None
+        self.process_pool_workers = process_pool_workers
+        self._process_pool_lock = threading.Lock()
 
         # middlewares
         self.use_class_middlewares = use_class_middlewares
@@ -294,7 +341,12 @@ class TeleBot:
         # threads
         self.threaded = threaded
         if self.threaded:
-            self.worker_pool = util.ThreadPool(self, num_threads=num_threads)
+            pool_kwargs = {}
+            if max_queue_size is not None:
+                pool_kwargs['max_queue_size'] = max_queue_size
+            if queue_high_water_mark is not None:
+                pool_kwargs['high_water_mark'] = queue_high_water_mark
+            self.worker_pool = (worker_pool_class or util.ThreadPool)(self, num_threads=num_threads, **pool_kwargs)
 
     @property
     def user(self) -> types.User:
@@ -317,6 +369,9 @@ class TeleBot:
         compatibility whose purpose was to enable file saving capability for handlers. And the same
         implementation is now available with FileHandlerBackend
 
+        FileHandlerBackend rewrites all handlers on every save; for many pending handlers pass
+        next_step_backend=SQLiteHandlerBackend(...) to TeleBot instead, which writes one row per change.
+
         :param delay: Delay between changes in handlers and saving, defaults to 120
         :type delay: :obj:`int`, optional
 
@@ -702,37 +757,16 @@ class TeleBot:
 
         :return None:
         """
+        if self.update_deduplicator is not None:
+            updates = [update for update in updates if not self.update_deduplicator.is_duplicate(update.update_id)]
+
         upd_count = len(updates)
         logger.debug('Received {0} new updates'.format(upd_count))
         if upd_count == 0: return
 
-        new_messages = None
-        new_edited_messages = None
-        new_channel_posts = None
-        new_edited_channel_posts = None
-        new_message_reactions = None
-        new_message_reaction_counts = None
-        new_inline_queries = None
-        new_chosen_inline_results = None
-        new_callback_queries = None
-        new_shipping_queries = None
-        new_pre_checkout_queries = None
-        new_polls = None
-        new_poll_answers = None
-        new_my_chat_members = None
-        new_chat_members = None
-        new_chat_join_request = None
-        new_chat_boosts = None
-        new_removed_chat_boosts = None
-        new_business_connections = None
-        new_business_messages = None
-        new_edited_business_messages = None
-        new_deleted_business_messages = None
-        new_purchased_paid_media = None
-        new_managed_bots = None
-        new_guest_messages = None
-        new_subscriptions = None
-
+        # states memoized on reused update objects are not trusted across batches
+        self._state_generation = next(self._state_generations)
+        batches = {}
         for update in updates:
             if apihelper.ENABLE_MIDDLEWARE and not self.use_class_middlewares:
                 try:
@@ -747,147 +781,114 @@ class TeleBot:
 
             if update.update_id > self.last_update_id:
                 self.last_update_id = update.update_id
-            if update.message:
-                if new_messages is None: new_messages = []
-                new_messages.append(update.message)
-            if update.edited_message:
-                if new_edited_messages is None: new_edited_messages = []
-                new_edited_messages.append(update.edited_message)
-            if update.channel_post:
-                if new_channel_posts is None: new_channel_posts = []
-                new_channel_posts.append(update.channel_post)
-            if update.edited_channel_post:
-                if new_edited_channel_posts is None: new_edited_channel_posts = []
-                new_edited_channel_posts.append(update.edited_channel_post)
-            if update.inline_query:
-                if new_inline_queries is None: new_inline_queries = []
-                new_inline_queries.append(update.inline_query)
-            if update.chosen_inline_result:
-                if new_chosen_inline_results is None: new_chosen_inline_results = []
-                new_chosen_inline_results.append(update.chosen_inline_result)
-            if update.callback_query:
-                if new_callback_queries is None: new_callback_queries = []
-                new_callback_queries.append(update.callback_query)
-            if update.shipping_query:
-                if new_shipping_queries is None: new_shipping_queries = []
-                new_shipping_queries.append(update.shipping_query)
-            if update.pre_checkout_query:
-                if new_pre_checkout_queries is None: new_pre_checkout_queries = []
-                new_pre_checkout_queries.append(update.pre_checkout_query)
-            if update.poll:
-                if new_polls is None: new_polls = []
-                new_polls.append(update.poll)
-            if update.poll_answer:
-                if new_poll_answers is None: new_poll_answers = []
-                new_poll_answers.append(update.poll_answer)
-            if update.my_chat_member:
-                if new_my_chat_members is None: new_my_chat_members = []
-                new_my_chat_members.append(update.my_chat_member)
-            if update.chat_member:
-                if new_chat_members is None: new_chat_members = []
-                new_chat_members.append(update.chat_member)
-            if update.chat_join_request:
-                if new_chat_join_request is None: new_chat_join_request = []
-                new_chat_join_request.append(update.chat_join_request)
-            if update.message_reaction:
-                if new_message_reactions is None: new_message_reactions = []
-                new_message_reactions.append(update.message_reaction)
-            if update.message_reaction_count:
-                if new_message_reaction_counts is None: new_message_reaction_counts = []
-                new_message_reaction_counts.append(update.message_reaction_count)
-            if update.chat_boost:
-                if new_chat_boosts is None: new_chat_boosts = []
-                new_chat_boosts.append(update.chat_boost)
-            if update.removed_chat_boost:
-                if new_removed_chat_boosts is None: new_removed_chat_boosts = []
-                new_removed_chat_boosts.append(update.removed_chat_boost)
-            if update.business_connection:
-                if new_business_connections is None: new_business_connections = []
-                new_business_connections.append(update.business_connection)
-            if update.business_message:
-                if new_business_messages is None: new_business_messages = []
-                new_business_messages.append(update.business_message)
-            if update.edited_business_message:
-                if new_edited_business_messages is None: new_edited_business_messages = []
-                new_edited_business_messages.append(update.edited_business_message)
-            if update.deleted_business_messages:
-                if new_deleted_business_messages is None: new_deleted_business_messages = []
-                new_deleted_business_messages.append(update.deleted_business_messages)
-            if update.purchased_paid_media:
-                if new_purchased_paid_media is None: new_purchased_paid_media = []
-                new_purchased_paid_media.append(update.purchased_paid_media)
-            if update.managed_bot:
-                if new_managed_bots is None: new_managed_bots = []
-                new_managed_bots.append(update.managed_bot)
-            if update.guest_message:
-                if new_guest_messages is None: new_guest_messages = []
-                new_guest_messages.append(update.guest_message)
-            if update.subscription:
-                if new_subscriptions is None: new_subscriptions = []
-                new_subscriptions.append(update.subscription)
-
-        if new_messages:
-            self.process_new_messages(new_messages)
-        if new_edited_messages:
-            self.process_new_edited_messages(new_edited_messages)
-        if new_channel_posts:
-            self.process_new_channel_posts(new_channel_posts)
-        if new_edited_channel_posts:
-            self.process_new_edited_channel_posts(new_edited_channel_posts)
-        if new_inline_queries:
-            self.process_new_inline_query(new_inline_queries)
-        if new_chosen_inline_results:
-            self.process_new_chosen_inline_query(new_chosen_inline_results)
-        if new_callback_queries:
-            self.process_new_callback_query(new_callback_queries)
-        if new_shipping_queries:
-            self.process_new_shipping_query(new_shipping_queries)
-        if new_pre_checkout_queries:
-            self.process_new_pre_checkout_query(new_pre_checkout_queries)
-        if new_polls:
-            self.process_new_poll(new_polls)
-        if new_poll_answers:
-            self.process_new_poll_answer(new_poll_answers)
-        if new_my_chat_members:
-            self.process_new_my_chat_member(new_my_chat_members)
-        if new_chat_members:
-            self.process_new_chat_member(new_chat_members)
-        if new_subscriptions:
-            self.process_new_subscription(new_subscriptions)
-        if new_chat_join_request:
-            self.process_new_chat_join_request(new_chat_join_request)
-        if new_message_reactions:
-            self.process_new_message_reaction(new_message_reactions)
-        if new_message_reaction_counts:
-            self.process_new_message_reaction_count(new_message_reaction_counts)
-        if new_chat_boosts:
-            self.process_new_chat_boost(new_chat_boosts)
-        if new_removed_chat_boosts:
-            self.process_new_removed_chat_boost(new_removed_chat_boosts)
-        if new_business_connections:
-            self.process_new_business_connection(new_business_connections)
-        if new_business_messages:
-            self.process_new_business_message(new_business_messages)
-        if new_edited_business_messages:
-            self.process_new_edited_business_message(new_edited_business_messages)
-        if new_deleted_business_messages:
-            self.process_new_deleted_business_messages(new_deleted_business_messages)
-        if new_purchased_paid_media:
-            self.process_new_purchased_paid_media(new_purchased_paid_media)
-        if new_managed_bots:
-            self.process_new_managed_bot(new_managed_bots)
-        if new_guest_messages:
-            self.process_new_guest_message(new_guest_messages)
+            for update_type, part in iter_update_parts(update):
+                batch = batches.get(update_type)
+                if batch is None:
+                    batches[update_type] = [part]
+                else:
+                    batch.append(part)
+
+        for update_type, process, handlers, middleware_type in self._update_routes:
+            batch = batches.get(update_type)
+            if batch and not self._can_skip_update_type(process, handlers, middleware_type):
+                getattr(self, process)(batch)
+
+    #: Update types in processing order: (Update field, method processing them, attribute holding their handlers
+    #: or None if they are never skipped, update type for middlewares)
+    _update_routes = (
+        ('message', 'process_new_messages', None, 'message'),
+        ('edited_message', 'process_new_edited_messages', 'edited_message_handlers', 'edited_message'),
+        ('channel_post', 'process_new_channel_posts', 'channel_post_handlers', 'channel_post'),
+        ('edited_channel_post', 'process_new_edited_channel_posts', 'edited_channel_post_handlers', 'edited_channel_post'),
+        ('inline_query', 'process_new_inline_query', 'inline_handlers', 'inline_query'),
+        ('chosen_inline_result', 'process_new_chosen_inline_query', 'chosen_inline_handlers', 'chosen_inline_query'),
+        ('callback_query', 'process_new_callback_query', 'callback_query_handlers', 'callback_query'),
+        ('shipping_query', 'process_new_shipping_query', 'shipping_query_handlers', 'shipping_query'),
+        ('pre_checkout_query', 'process_new_pre_checkout_query', 'pre_checkout_query_handlers', 'pre_checkout_query'),
+        ('poll', 'process_new_poll', 'poll_handlers', 'poll'),
+        ('poll_answer', 'process_new_poll_answer', 'poll_answer_handlers', 'poll_answer'),
+        ('my_chat_member', 'process_new_my_chat_member', 'my_chat_member_handlers', 'my_chat_member'),
+        ('chat_member', 'process_new_chat_member', 'chat_member_handlers', 'chat_member'),
+        ('subscription', 'process_new_subscription', 'subscription_handlers', 'subscription'),
+        ('chat_join_request', 'process_new_chat_join_request', 'chat_join_request_handlers', 'chat_join_request'),
+        ('message_reaction', 'process_new_message_reaction', 'message_reaction_handlers', 'message_reaction'),
+        ('message_reaction_count', 'process_new_message_reaction_count', 'message_reaction_count_handlers', 'message_reaction_count'),
+        ('chat_boost', 'process_new_chat_boost', 'chat_boost_handlers', 'chat_boost'),
+        ('removed_chat_boost', 'process_new_removed_chat_boost', 'removed_chat_boost_handlers', 'removed_chat_boost'),
+        ('business_connection', 'process_new_business_connection', 'business_connection_handlers', 'business_connection'),
+        ('business_message', 'process_new_business_message', 'business_message_handlers', 'business_message'),
+        ('edited_business_message', 'process_new_edited_business_message', 'edited_business_message_handlers', 'edited_business_message'),
+        ('deleted_business_messages', 'process_new_deleted_business_messages', 'deleted_business_messages_handlers', 'deleted_business_messages'),
+        ('purchased_paid_media', 'process_new_purchased_paid_media', 'purchased_paid_media_handlers', 'purchased_paid_media'),
+        ('managed_bot', 'process_new_managed_bot', 'managed_bot_handlers', 'managed_bot'),
+        ('guest_message', 'process_new_guest_message', 'guest_message_handlers', 'guest_message'),
+    )
+
+    def _can_skip_update_type(self, process, handlers, middleware_type) -> bool:
+        """
+        Checks whether processing an update type would do nothing: no handlers, no class middlewares
+        and the processing method is not overridden.
+
+        :meta private:
+        """
+        if handlers is None or getattr(self, handlers):
+            return False
+        if self.use_class_middlewares and self._get_middleware_chain(middleware_type):
+            return False
+        return getattr(type(self), process) is getattr(TeleBot, process)
+
+    def is_known_update(self, update_id: Optional[int]) -> bool:
+        """
+        Checks whether an update with this id was already processed, so that it can be dropped
+        before decoding. Always False if no update_deduplicator is set.
+
+        :meta private:
+
+        :param update_id: Update id
+        :type update_id: :obj:`int`
+
+        :return: True if the update is a duplicate
+        :rtype: :obj:`bool`
+        """
+        if self.update_deduplicator is None or update_id is None:
+            return False
+        return self.update_deduplicator.seen(update_id)
+
 
     def process_new_messages(self, new_messages):
         """
         :meta private:
         """
+        if self.threaded and self.worker_pool.keeps_chat_order:
+            # next step and reply handlers must be looked up after the chat's previous messages were handled
+            for message in new_messages:
+                self._exec_task(self._process_message_in_order, message)
+            return
         self._notify_next_handlers(new_messages)
         self._notify_reply_handlers(new_messages)
         self.__notify_update(new_messages)
         self._notify_command_handlers(self.message_handlers, new_messages, 'message')
 
+    def _process_message_in_order(self, message):
+        """
+        Runs in the worker of the message's chat: dispatches the message, running its handlers
+        in this task instead of queuing them behind the chat's following messages.
+
+        :meta private:
+        """
+        self._inline_tasks.errors = []
+        try:
+            messages = [message]
+            self._notify_next_handlers(messages)
+            self._notify_reply_handlers(messages)
+            self.__notify_update(messages)
+            self._notify_command_handlers(self.message_handlers, messages, 'message')
+            errors = self._inline_tasks.errors
+        finally:
+            self._inline_tasks.errors = None
+        if errors:
+            raise errors[0]
+
     def process_new_edited_messages(self, new_edited_message):
         """
         :meta private:
@@ -1165,7 +1166,8 @@ class TeleBot:
     def polling(self, non_stop: Optional[bool]=False, skip_pending: Optional[bool]=False, interval: Optional[int]=0,
                 timeout: Optional[int]=20, long_polling_timeout: Optional[int]=20,
                 logger_level: Optional[int]=logging.ERROR, allowed_updates: Optional[List[str]]=None,
-                none_stop: Optional[bool]=None, restart_on_change: Optional[bool]=False, path_to_watch: Optional[str]=None):
+                none_stop: Optional[bool]=None, restart_on_change: Optional[bool]=False, path_to_watch: Optional[str]=None,
+                pipelined: Optional[bool]=False):
         """
         This function creates a new Thread that calls an internal __retrieve_updates function.
         This allows the bot to retrieve Updates automatically and notify listeners and message handlers accordingly.
@@ -1219,6 +1221,11 @@ class TeleBot:
         :param path_to_watch: Path to watch for changes. Defaults to None
         :type path_to_watch: :obj:`str`
 
+        :param pipelined: Threaded mode only: limit each request to the free capacity of the worker pool and
+            request the next updates without waiting for `interval` after a full batch. Updates are confirmed
+            only after they were handed to the worker pool. Defaults to False
+        :type pipelined: :obj:`bool`
+
         :return:
         """
         if none_stop is not None:
@@ -1233,7 +1240,10 @@ class TeleBot:
 
         logger.info('Starting your bot with username: [@%s]', self.user.username)
 
-        if self.threaded:
+        if self.threaded and pipelined:
+            self.__pipelined_polling(non_stop=non_stop, interval=interval, timeout=timeout, long_polling_timeout=long_polling_timeout,
+                                     logger_level=logger_level, allowed_updates=allowed_updates)
+        elif self.threaded:
             self.__threaded_polling(non_stop=non_stop, interval=interval, timeout=timeout, long_polling_timeout=long_polling_timeout,
                                     logger_level=logger_level, allowed_updates=allowed_updates)
         else:
@@ -1266,6 +1276,8 @@ class TeleBot:
         )
 
         while not self.__stop_polling.wait(interval):
+            if not self.__wait_for_worker_pool():
+                continue
             or_event.clear()
             try:
                 polling_thread.put(self.__retrieve_updates, timeout, long_polling_timeout, allowed_updates=allowed_updates)
@@ -1322,6 +1334,107 @@ class TeleBot:
         logger.info('Stopped polling.' + warning)
 
 
+    def __pipelined_polling(self, non_stop=False, interval=0, timeout=None, long_polling_timeout=None,
+                            logger_level=logging.ERROR, allowed_updates=None):
+        """
+        Polling that sizes each request to the free capacity of the worker pool and requests the next batch
+        without delay after a full one.
+
+        Every batch is handed to the worker pool by :meth:`process_new_updates` before the next request
+        confirms it (by asking for updates with a higher offset), so unprocessed updates are never confirmed
+        while they wait outside the worker pool. `interval` only applies after partial batches.
+
+        :meta private:
+        """
+        if (not logger_level) or (logger_level < logging.INFO):
+            warning = "\n  Warning: this message appearance will be changed. Set logger_level=logging.INFO to continue seeing it."
+        else:
+            warning = ""
+        logger.info('Started pipelined polling.' + warning)
+        self.__stop_polling.clear()
+        error_interval = 0.25
+        delay = 0
+
+        while not self.__stop_polling.wait(delay):
+            try:
+                if not self.__wait_for_worker_pool():
+                    continue
+                if self.skip_pending:
+                    self.__skip_updates()
+                    logger.debug('Skipped all pending messages')
+                    self.skip_pending = False
+                limit = self.__pipelined_limit()
+                updates = self.get_updates(offset=(self.last_update_id + 1), limit=limit,
+                                           allowed_updates=allowed_updates,
+                                           timeout=timeout, long_polling_timeout=long_polling_timeout)
+                self.process_new_updates(updates)
+                delay = 0 if len(updates) >= limit else interval
+                self.worker_pool.raise_exceptions()
+                error_interval = 0.25
+            except apihelper.ApiException as e:
+                handled = self._handle_exception(e)
+                if not handled:
+                    if logger_level and logger_level >= logging.ERROR:
+                        logger.error("Pipelined polling exception: %s", self.__hide_token(str(e)))
+                    if logger_level and logger_level >= logging.DEBUG:
+                        logger.error("Exception traceback:\n%s", self.__hide_token(traceback.format_exc()))
+                    if not non_stop:
+                        self.__stop_polling.set()
+                        logger.info("Exception occurred. Stopping." + warning)
+                    else:
+                        logger.info("Waiting for {0} seconds until retry".format(error_interval) + warning)
+                        time.sleep(error_interval)
+                        error_interval = min(error_interval * 2, 60)
+                else:
+                    time.sleep(error_interval)
+                self.worker_pool.clear_exceptions()
+            except KeyboardInterrupt:
+                logger.info("KeyboardInterrupt received." + warning)
+                self.__stop_polling.set()
+                break
+            except Exception as e:
+                handled = self._handle_exception(e)
+                self.worker_pool.clear_exceptions()
+                if not handled:
+                    raise e
+                else:
+                    time.sleep(error_interval)
+
+        self.worker_pool.clear_exceptions()
+        logger.info('Stopped polling.' + warning)
+
+
+    def __pipelined_limit(self) -> int:
+        """
+        Batch size for the next request, limited to the free capacity of the worker pool.
+
+        :meta private:
+        """
+        if not self.worker_pool.high_water_mark:
+            return 100
+        return max(1, min(100, self.worker_pool.high_water_mark - self.worker_pool.stats.depth))
+
+
+    def __wait_for_worker_pool(self) -> bool:
+        """
+        Pauses requesting updates while the worker pool is saturated, so that unprocessed
+        updates stay unconfirmed on the server instead of piling up in memory.
+
+        :meta private:
+
+        :return: True if polling can continue, False to check for stop first.
+        """
+        if not self.worker_pool.is_saturated():
+            return True
+        logger.warning('Worker pool queue reached the high-water mark (%s tasks), polling is paused.',
+                       self.worker_pool.stats.depth)
+        while not self.__stop_polling.is_set():
+            if self.worker_pool.wait_for_capacity(timeout=0.5):
+                logger.info('Worker pool queue is below the high-water mark, polling continues.')
+                return True
+        return False
+
+
     def __non_threaded_polling(self, non_stop=False, interval=0, timeout=None, long_polling_timeout=None,
                                logger_level=logging.ERROR, allowed_updates=None):
         if (not logger_level) or (logger_level < logging.INFO):
@@ -1371,7 +1484,14 @@ class TeleBot:
 
 
     def _exec_task(self, task, *args, **kwargs):
-        if self.threaded:
+        errors = getattr(self._inline_tasks, 'errors', None)
+        if errors is not None:
+            try:
+                task(*args, **kwargs)
+            except Exception as e:
+                if not self._handle_exception(e):
+                    errors.append(e)
+        elif self.threaded:
             self.worker_pool.put(task, *args, **kwargs)
         else:
             try:
@@ -1398,6 +1518,8 @@ class TeleBot:
         self.stop_polling()
         if self.threaded and self.worker_pool:
             self.worker_pool.close()
+        if self.process_pool:
+            self.process_pool.close()
 
 
     def set_update_listener(self, listener: Callable):
@@ -8993,7 +9115,7 @@ class TeleBot:
                 handlers = self.reply_backend.get_handlers(message.reply_to_message.message_id)
                 if handlers:
                     for handler in handlers:
-                        self._exec_task(handler["callback"], message, *handler["args"], **handler["kwargs"])
+                        self._exec_task(self._wrap_process_handler(handler["callback"]), message, *handler["args"], **handler["kwargs"])
 
 
     def register_next_step_handler(self, message: types.Message, callback: Callable, *args, **kwargs) -> None:
@@ -9038,6 +9160,7 @@ class TeleBot:
             middleware.update_sensitive = False
 
         self.middlewares.append(middleware)
+        self._middleware_chains.clear()
 
 
     def set_state(self, user_id: int, state: Union[str, State], chat_id: Optional[int]=None,
@@ -9085,8 +9208,10 @@ class TeleBot:
             chat_id = user_id
         if bot_id is None:
             bot_id = self.bot_id
-        return self.current_states.set_state(chat_id, user_id, state,
+        result = self.current_states.set_state(chat_id, user_id, state,
             bot_id=bot_id, business_connection_id=business_connection_id, message_thread_id=message_thread_id)
+        self._state_generation = next(self._state_generations)
+        return result
 
 
     def reset_data(self, user_id: int, chat_id: Optional[int]=None,
@@ -9152,8 +9277,10 @@ class TeleBot:
             chat_id = user_id
         if bot_id is None:
             bot_id = self.bot_id
-        return self.current_states.delete_state(chat_id, user_id,
+        result = self.current_states.delete_state(chat_id, user_id,
             bot_id=bot_id, business_connection_id=business_connection_id, message_thread_id=message_thread_id)
+        self._state_generation = next(self._state_generations)
+        return result
 
 
     def retrieve_data(self, user_id: int, chat_id: Optional[int]=None, business_connection_id: Optional[str]=None,
@@ -9225,6 +9352,35 @@ class TeleBot:
             bot_id=bot_id, business_connection_id=business_connection_id, message_thread_id=message_thread_id)
 
 
+    def _get_update_state(self, update_object):
+        """
+        Returns the state of the user of an update object (message, callback query, ...).
+        The state is memoized on the update object, so that filters and state contexts
+        read it from the storage once per update; it is read again after states change.
+
+        :meta private:
+        """
+        generation = self._state_generation
+        state = get_memoized_state(update_object, generation)
+        if state is NOT_MEMOIZED:
+            update_context = resolve_cached_context(update_object, self.bot_id)
+            if update_context is None:
+                # update type without a user
+                return None
+            chat_id, user_id, business_connection_id, bot_id, message_thread_id = update_context
+            if chat_id is None:
+                chat_id = user_id
+            state = self.current_states.get_state(
+                chat_id=chat_id,
+                user_id=user_id,
+                business_connection_id=business_connection_id,
+                bot_id=bot_id,
+                message_thread_id=message_thread_id
+            )
+            memoize_state(update_object, generation, state)
+        return state
+
+
     def add_data(self, user_id: int, chat_id: Optional[int]=None,
                     business_connection_id: Optional[str]=None,
                     message_thread_id: Optional[int]=None,
@@ -9332,21 +9488,22 @@ class TeleBot:
 
     def _notify_next_handlers(self, new_messages):
         """
-        Description: TBD
+        Passes messages to the next step handlers registered for their chats and removes
+        these messages from new_messages, so that other handlers do not get them.
 
-        :param new_messages:
+        :param new_messages: Messages, changed in place
         :return:
         """
-        for i, message in enumerate(new_messages):
-            need_pop = False
+        remaining = []
+        for message in new_messages:
             handlers = self.next_step_backend.get_handlers(message.chat.id)
             if handlers:
                 for handler in handlers:
-                    need_pop = True
-                    self._exec_task(handler["callback"], message, *handler["args"], **handler["kwargs"])
-            if need_pop:
-                # removing message that was detected with next_step_handler
-                new_messages.pop(i)
+                    self._exec_task(self._wrap_process_handler(handler["callback"]), message, *handler["args"], **handler["kwargs"])
+            else:
+                remaining.append(message)
+        if len(remaining) != len(new_messages):
+            new_messages[:] = remaining
 
 
     @staticmethod
@@ -11317,6 +11474,27 @@ class TeleBot:
         :param custom_filter: Custom filter class with key.
         """
         self.custom_filters[custom_filter.key] = custom_filter
+        self._handler_indexes.clear()
+
+
+    def reset_handler_indexes(self):
+        """
+        Rebuilds the handler indexes on the next update. Call it after changing a handler dict
+        in place, e.g. its filters; adding, removing or replacing handlers in the handler lists
+        is noticed without it.
+
+        :return: None
+        """
+        self._handler_indexes.clear()
+
+
+    def _get_text_filters(self):
+        """
+        Returns keys of the registered built-in text filters, which handler indexes compile
+        into a single text matcher instead of calling them for every handler.
+        """
+        builtin = {'text': TextMatchFilter, 'text_contains': TextContainsFilter, 'text_startswith': TextStartsFilter}
+        return [key for key, filter_class in builtin.items() if type(self.custom_filters.get(key)) is filter_class]
 
 
     def _test_message_handler(self, message_handler, message):
@@ -11337,6 +11515,72 @@ class TeleBot:
         return True
 
 
+    def _test_handler_entry(self, entry, context):
+        """
+        Test indexed handler. Filters guaranteed by the index are not tested again.
+
+        :param entry: :class:`telebot.handler_index.HandlerEntry` to test
+        :param context: :class:`telebot.handler_index.DispatchContext` of the message to test
+        :return: True if all filters conform
+        """
+        message = context.message
+        for message_filter, filter_value in entry.filters:
+            if message_filter is COMPILED_FILTER:
+                result = filter_value(context)
+                if result is UNCOMPILED:
+                    result = self._test_filter(*filter_value.uncompiled, message)
+                if not result:
+                    return False
+            elif message_filter == 'commands':
+                if not (message.content_type == 'text' and context.command in filter_value):
+                    return False
+            elif not self._test_filter(message_filter, filter_value, message):
+                return False
+        return True
+
+
+    def _get_handler_index(self, handlers):
+        """
+        Returns the index of the handler list, rebuilding it if the list has been changed.
+
+        :param handlers: handler list
+        :return: :class:`telebot.handler_index.HandlerIndex`
+        """
+        index = self._handler_indexes.get(id(handlers))
+        if index is None or index.is_stale(handlers):
+            index = HandlerIndex(handlers, self._get_text_filters(), type(self.custom_filters.get('state')) is StateFilter)
+            for entry in index.entries:
+                entry.function = self._wrap_process_handler(entry.function)
+            self._handler_indexes[id(handlers)] = index
+        return index
+
+
+    def _wrap_process_handler(self, function):
+        """
+        Returns a callable running `function` in the process pool if it is marked with
+        :func:`telebot.process_pool.run_in_process`, else `function` itself.
+        """
+        if is_process_handler(function):
+            return self._get_process_pool().wrap(function)
+        return function
+
+
+    def _get_process_pool(self):
+        """
+        Returns the process pool for handlers marked with :func:`telebot.process_pool.run_in_process`,
+        creating it on first use.
+
+        :return: :class:`telebot.process_pool.ProcessPool`
+        """
+        with self._process_pool_lock:
+            if self.process_pool is None:
+                self.process_pool = ProcessPool(self, max_workers=self.process_pool_workers)
+                if self.threaded:
+                    # worker threads wait for the process handlers they dispatched
+                    self.worker_pool.add_threads(self.process_pool.max_workers)
+            return self.process_pool
+
+
     def _test_filter(self, message_filter, filter_value, message):
         """
         Test filters
@@ -11376,17 +11620,24 @@ class TeleBot:
 
 
     # middleware check-up method
-    def _get_middlewares(self, update_type):
+    def _get_middleware_chain(self, update_type):
         """
-        Check middleware
+        Returns the middlewares for update_type with their hooks resolved (see
+        :func:`telebot.handler_index.build_middleware_chain`). The chain is cached
+        until the middleware list is changed.
 
         :param update_type:
         :return:
         """
-        middlewares = None
-        if self.middlewares:
-            middlewares = [i for i in self.middlewares if update_type in i.update_types]
-        return middlewares
+        if not self.middlewares:
+            return None
+        key = tuple(map(id, self.middlewares))
+        cached = self._middleware_chains.get(update_type)
+        if cached is None or cached[0] != key:
+            # the middlewares are kept with the chain, so that their ids are not reused while it is cached
+            cached = (key, build_middleware_chain(self.middlewares, update_type), tuple(self.middlewares))
+            self._middleware_chains[update_type] = cached
+        return cached[1]
 
 
     def _run_middlewares_and_handler(self, message, handlers, middlewares, update_type):
@@ -11395,20 +11646,27 @@ class TeleBot:
 
         :param message: received message (update part) to process with handlers and/or middlewares
         :param handlers: all created handlers (not filtered)
-        :param middlewares: middlewares that should be executed (already filtered)
+        :param middlewares: middleware chain that should be executed (see _get_middleware_chain)
         :param update_type: handler/update type (Update field name)
         :return:
         """
         if not self.use_class_middlewares:
             if handlers:
-                for handler in handlers:
-                    if self._test_message_handler(handler, message):
-                        if handler.get('pass_bot', False):
-                            result = handler['function'](message, bot=self)
+                context = DispatchContext(message)
+                index = self._get_handler_index(handlers)
+                if index.needs_state:
+                    context.state = self._get_update_state(message)
+                candidates = index.iter_candidates(context)
+                for entry in candidates:
+                    if self._test_handler_entry(entry, context):
+                        if entry.handler.get('pass_bot', False):
+                            result = entry.function(message, bot=self)
                         else:
-                            result = handler['function'](message)
+                            result = entry.function(message)
                         if not isinstance(result, ContinueHandling):
                             break
+                        if index.needs_state:
+                            candidates.update_state(self._get_update_state(message))
             return
 
         data = {}
@@ -11416,15 +11674,12 @@ class TeleBot:
         skip_handlers = False
 
         if middlewares:
-            for middleware in middlewares:
-                if middleware.update_sensitive:
-                    if hasattr(middleware, f'pre_process_{update_type}'):
-                        result = getattr(middleware, f'pre_process_{update_type}')(message, data)
-                    else:
-                        logger.error('Middleware {} does not have pre_process_{} method. pre_process function execution was skipped.'.format(middleware.__class__.__name__, update_type))
-                        result = None
+            for middleware, pre_process, _ in middlewares:
+                if pre_process is not None:
+                    result = pre_process(message, data)
                 else:
-                    result = middleware.pre_process(message, data)
+                    logger.error('Middleware {} does not have pre_process_{} method. pre_process function execution was skipped.'.format(middleware.__class__.__name__, update_type))
+                    result = None
                 # We will break this loop if CancelUpdate is returned
                 # Also, we will not run other middlewares
                 if isinstance(result, CancelUpdate):
@@ -11434,36 +11689,40 @@ class TeleBot:
 
         if handlers and not skip_handlers:
             try:
-                for handler in handlers:
-                    params = []
-                    process_handler = self._test_message_handler(handler, message)
+                context = DispatchContext(message)
+                index = self._get_handler_index(handlers)
+                if index.needs_state:
+                    context.state = self._get_update_state(message)
+                candidates = index.iter_candidates(context)
+                for entry in candidates:
+                    process_handler = self._test_handler_entry(entry, context)
                     if not process_handler: continue
-                    for i in inspect.signature(handler['function']).parameters:
-                        params.append(i)
+                    handler = entry.handler
+                    params = entry.params
                     if len(params) == 1:
-                        result = handler['function'](message)
+                        result = entry.function(message)
                     elif "data" in params:
                         if len(params) == 2:
-                            result = handler['function'](message, data)
+                            result = entry.function(message, data)
                         elif len(params) == 3:
-                            result = handler['function'](message, data=data, bot=self)
+                            result = entry.function(message, data=data, bot=self)
                         else:
                             logger.error("It is not allowed to pass data and values inside data to the handler. Check your handler: {}".format(handler['function']))
                             return
                     else:
-                        data_copy = data.copy()
-                        for key in list(data_copy):
-                            # remove data from data_copy if handler does not accept it
-                            if key not in params:
-                                del data_copy[key]
+                        # pass only data that handler accepts
+                        accepted = entry.accepted
+                        data_copy = {key: value for key, value in data.items() if key in accepted}
                         if handler.get('pass_bot'):
                             data_copy["bot"] = self
                         if len(data_copy) > len(params) - 1: # remove the message parameter
                             logger.error("You are passing more parameters than the handler needs. Check your handler: {}".format(handler['function']))
                             return
-                        result = handler["function"](message, **data_copy)
+                        result = entry.function(message, **data_copy)
                     if not isinstance(result, ContinueHandling):
                         break
+                    if index.needs_state:
+                        candidates.update_state(self._get_update_state(message))
             except Exception as e:
                 handler_error = e
                 handled = self._handle_exception(e)
@@ -11472,14 +11731,11 @@ class TeleBot:
                     logger.debug("Exception traceback:\n%s", traceback.format_exc())
 
         if middlewares:
-            for middleware in middlewares:
-                if middleware.update_sensitive:
-                    if hasattr(middleware, f'post_process_{update_type}'):
-                        getattr(middleware, f'post_process_{update_type}')(message, data, handler_error)
-                    else:
-                        logger.error("Middleware: {} does not have post_process_{} method. Post process function was not executed.".format(middleware.__class__.__name__, update_type))
+            for middleware, _, post_process in middlewares:
+                if post_process is not None:
+                    post_process(message, data, handler_error)
                 else:
-                    middleware.post_process(message, data, handler_error)
+                    logger.error("Middleware: {} does not have post_process_{} method. Post process function was not executed.".format(middleware.__class__.__name__, update_type))
 
 
     def _notify_command_handlers(self, handlers, new_messages, update_type):
@@ -11495,7 +11751,7 @@ class TeleBot:
             return
 
         if self.use_class_middlewares:
-            middlewares = self._get_middlewares(update_type)
+            middlewares = self._get_middleware_chain(update_type)
         else:
             middlewares = None
         for message in new_messages:
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 
+import itertools
 import logging
 import re
 import traceback
@@ -15,13 +16,16 @@ import telebot.types
 
 # storages
 from telebot.asyncio_storage import StateMemoryStorage, StatePickleStorage, StateStorageBase
-from telebot.asyncio_handler_backends import BaseMiddleware, CancelUpdate, SkipHandler, State, ContinueHandling
+from telebot.asyncio_handler_backends import BaseMiddleware, CancelUpdate, SkipHandler, State, ContinueHandling, UpdateDeduplicator
 
-from inspect import signature, iscoroutinefunction
+from inspect import isawaitable, iscoroutinefunction
 
 from telebot import util, types, asyncio_helper
 import asyncio
 from telebot import asyncio_filters
+from telebot.handler_index import DispatchContext, HandlerIndex, HandlerList, build_middleware_chain, iter_update_parts
+from telebot.states import NOT_MEMOIZED, get_memoized_state, memoize_state, resolve_cached_context
+from telebot.text_matching import COMPILED_FILTER, UNCOMPILED
 
 logger = logging.getLogger('TeleBot')
 
@@ -121,6 +125,11 @@ class AsyncTeleBot:
     :param validate_token: Validate token, defaults to True;
     :type validate_token: :obj:`bool`, optional
 
+    :param update_deduplicator: Drops updates whose update_id was already processed, e.g. webhook redeliveries,
+        defaults to None. Use :class:`telebot.asyncio_handler_backends.MemoryUpdateDeduplicator` or, for several
+        bot instances, :class:`telebot.asyncio_handler_backends.RedisUpdateDeduplicator`.
+    :type update_deduplicator: :class:`telebot.handler_backends.UpdateDeduplicator`, optional
+
     :raises ImportError: If coloredlogs module is not installed and colorful_logs is True
     :raises ValueError: If token is invalid
     """
@@ -133,11 +142,13 @@ class AsyncTeleBot:
                 protect_content: Optional[bool]=None,
                 allow_sending_without_reply: Optional[bool]=None,
                 colorful_logs: Optional[bool]=False,
-                validate_token: Optional[bool]=True) -> None:
+                validate_token: Optional[bool]=True,
+                update_deduplicator: Optional[UpdateDeduplicator]=None) -> None:
 
         # update-related
         self.token = token
         self.offset = offset
+        self.update_deduplicator = update_deduplicator
 
         # logs-related
         if colorful_logs:
@@ -158,40 +169,45 @@ class AsyncTeleBot:
 
         # states
         self.current_states = state_storage
+        # advanced whenever states may have changed, see _get_update_state
+        self._state_generations = itertools.count(1)
+        self._state_generation = 0
 
         # handlers
         self.update_listener = []
         self.exception_handler = exception_handler
-        self.message_handlers = []
-        self.edited_message_handlers = []
-        self.channel_post_handlers = []
-        self.edited_channel_post_handlers = []
-        self.message_reaction_handlers = []
-        self.message_reaction_count_handlers = []
-        self.inline_handlers = []
-        self.chosen_inline_handlers = []
-        self.callback_query_handlers = []
-        self.shipping_query_handlers = []
-        self.pre_checkout_query_handlers = []
-        self.poll_handlers = []
-        self.poll_answer_handlers = []
-        self.my_chat_member_handlers = []
-        self.chat_member_handlers = []
-        self.chat_join_request_handlers = []
-        self.removed_chat_boost_handlers = []
-        self.chat_boost_handlers = []
-        self.business_connection_handlers = []
-        self.business_message_handlers = []
-        self.edited_business_message_handlers = []
-        self.deleted_business_messages_handlers = []
-        self.purchased_paid_media_handlers = []
-        self.managed_bot_handlers = []
-        self.guest_message_handlers = []
-        self.subscription_handlers = []
+        self.message_handlers = HandlerList()
+        self.edited_message_handlers = HandlerList()
+        self.channel_post_handlers = HandlerList()
+        self.edited_channel_post_handlers = HandlerList()
+        self.message_reaction_handlers = HandlerList()
+        self.message_reaction_count_handlers = HandlerList()
+        self.inline_handlers = HandlerList()
+        self.chosen_inline_handlers = HandlerList()
+        self.callback_query_handlers = HandlerList()
+        self.shipping_query_handlers = HandlerList()
+        self.pre_checkout_query_handlers = HandlerList()
+        self.poll_handlers = HandlerList()
+        self.poll_answer_handlers = HandlerList()
+        self.my_chat_member_handlers = HandlerList()
+        self.chat_member_handlers = HandlerList()
+        self.chat_join_request_handlers = HandlerList()
+        self.removed_chat_boost_handlers = HandlerList()
+        self.chat_boost_handlers = HandlerList()
+        self.business_connection_handlers = HandlerList()
+        self.business_message_handlers = HandlerList()
+        self.edited_business_message_handlers = HandlerList()
+        self.deleted_business_messages_handlers = HandlerList()
+        self.purchased_paid_media_handlers = HandlerList()
+        self.managed_bot_handlers = HandlerList()
+        self.guest_message_handlers = HandlerList()
+        self.subscription_handlers = HandlerList()
 
         self.custom_filters = {}
         self.state_handlers = []
         self.middlewares = []
+        self._handler_indexes = {}
+        self._middleware_chains = {}
 
         self._user = None # set during polling
         self._polling = None
@@ -530,7 +546,7 @@ class AsyncTeleBot:
         :return:
         """
         tasks = []
-        middlewares = await self._get_middlewares(update_type)
+        middlewares = self._get_middleware_chain(update_type)
         for message in messages:
             tasks.append(self._run_middlewares_and_handlers(message, handlers, middlewares, update_type))
         await asyncio.gather(*tasks)
@@ -541,7 +557,7 @@ class AsyncTeleBot:
 
         :param message: received message (update part) to process with handlers and/or middlewares
         :param handlers: all created handlers (not filtered)
-        :param middlewares: middlewares that should be executed (already filtered)
+        :param middlewares: middleware chain that should be executed (see _get_middleware_chain)
         :param update_type: handler/update type (Update field name)
         :return:
         """
@@ -551,15 +567,12 @@ class AsyncTeleBot:
         skip_handlers = False
 
         if middlewares:
-            for middleware in middlewares:
-                if middleware.update_sensitive:
-                    if hasattr(middleware, f'pre_process_{update_type}'):
-                        middleware_result = await getattr(middleware, f'pre_process_{update_type}')(message, data)
-                    else:
-                        logger.error('Middleware {} does not have pre_process_{} method. pre_process function execution was skipped.'.format(middleware.__class__.__name__, update_type))
-                        middleware_result = None
+            for middleware, pre_process, _ in middlewares:
+                if pre_process is not None:
+                    middleware_result = await pre_process(message, data)
                 else:
-                    middleware_result = await middleware.pre_process(message, data)
+                    logger.error('Middleware {} does not have pre_process_{} method. pre_process function execution was skipped.'.format(middleware.__class__.__name__, update_type))
+                    middleware_result = None
                 if isinstance(middleware_result, CancelUpdate):
                     return
                 elif isinstance(middleware_result, SkipHandler):
@@ -567,12 +580,16 @@ class AsyncTeleBot:
 
         if handlers and (not skip_handlers):
             try:
-                for handler in handlers:
-                    params = []
-                    process_update = await self._test_message_handler(handler, message)
+                context = DispatchContext(message)
+                index = self._get_handler_index(handlers)
+                if index.needs_state:
+                    context.state = await self._get_update_state(message)
+                candidates = index.iter_candidates(context)
+                for entry in candidates:
+                    process_update = await self._test_handler_entry(entry, context)
                     if not process_update: continue
-                    for i in signature(handler['function']).parameters:
-                        params.append(i)
+                    handler = entry.handler
+                    params = entry.params
                     if len(params) == 1:
                         result = await handler['function'](message)
                     elif "data" in params:
@@ -584,11 +601,9 @@ class AsyncTeleBot:
                             logger.error("It is not allowed to pass data and values inside data to the handler. Check your handler: {}".format(handler['function']))
                             return
                     else:
-                        data_copy = data.copy()
-                        for key in list(data_copy):
-                            # remove data from data_copy if handler does not accept it
-                            if key not in params:
-                                del data_copy[key]
+                        # pass only data that handler accepts
+                        accepted = entry.accepted
+                        data_copy = {key: value for key, value in data.items() if key in accepted}
                         if handler.get('pass_bot'):
                             data_copy["bot"] = self
                         if len(data_copy) > len(params) - 1: # remove the message parameter
@@ -597,6 +612,8 @@ class AsyncTeleBot:
                         result = await handler["function"](message, **data_copy)
                     if not isinstance(result, ContinueHandling):
                         break
+                    if index.needs_state:
+                        candidates.update_state(await self._get_update_state(message))
             except Exception as e:
                 handler_error = e
                 handled = await self._handle_exception(e)
@@ -605,13 +622,11 @@ class AsyncTeleBot:
                     logger.debug("Exception traceback:\n%s", traceback.format_exc())
 
         if middlewares:
-            for middleware in middlewares:
-                if middleware.update_sensitive:
-                    if hasattr(middleware, f'post_process_{update_type}'):
-                        await getattr(middleware, f'post_process_{update_type}')(message, data, handler_error)
-                    else:
-                        logger.error('Middleware {} does not have post_process_{} method. post_process function execution was skipped.'.format(middleware.__class__.__name__, update_type))
-                else: await middleware.post_process(message, data, handler_error)
+            for middleware, _, post_process in middlewares:
+                if post_process is not None:
+                    await post_process(message, data, handler_error)
+                else:
+                    logger.error('Middleware {} does not have post_process_{} method. post_process function execution was skipped.'.format(middleware.__class__.__name__, update_type))
 
     async def process_new_updates(self, updates: List[types.Update]):
         """
@@ -624,170 +639,99 @@ class AsyncTeleBot:
 
         :return: None
         """
+        if self.update_deduplicator is not None:
+            updates = [update for update in updates if not await self._is_duplicate_update(update.update_id)]
+
         upd_count = len(updates)
         logger.info('Received {0} new updates'.format(upd_count))
         if upd_count == 0: return
 
-        new_messages = None
-        new_edited_messages = None
-        new_channel_posts = None
-        new_edited_channel_posts = None
-        new_message_reactions = None
-        new_message_reaction_count_handlers = None
-        new_inline_queries = None
-        new_chosen_inline_results = None
-        new_callback_queries = None
-        new_shipping_queries = None
-        new_pre_checkout_queries = None
-        new_polls = None
-        new_poll_answers = None
-        new_my_chat_members = None
-        new_chat_members = None
-        chat_join_request = None
-        removed_chat_boost_handlers = None
-        chat_boost_handlers = None
-        new_business_connections = None
-        new_business_messages = None
-        new_edited_business_messages = None
-        new_deleted_business_messages = None
-        new_purchased_paid_media = None
-        new_managed_bots = None
-        new_guest_messages = None
-        new_subscriptions = None
-
-
+        # states memoized on reused update objects are not trusted across batches
+        self._state_generation = next(self._state_generations)
+        batches = {}
         for update in updates:
             logger.debug('Processing updates: {0}'.format(update))
-            if update.message:
-                if new_messages is None: new_messages = []
-                new_messages.append(update.message)
-            if update.edited_message:
-                if new_edited_messages is None: new_edited_messages = []
-                new_edited_messages.append(update.edited_message)
-            if update.channel_post:
-                if new_channel_posts is None: new_channel_posts = []
-                new_channel_posts.append(update.channel_post)
-            if update.edited_channel_post:
-                if new_edited_channel_posts is None: new_edited_channel_posts = []
-                new_edited_channel_posts.append(update.edited_channel_post)
-            if update.inline_query:
-                if new_inline_queries is None: new_inline_queries = []
-                new_inline_queries.append(update.inline_query)
-            if update.chosen_inline_result:
-                if new_chosen_inline_results is None: new_chosen_inline_results = []
-                new_chosen_inline_results.append(update.chosen_inline_result)
-            if update.callback_query:
-                if new_callback_queries is None: new_callback_queries = []
-                new_callback_queries.append(update.callback_query)
-            if update.shipping_query:
-                if new_shipping_queries is None: new_shipping_queries = []
-                new_shipping_queries.append(update.shipping_query)
-            if update.pre_checkout_query:
-                if new_pre_checkout_queries is None: new_pre_checkout_queries = []
-                new_pre_checkout_queries.append(update.pre_checkout_query)
-            if update.poll:
-                if new_polls is None: new_polls = []
-                new_polls.append(update.poll)
-            if update.poll_answer:
-                if new_poll_answers is None: new_poll_answers = []
-                new_poll_answers.append(update.poll_answer)
-            if update.my_chat_member:
-                if new_my_chat_members is None: new_my_chat_members = []
-                new_my_chat_members.append(update.my_chat_member)
-            if update.chat_member:
-                if new_chat_members is None: new_chat_members = []
-                new_chat_members.append(update.chat_member)
-            if update.chat_join_request:
-                if chat_join_request is None: chat_join_request = []
-                chat_join_request.append(update.chat_join_request)
-            if update.message_reaction:
-                if new_message_reactions is None: new_message_reactions = []
-                new_message_reactions.append(update.message_reaction)
-            if update.message_reaction_count:
-                if new_message_reaction_count_handlers is None: new_message_reaction_count_handlers = []
-                new_message_reaction_count_handlers.append(update.message_reaction_count)
-            if update.chat_boost:
-                if chat_boost_handlers is None: chat_boost_handlers = []
-                chat_boost_handlers.append(update.chat_boost)
-            if update.removed_chat_boost:
-                if removed_chat_boost_handlers is None: removed_chat_boost_handlers = []
-                removed_chat_boost_handlers.append(update.removed_chat_boost)
-            if update.business_connection:
-                if new_business_connections is None: new_business_connections = []
-                new_business_connections.append(update.business_connection)
-            if update.business_message:
-                if new_business_messages is None: new_business_messages = []
-                new_business_messages.append(update.business_message)
-            if update.edited_business_message:
-                if new_edited_business_messages is None: new_edited_business_messages = []
-                new_edited_business_messages.append(update.edited_business_message)
-            if update.deleted_business_messages:
-                if new_deleted_business_messages is None: new_deleted_business_messages = []
-                new_deleted_business_messages.append(update.deleted_business_messages)
-            if update.purchased_paid_media:
-                if new_purchased_paid_media is None: new_purchased_paid_media = []
-                new_purchased_paid_media.append(update.purchased_paid_media)
-            if update.managed_bot:
-                if new_managed_bots is None: new_managed_bots = []
-                new_managed_bots.append(update.managed_bot)
-            if update.guest_message:
-                if new_guest_messages is None: new_guest_messages = []
-                new_guest_messages.append(update.guest_message)
-            if update.subscription:
-                if new_subscriptions is None: new_subscriptions = []
-                new_subscriptions.append(update.subscription)
-
-
-        if new_messages:
-            await self.process_new_messages(new_messages)
-        if new_edited_messages:
-            await self.process_new_edited_messages(new_edited_messages)
-        if new_channel_posts:
-            await self.process_new_channel_posts(new_channel_posts)
-        if new_edited_channel_posts:
-            await self.process_new_edited_channel_posts(new_edited_channel_posts)
-        if new_inline_queries:
-            await self.process_new_inline_query(new_inline_queries)
-        if new_chosen_inline_results:
-            await self.process_new_chosen_inline_query(new_chosen_inline_results)
-        if new_callback_queries:
-            await self.process_new_callback_query(new_callback_queries)
-        if new_shipping_queries:
-            await self.process_new_shipping_query(new_shipping_queries)
-        if new_pre_checkout_queries:
-            await self.process_new_pre_checkout_query(new_pre_checkout_queries)
-        if new_polls:
-            await self.process_new_poll(new_polls)
-        if new_poll_answers:
-            await self.process_new_poll_answer(new_poll_answers)
-        if new_my_chat_members:
-            await self.process_new_my_chat_member(new_my_chat_members)
-        if new_chat_members:
-            await self.process_new_chat_member(new_chat_members)
-        if chat_join_request:
-            await self.process_chat_join_request(chat_join_request)
-        if new_message_reactions:
-            await self.process_new_message_reaction(new_message_reactions)
-        if new_message_reaction_count_handlers:
-            await self.process_new_message_reaction_count(new_message_reaction_count_handlers)
-        if chat_boost_handlers:
-            await self.process_new_chat_boost(chat_boost_handlers)
-        if new_business_connections:
-            await self.process_new_business_connection(new_business_connections)
-        if new_business_messages:
-            await self.process_new_business_message(new_business_messages)
-        if new_edited_business_messages:
-            await self.process_new_edited_business_message(new_edited_business_messages)
-        if new_deleted_business_messages:
-            await self.process_new_deleted_business_messages(new_deleted_business_messages)
-        if new_purchased_paid_media:
-            await self.process_new_purchased_paid_media(new_purchased_paid_media)
-        if new_managed_bots:
-            await self.process_new_managed_bots(new_managed_bots)
-        if new_guest_messages:
-            await self.process_new_guest_message(new_guest_messages)
-        if new_subscriptions:
-            await self.process_new_subscriptions(new_subscriptions)
+            for update_type, part in iter_update_parts(update):
+                batch = batches.get(update_type)
+                if batch is None:
+                    batches[update_type] = [part]
+                else:
+                    batch.append(part)
+
+        for update_type, process, handlers, middleware_type in self._update_routes:
+            batch = batches.get(update_type)
+            if batch and not self._can_skip_update_type(process, handlers, middleware_type):
+                await getattr(self, process)(batch)
+
+    #: Update types in processing order: (Update field, method processing them, attribute holding their handlers
+    #: or None if they are never skipped, update type for middlewares)
+    _update_routes = (
+        ('message', 'process_new_messages', None, 'message'),
+        ('edited_message', 'process_new_edited_messages', 'edited_message_handlers', 'edited_message'),
+        ('channel_post', 'process_new_channel_posts', 'channel_post_handlers', 'channel_post'),
+        ('edited_channel_post', 'process_new_edited_channel_posts', 'edited_channel_post_handlers', 'edited_channel_post'),
+        ('inline_query', 'process_new_inline_query', 'inline_handlers', 'inline_query'),
+        ('chosen_inline_result', 'process_new_chosen_inline_query', 'chosen_inline_handlers', 'chosen_inline_query'),
+        ('callback_query', 'process_new_callback_query', 'callback_query_handlers', 'callback_query'),
+        ('shipping_query', 'process_new_shipping_query', 'shipping_query_handlers', 'shipping_query'),
+        ('pre_checkout_query', 'process_new_pre_checkout_query', 'pre_checkout_query_handlers', 'pre_checkout_query'),
+        ('poll', 'process_new_poll', 'poll_handlers', 'poll'),
+        ('poll_answer', 'process_new_poll_answer', 'poll_answer_handlers', 'poll_answer'),
+        ('my_chat_member', 'process_new_my_chat_member', 'my_chat_member_handlers', 'my_chat_member'),
+        ('chat_member', 'process_new_chat_member', 'chat_member_handlers', 'chat_member'),
+        ('chat_join_request', 'process_chat_join_request', 'chat_join_request_handlers', 'chat_join_request'),
+        ('message_reaction', 'process_new_message_reaction', 'message_reaction_handlers', 'message_reaction'),
+        ('message_reaction_count', 'process_new_message_reaction_count', 'message_reaction_count_handlers', 'message_reaction_count'),
+        ('chat_boost', 'process_new_chat_boost', 'chat_boost_handlers', 'chat_boost'),
+        ('removed_chat_boost', 'process_new_removed_chat_boost', 'removed_chat_boost_handlers', 'removed_chat_boost'),
+        ('business_connection', 'process_new_business_connection', 'business_connection_handlers', 'business_connection'),
+        ('business_message', 'process_new_business_message', 'business_message_handlers', 'business_message'),
+        ('edited_business_message', 'process_new_edited_business_message', 'edited_business_message_handlers', 'edited_business_message'),
+        ('deleted_business_messages', 'process_new_deleted_business_messages', 'deleted_business_messages_handlers', 'deleted_business_messages'),
+        ('purchased_paid_media', 'process_new_purchased_paid_media', 'purchased_paid_media_handlers', 'purchased_paid_media'),
+        ('managed_bot', 'process_new_managed_bots', 'managed_bot_handlers', 'managed_bot'),
+        ('guest_message', 'process_new_guest_message', 'guest_message_handlers', 'guest_message'),
+        ('subscription', 'process_new_subscriptions', 'subscription_handlers', 'subscription'),
+    )
+
+    def _can_skip_update_type(self, process, handlers, middleware_type) -> bool:
+        """
+        Checks whether processing an update type would do nothing: no handlers, no middlewares
+        and the processing method is not overridden.
+
+        :meta private:
+        """
+        if handlers is None or getattr(self, handlers):
+            return False
+        if self._get_middleware_chain(middleware_type):
+            return False
+        return getattr(type(self), process) is getattr(AsyncTeleBot, process)
+
+    async def _is_duplicate_update(self, update_id):
+        duplicate = self.update_deduplicator.is_duplicate(update_id)
+        if isawaitable(duplicate):
+            duplicate = await duplicate
+        return duplicate
+
+    async def is_known_update(self, update_id: Optional[int]) -> bool:
+        """
+        Checks whether an update with this id was already processed, so that it can be dropped
+        before decoding. Always False if no update_deduplicator is set.
+
+        :meta private:
+
+        :param update_id: Update id
+        :type update_id: :obj:`int`
+
+        :return: True if the update is a duplicate
+        :rtype: :obj:`bool`
+        """
+        if self.update_deduplicator is None or update_id is None:
+            return False
+        seen = self.update_deduplicator.seen(update_id)
+        if isawaitable(seen):
+            seen = await seen
+        return seen
 
     async def process_new_messages(self, new_messages):
         """
@@ -946,14 +890,23 @@ class AsyncTeleBot:
         """
         await self._process_updates(self.subscription_handlers, new_subscriptions, 'subscription')
 
-    async def _get_middlewares(self, update_type):
+    def _get_middleware_chain(self, update_type):
         """
+        Returns the middlewares for update_type with their hooks resolved (see
+        :func:`telebot.handler_index.build_middleware_chain`). The chain is cached
+        until the middleware list is changed.
+
         :meta private:
         """
-        if self.middlewares:
-            middlewares = [middleware for middleware in self.middlewares if update_type in middleware.update_types]
-            return middlewares
-        return None
+        if not self.middlewares:
+            return None
+        key = tuple(map(id, self.middlewares))
+        cached = self._middleware_chains.get(update_type)
+        if cached is None or cached[0] != key:
+            # the middlewares are kept with the chain, so that their ids are not reused while it is cached
+            cached = (key, build_middleware_chain(self.middlewares, update_type), tuple(self.middlewares))
+            self._middleware_chains[update_type] = cached
+        return cached[1]
 
     async def __notify_update(self, new_messages):
         if len(self.update_listener) == 0:
@@ -978,6 +931,44 @@ class AsyncTeleBot:
 
         return True
 
+    async def _test_handler_entry(self, entry, context):
+        """
+        Test indexed handler. Filters guaranteed by the index are not tested again.
+
+        :param entry: :class:`telebot.handler_index.HandlerEntry` to test
+        :param context: :class:`telebot.handler_index.DispatchContext` of the message to test
+        :return: True if all filters conform
+        """
+        message = context.message
+        for message_filter, filter_value in entry.filters:
+            if message_filter is COMPILED_FILTER:
+                result = filter_value(context)
+                if result is UNCOMPILED:
+                    result = await self._test_filter(*filter_value.uncompiled, message)
+                if not result:
+                    return False
+            elif message_filter == 'commands':
+                if not (message.content_type == 'text' and context.command in filter_value):
+                    return False
+            elif not await self._test_filter(message_filter, filter_value, message):
+                return False
+        return True
+
+    def _get_handler_index(self, handlers):
+        """
+        Returns the index of the handler list, rebuilding it if the list has been changed.
+
+        :param handlers: handler list
+        :return: :class:`telebot.handler_index.HandlerIndex`
+        """
+        index = self._handler_indexes.get(id(handlers))
+        if index is None or index.is_stale(handlers):
+            index = HandlerIndex(
+                handlers, self._get_text_filters(), type(self.custom_filters.get('state')) is asyncio_filters.StateFilter,
+                asynchronous=True)
+            self._handler_indexes[id(handlers)] = index
+        return index
+
     def set_update_listener(self, func: Awaitable):
         """
         Update listener is a function that gets any update.
@@ -1017,6 +1008,29 @@ class AsyncTeleBot:
         :return: None
         """
         self.custom_filters[custom_filter.key] = custom_filter
+        self._handler_indexes.clear()
+
+    def reset_handler_indexes(self):
+        """
+        Rebuilds the handler indexes on the next update. Call it after changing a handler dict
+        in place, e.g. its filters; adding, removing or replacing handlers in the handler lists
+        is noticed without it.
+
+        :return: None
+        """
+        self._handler_indexes.clear()
+
+    def _get_text_filters(self):
+        """
+        Returns keys of the registered built-in text filters, which handler indexes compile
+        into a single text matcher instead of calling them for every handler.
+        """
+        builtin = {
+            'text': asyncio_filters.TextMatchFilter,
+            'text_contains': asyncio_filters.TextContainsFilter,
+            'text_startswith': asyncio_filters.TextStartsFilter,
+        }
+        return [key for key, filter_class in builtin.items() if type(self.custom_filters.get(key)) is filter_class]
 
     async def _test_filter(self, message_filter, filter_value, message):
         """
@@ -1093,6 +1107,7 @@ class AsyncTeleBot:
             middleware.update_sensitive = False
 
         self.middlewares.append(middleware)
+        self._middleware_chains.clear()
 
     @staticmethod
     def check_commands_input(commands, method_name):
@@ -10506,8 +10521,10 @@ class AsyncTeleBot:
             chat_id = user_id
         if bot_id is None:
             bot_id = self.bot_id
-        return await self.current_states.set_state(chat_id, user_id, state,
+        result = await self.current_states.set_state(chat_id, user_id, state,
             bot_id=bot_id, business_connection_id=business_connection_id, message_thread_id=message_thread_id)
+        self._state_generation = next(self._state_generations)
+        return result
 
 
     async def reset_data(self, user_id: int, chat_id: Optional[int]=None,
@@ -10568,8 +10585,10 @@ class AsyncTeleBot:
             chat_id = user_id
         if bot_id is None:
             bot_id = self.bot_id
-        return await self.current_states.delete_state(chat_id, user_id,
+        result = await self.current_states.delete_state(chat_id, user_id,
             bot_id=bot_id, business_connection_id=business_connection_id, message_thread_id=message_thread_id)
+        self._state_generation = next(self._state_generations)
+        return result
 
 
     def retrieve_data(self, user_id: int, chat_id: Optional[int]=None, business_connection_id: Optional[str]=None,
@@ -10641,6 +10660,35 @@ class AsyncTeleBot:
             bot_id=bot_id, business_connection_id=business_connection_id, message_thread_id=message_thread_id)
 
 
+    async def _get_update_state(self, update_object):
+        """
+        Returns the state of the user of an update object (message, callback query, ...).
+        The state is memoized on the update object, so that filters and state contexts
+        read it from the storage once per update; it is read again after states change.
+
+        :meta private:
+        """
+        generation = self._state_generation
+        state = get_memoized_state(update_object, generation)
+        if state is NOT_MEMOIZED:
+            update_context = resolve_cached_context(update_object, self.bot_id)
+            if update_context is None:
+                # update type without a user
+                return None
+            chat_id, user_id, business_connection_id, bot_id, message_thread_id = update_context
+            if chat_id is None:
+                chat_id = user_id
+            state = await self.current_states.get_state(
+                chat_id=chat_id,
+                user_id=user_id,
+                business_connection_id=business_connection_id,
+                bot_id=bot_id,
+                message_thread_id=message_thread_id
+            )
+            memoize_state(update_object, generation, state)
+        return state
+
+
     async def add_data(self, user_id: int, chat_id: Optional[int]=None,
                     business_connection_id: Optional[str]=None,
                     message_thread_id: Optional[int]=None,
@@ -2,6 +2,13 @@
 File with all middleware classes, states.
 """
 from telebot.states import State, StatesGroup
+from telebot.handler_backends import UpdateDeduplicator, MemoryUpdateDeduplicator
+
+try:
+    from redis.asyncio import Redis
+    redis_installed = True
+except ImportError:
+    redis_installed = False
 
 
 class BaseMiddleware:
@@ -96,3 +103,29 @@ class ContinueHandling:
     """
     def __init__(self) -> None:
         pass
+
+
+class RedisUpdateDeduplicator(UpdateDeduplicator):
+    """
+    Remembers update ids in Redis for ttl seconds, so that several bot instances
+    can share them. Pass redis to reuse an existing connection.
+
+    :meta private:
+    """
+    def __init__(self, host='localhost', port=6379, db=0, prefix='telebot', password=None, ttl=86400, redis=None):
+        if redis is None:
+            if not redis_installed:
+                raise Exception("Redis is not installed. Install it via 'pip install redis'")
+            redis = Redis(host=host, port=port, db=db, password=password)
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, update_id):
+        return ':'.join((self.prefix, 'update', str(update_id)))
+
+    async def is_duplicate(self, update_id):
+        return not await self.redis.set(self._key(update_id), 1, nx=True, ex=self.ttl)
+
+    async def seen(self, update_id):
+        return bool(await self.redis.exists(self._key(update_id)))
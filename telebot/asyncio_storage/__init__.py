@@ -1,6 +1,7 @@
 from telebot.asyncio_storage.memory_storage import StateMemoryStorage
 from telebot.asyncio_storage.redis_storage import StateRedisStorage
 from telebot.asyncio_storage.pickle_storage import StatePickleStorage
+from telebot.asyncio_storage.sqlite_storage import StateSQLiteStorage
 from telebot.asyncio_storage.base_storage import StateDataContext, StateStorageBase
 
 
@@ -10,4 +11,5 @@ __all__ = [
     "StateMemoryStorage",
     "StateRedisStorage",
     "StatePickleStorage",
+    "StateSQLiteStorage",
 ]
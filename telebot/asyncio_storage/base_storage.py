@@ -1,5 +1,7 @@
 import copy
 
+from telebot.storage.base_storage import get_data_changes
+
 
 class StateStorageBase:
     def __init__(self) -> None:
@@ -63,6 +65,42 @@ class StateStorageBase:
     ):
         raise NotImplementedError
 
+    async def get_states(self, chat_user_ids,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        """
+        Get states for many (chat_id, user_id) pairs, in their order.
+        Storages can override this to fetch them at once.
+        """
+        return [
+            await self.get_state(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+            for chat_id, user_id in chat_user_ids
+        ]
+
+    async def delete_states_for_chat(self, chat_id, bot_id=None):
+        """
+        Delete the states and data of all users in a chat, in all topics and business connections.
+        Returns the number of deleted states.
+        In these bulk operations, bot_id None matches the states of any bot.
+        """
+        raise NotImplementedError
+
+    async def count_states(self, chat_id=None, bot_id=None):
+        """
+        Count the states in a chat, or in all chats if chat_id is None.
+        """
+        raise NotImplementedError
+
+    def iter_states(self, chat_id=None, bot_id=None):
+        """
+        Iterate over the states of a chat, or of all chats if chat_id is None,
+        as (chat_id, user_id, business_connection_id, message_thread_id, bot_id, state) tuples.
+        Returns an async iterator.
+        """
+        raise NotImplementedError
+
     def get_interactive_data(self, chat_id, user_id,
         business_connection_id=None,
         message_thread_id=None,
@@ -77,6 +115,28 @@ class StateStorageBase:
     async def save(self, chat_id, user_id, data):
         raise NotImplementedError
 
+    async def update_data(self, chat_id, user_id, changed, removed,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        """
+        Set the changed keys and remove the removed keys of the data of a user.
+        Called by :class:`StateDataContext` if the data was changed.
+        Storages can override this to write only these keys.
+        """
+        data = dict(await self.get_data(
+            chat_id=chat_id,
+            user_id=user_id,
+            business_connection_id=business_connection_id,
+            message_thread_id=message_thread_id,
+            bot_id=bot_id,
+        ))
+        data.update(changed)
+        for key in removed:
+            data.pop(key, None)
+        return await self.save(chat_id, user_id, data, business_connection_id, message_thread_id, bot_id)
+
     def _get_key(
         self,
         chat_id: int,
@@ -119,11 +179,14 @@ class StateDataContext:
     ):
         self.obj = obj
         self.data = None
+        self.original = None
         self.chat_id = chat_id
         self.user_id = user_id
         self.bot_id = bot_id
         self.business_connection_id = business_connection_id
         self.message_thread_id = message_thread_id
+        #: Result of the storage write on exit, None if the data was not changed
+        self.saved = None
 
     async def __aenter__(self):
         data = await self.obj.get_data(
@@ -133,15 +196,24 @@ class StateDataContext:
             message_thread_id=self.message_thread_id,
             bot_id=self.bot_id,
         )
+        # kept to write only the keys changed in the context
+        self.original = copy.deepcopy(data)
         self.data = copy.deepcopy(data)
         return self.data
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        return await self.obj.save(
+        # the result is kept as a status only: a true return value would swallow
+        # exceptions raised in the block
+        changed, removed = get_data_changes(self.original, self.data)
+        if not changed and not removed:
+            return None
+        self.saved = await self.obj.update_data(
             self.chat_id,
             self.user_id,
-            self.data,
+            changed,
+            removed,
             self.business_connection_id,
             self.message_thread_id,
             self.bot_id,
         )
+        return None
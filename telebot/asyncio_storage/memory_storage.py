@@ -1,36 +1,71 @@
 from telebot.asyncio_storage.base_storage import StateStorageBase, StateDataContext
-from typing import Optional, Union
+from telebot.storage.memory_storage import StateMemoryStorage as SyncStateMemoryStorage
+from typing import Optional, Union, AsyncIterator
 
 
 class StateMemoryStorage(StateStorageBase):
     """
     Memory storage for states.
 
-    Stores states in memory as a dictionary.
+    Stores states in memory as a dictionary, or sharded with expiration and size limit, like
+    :class:`telebot.storage.StateMemoryStorage`. The operations never wait for I/O, so they
+    run directly on the event loop; the shard locks are only held for dict operations.
 
     .. code-block:: python3
 
-        storage = StateMemoryStorage()
-        bot = AsyncTeleBot(token, storage=storage)
+        storage = StateMemoryStorage(ttl=24 * 60 * 60, max_entries=100000)
+        bot = AsyncTeleBot(token, state_storage=storage)
 
     :param separator: Separator for keys, default is ":".
     :type separator: Optional[str]
 
     :param prefix: Prefix for keys, default is "telebot".
     :type prefix: Optional[str]
+
+    :param ttl: Seconds after the last use of a record until it expires, default is None (never).
+    :type ttl: Optional[float]
+
+    :param max_entries: Maximum number of records, default is None (unlimited).
+    :type max_entries: Optional[int]
+
+    :param shards: Number of shards, default is None (16 if ttl or max_entries is set, otherwise a single dictionary).
+    :type shards: Optional[int]
+
+    :param eviction_interval: Seconds between runs of the background eviction, default is 60.
+    :type eviction_interval: Optional[float]
+
+    :param indexes: Index the keys by chat and by bot (needed for bulk operations without shards), default is False.
+    :type indexes: Optional[bool]
     """
 
     def __init__(
-        self, separator: Optional[str] = ":", prefix: Optional[str] = "telebot"
+        self,
+        separator: Optional[str] = ":",
+        prefix: Optional[str] = "telebot",
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        shards: Optional[int] = None,
+        eviction_interval: Optional[float] = 60,
+        indexes: Optional[bool] = False,
     ) -> None:
+        self.storage = SyncStateMemoryStorage(
+            separator=separator,
+            prefix=prefix,
+            ttl=ttl,
+            max_entries=max_entries,
+            shards=shards,
+            eviction_interval=eviction_interval,
+            indexes=indexes,
+        )
         self.separator = separator
         self.prefix = prefix
-        if not self.prefix:
-            raise ValueError("Prefix cannot be empty")
 
-        self.data = (
-            {}
-        )  # key: telebot:bot_id:business_connection_id:message_thread_id:chat_id:user_id
+    @property
+    def data(self) -> Optional[dict]:
+        """
+        States by key if the storage is not sharded, see :class:`telebot.storage.StateMemoryStorage`.
+        """
+        return self.storage.data
 
     async def set_state(
         self,
@@ -41,26 +76,10 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
-        if hasattr(state, "name"):
-            state = state.name
-
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
+        return self.storage.set_state(
+            chat_id, user_id, state, business_connection_id, message_thread_id, bot_id
         )
 
-        if self.data.get(_key) is None:
-            self.data[_key] = {"state": state, "data": {}}
-        else:
-            self.data[_key]["state"] = state
-
-        return True
-
     async def get_state(
         self,
         chat_id: int,
@@ -69,22 +88,10 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> Union[str, None]:
-
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
+        return self.storage.get_state(
+            chat_id, user_id, business_connection_id, message_thread_id, bot_id
         )
 
-        if self.data.get(_key) is None:
-            return None
-
-        return self.data[_key]["state"]
-
     async def delete_state(
         self,
         chat_id: int,
@@ -93,22 +100,10 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
+        return self.storage.delete_state(
+            chat_id, user_id, business_connection_id, message_thread_id, bot_id
         )
 
-        if self.data.get(_key) is None:
-            return False
-
-        del self.data[_key]
-        return True
-
     async def set_data(
         self,
         chat_id: int,
@@ -119,22 +114,10 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
-
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
+        return self.storage.set_data(
+            chat_id, user_id, key, value, business_connection_id, message_thread_id, bot_id
         )
 
-        if self.data.get(_key) is None:
-            raise RuntimeError(f"MemoryStorage: key {_key} does not exist.")
-        self.data[_key]["data"][key] = value
-        return True
-
     async def get_data(
         self,
         chat_id: int,
@@ -143,19 +126,10 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> dict:
-
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
+        return self.storage.get_data(
+            chat_id, user_id, business_connection_id, message_thread_id, bot_id
         )
 
-        return self.data.get(_key, {}).get("data", {})
-
     async def reset_data(
         self,
         chat_id: int,
@@ -164,22 +138,10 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
-
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
+        return self.storage.reset_data(
+            chat_id, user_id, business_connection_id, message_thread_id, bot_id
         )
 
-        if self.data.get(_key) is None:
-            return False
-        self.data[_key]["data"] = {}
-        return True
-
     def get_interactive_data(
         self,
         chat_id: int,
@@ -206,20 +168,51 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
+        return self.storage.save(
+            chat_id, user_id, data, business_connection_id, message_thread_id, bot_id
         )
 
-        if self.data.get(_key) is None:
-            return False
-        self.data[_key]["data"] = data
-        return True
+    async def update_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        changed: dict,
+        removed: list,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        return self.storage.update_data(
+            chat_id, user_id, changed, removed, business_connection_id, message_thread_id, bot_id
+        )
+
+    async def delete_states_for_chat(self, chat_id: int, bot_id: Optional[int] = None) -> int:
+        return self.storage.delete_states_for_chat(chat_id, bot_id)
+
+    async def count_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> int:
+        return self.storage.count_states(chat_id, bot_id)
+
+    async def iter_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> AsyncIterator[tuple]:
+        for record in self.storage.iter_states(chat_id, bot_id):
+            yield record
+
+    def evict_expired(self) -> int:
+        """
+        Drops the expired records, see :meth:`telebot.storage.StateMemoryStorage.evict_expired`.
+        """
+        return self.storage.evict_expired()
+
+    def stats(self) -> dict:
+        """
+        Returns the number of records and eviction counters as a dict.
+        """
+        return self.storage.stats()
+
+    async def close(self) -> None:
+        """
+        Stops the background eviction thread.
+        """
+        self.storage.close()
 
     def __str__(self) -> str:
-        return f"<StateMemoryStorage: {self.data}>"
+        return f"<StateMemoryStorage: {self.stats()['entries']} states>"
@@ -1,23 +1,14 @@
-aiofiles_installed = True
-try:
-    import aiofiles
-except ImportError:
-    aiofiles_installed = False
-
 import os
 import pickle
 import asyncio
-from typing import Optional, Union, Callable, Any
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union, AsyncIterator
 
 from telebot.asyncio_storage.base_storage import StateStorageBase, StateDataContext
+from telebot.storage.pickle_storage import record_ids, find_records
 
-
-def with_lock(func: Callable) -> Callable:
-    async def wrapper(self, *args, **kwargs):
-        async with self.lock:
-            return await func(self, *args, **kwargs)
-
-    return wrapper
+logger = logging.getLogger('TeleBot')
 
 
 class StatePickleStorage(StateStorageBase):
@@ -35,6 +26,18 @@ class StatePickleStorage(StateStorageBase):
         storage = StatePickleStorage()
         bot = AsyncTeleBot(token, storage=storage)
 
+    The file is read once, then the states are kept in memory, so reads are dict lookups.
+    Each change is written to the file before the call returns; the states are pickled and
+    written in a separate thread, so the event loop is never blocked by the file.
+
+    With flush_delay set, changes are written by a flush that starts at most flush_delay
+    seconds after the first change instead, so a burst of changes is written at once.
+    Changes that are not flushed yet are lost if the process exits, so call :meth:`close`
+    (or :meth:`flush`) before exiting then.
+
+    The records keep the parts of their keys for the bulk operations, see
+    :class:`telebot.storage.StatePickleStorage`.
+
     :param file_path: Path to file where states will be stored.
     :type file_path: str
 
@@ -43,6 +46,10 @@ class StatePickleStorage(StateStorageBase):
 
     :param separator: Separator for keys, default is ":".
     :type separator: Optional[str]
+
+    :param flush_delay: Maximum seconds between a change and the start of its write,
+        default is None (each change is written before the call returns).
+    :type flush_delay: Optional[float]
     """
 
     def __init__(
@@ -50,25 +57,30 @@ class StatePickleStorage(StateStorageBase):
         file_path: str = "./.state-save/states.pkl",
         prefix="telebot",
         separator: Optional[str] = ":",
+        flush_delay: Optional[float] = None,
     ) -> None:
-
-        if not aiofiles_installed:
-            raise ImportError("Please install aiofiles using `pip install aiofiles`")
-
         self.file_path = file_path
         self.prefix = prefix
         self.separator = separator
-        self.lock = asyncio.Lock()
+        self.flush_delay = flush_delay
         self.create_dir()
+        self.states = self._read_from_file()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="StatePickleStorage")
+        self._dirty = False
+        self._flush_task = None
+        self._flush_lock = None
 
-    async def _read_from_file(self) -> dict:
-        async with aiofiles.open(self.file_path, "rb") as f:
-            data = await f.read()
-            return pickle.loads(data)
+    def _read_from_file(self) -> dict:
+        with open(self.file_path, "rb") as f:
+            return pickle.load(f)
 
-    async def _write_to_file(self, data: dict) -> None:
-        async with aiofiles.open(self.file_path, "wb") as f:
-            await f.write(pickle.dumps(data))
+    def _write_to_file(self, data: dict) -> None:
+        # runs in the executor; the records are never changed in place, so a shallow
+        # copy of the dict can be pickled while the event loop goes on
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f)
+        os.replace(tmp_path, self.file_path)
 
     def create_dir(self):
         """
@@ -80,7 +92,55 @@ class StatePickleStorage(StateStorageBase):
             with open(self.file_path, "wb") as file:
                 pickle.dump({}, file)
 
-    @with_lock
+    async def _changed(self) -> None:
+        self._dirty = True
+        if self.flush_delay is None:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        # changes made during the flush schedule the next one
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error("StatePickleStorage: failed to write %s: %s", self.file_path, e)
+            self._dirty = True
+            if self._flush_task is None:
+                self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def flush(self) -> bool:
+        """
+        Write the states to the file now.
+
+        :return: False if there were no changes since the last flush.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._dirty:
+                return False
+            self._dirty = False
+            snapshot = dict(self.states)
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.executor, self._write_to_file, snapshot)
+            except BaseException:
+                self._dirty = True
+                raise
+            return True
+
+    async def close(self) -> None:
+        """
+        Write the last changes and stop the writer thread.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        self.executor.shutdown(wait=True)
+
     async def set_state(
         self,
         chat_id: int,
@@ -90,6 +150,9 @@ class StatePickleStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
+        if hasattr(state, "name"):
+            state = state.name
+
         _key = self._get_key(
             chat_id,
             user_id,
@@ -99,15 +162,15 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = await self._read_from_file()
-        if _key not in data:
-            data[_key] = {"state": state, "data": {}}
-        else:
-            data[_key]["state"] = state
-        await self._write_to_file(data)
+        record = self.states.get(_key)
+        self.states[_key] = {
+            "state": state,
+            "data": {} if record is None else record["data"],
+            "ids": record_ids(chat_id, user_id, business_connection_id, message_thread_id, bot_id),
+        }
+        await self._changed()
         return True
 
-    @with_lock
     async def get_state(
         self,
         chat_id: int,
@@ -125,10 +188,8 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = await self._read_from_file()
-        return data.get(_key, {}).get("state")
+        return self.states.get(_key, {}).get("state")
 
-    @with_lock
     async def delete_state(
         self,
         chat_id: int,
@@ -146,14 +207,11 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = await self._read_from_file()
-        if _key in data:
-            del data[_key]
-            await self._write_to_file(data)
-            return True
-        return False
+        if self.states.pop(_key, None) is None:
+            return False
+        await self._changed()
+        return True
 
-    @with_lock
     async def set_data(
         self,
         chat_id: int,
@@ -173,17 +231,15 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = await self._read_from_file()
-        state_data = data.get(_key, {})
-        state_data["data"][key] = value
-        if _key not in data:
+        record = self.states.get(_key)
+        if record is None:
             raise RuntimeError(f"StatePickleStorage: key {_key} does not exist.")
-        else:
-            data[_key]["data"][key] = value
-        await self._write_to_file(data)
+        data = dict(record["data"])
+        data[key] = value
+        self.states[_key] = dict(record, data=data)
+        await self._changed()
         return True
 
-    @with_lock
     async def get_data(
         self,
         chat_id: int,
@@ -201,10 +257,8 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = await self._read_from_file()
-        return data.get(_key, {}).get("data", {})
+        return dict(self.states.get(_key, {}).get("data", {}))
 
-    @with_lock
     async def reset_data(
         self,
         chat_id: int,
@@ -222,12 +276,12 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = await self._read_from_file()
-        if _key in data:
-            data[_key]["data"] = {}
-            await self._write_to_file(data)
-            return True
-        return False
+        record = self.states.get(_key)
+        if record is None:
+            return False
+        self.states[_key] = dict(record, data={})
+        await self._changed()
+        return True
 
     def get_interactive_data(
         self,
@@ -246,7 +300,6 @@ class StatePickleStorage(StateStorageBase):
             bot_id=bot_id,
         )
 
-    @with_lock
     async def save(
         self,
         chat_id: int,
@@ -265,10 +318,27 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        file_data = await self._read_from_file()
-        file_data[_key]["data"] = data
-        await self._write_to_file(file_data)
+        record = self.states.get(_key)
+        if record is None:
+            return False
+        self.states[_key] = dict(record, data=dict(data))
+        await self._changed()
         return True
 
+    async def delete_states_for_chat(self, chat_id: int, bot_id: Optional[int] = None) -> int:
+        records = find_records(self.states, chat_id, bot_id)
+        for _key, _ in records:
+            del self.states[_key]
+        if records:
+            await self._changed()
+        return len(records)
+
+    async def count_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> int:
+        return len(find_records(self.states, chat_id, bot_id))
+
+    async def iter_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> AsyncIterator[tuple]:
+        for _, record in find_records(self.states, chat_id, bot_id):
+            yield (*record["ids"], record["state"])
+
     def __str__(self) -> str:
         return f"StatePickleStorage({self.file_path}, {self.prefix})"
@@ -6,29 +6,18 @@ except ImportError:
     redis_installed = False
 
 import json
-from typing import Optional, Union, Callable, Coroutine
+import types
+import logging
+from typing import Optional, Union, Callable, Coroutine, List, Tuple, AsyncIterator, Iterable
 import asyncio
 
 from telebot.asyncio_storage.base_storage import StateStorageBase, StateDataContext
+from telebot.storage.redis_storage import (
+    DATA_FIELD_PREFIX, SET_STATE_SCRIPT, SET_DATA_SCRIPT, REPLACE_DATA_SCRIPT, UPDATE_DATA_SCRIPT,
+    NearCache, encode_data, decode_data, decode_state, encode_data_changes, data_field_names,
+)
 
-
-def async_with_lock(func: Callable[..., Coroutine]) -> Callable[..., Coroutine]:
-    async def wrapper(self, *args, **kwargs):
-        async with self.lock:
-            return await func(self, *args, **kwargs)
-
-    return wrapper
-
-
-def async_with_pipeline(func: Callable[..., Coroutine]) -> Callable[..., Coroutine]:
-    async def wrapper(self, *args, **kwargs):
-        async with self.redis.pipeline() as pipe:
-            pipe.multi()
-            result = await func(self, pipe, *args, **kwargs)
-            await pipe.execute()
-            return result
-
-    return wrapper
+logger = logging.getLogger('TeleBot')
 
 
 class StateRedisStorage(StateStorageBase):
@@ -64,6 +53,25 @@ class StateRedisStorage(StateStorageBase):
     :param separator: Separator for keys, default is ":".
     :type separator: Optional[str]
 
+    :param cache_size: Number of users whose state and data are cached in the process,
+        default is None (no cache).
+    :type cache_size: Optional[int]
+
+    :param cache_ttl: Seconds a cached state is used, default is 5.
+    :type cache_ttl: Optional[float]
+
+    :param indexes: Keep sets of the users with a state per chat and per bot, needed by
+        :meth:`delete_states_for_chat`, :meth:`count_states` and :meth:`iter_states`,
+        default is False.
+    :type indexes: Optional[bool]
+
+    :param data_fields: Store each data value in its own hash field, default is False
+        (the whole data dict in the "data" field, as older versions do).
+    :type data_fields: Optional[bool]
+
+    See :class:`telebot.storage.StateRedisStorage` for the layouts of the data, how to switch
+    them, the cache and the indexes. The cache subscriber runs as a task started by
+    the first operation; call :meth:`close` to stop it.
     """
 
     def __init__(
@@ -76,6 +84,10 @@ class StateRedisStorage(StateStorageBase):
         redis_url=None,
         connection_pool: "ConnectionPool" = None,
         separator: Optional[str] = ":",
+        cache_size: Optional[int] = None,
+        cache_ttl: Optional[float] = 5,
+        indexes: Optional[bool] = False,
+        data_fields: Optional[bool] = False,
     ) -> None:
 
         if not redis_installed:
@@ -93,13 +105,225 @@ class StateRedisStorage(StateStorageBase):
         else:
             self.redis = Redis(host=host, port=port, db=db, password=password)
 
-        self.lock = asyncio.Lock()
+        self._set_state_script = self.redis.register_script(SET_STATE_SCRIPT)
+        self._set_data_script = self.redis.register_script(SET_DATA_SCRIPT)
+        self._replace_data_script = self.redis.register_script(REPLACE_DATA_SCRIPT)
+        self._update_data_script = self.redis.register_script(UPDATE_DATA_SCRIPT)
+
+        self.indexes = indexes
+        self.data_fields = data_fields
+        self.invalidation_channel = separator.join((prefix, "invalidate"))
+        self.cache = NearCache(cache_size, cache_ttl) if cache_size else None
+        self._invalidator = None
+
+    async def _run_invalidator(self) -> None:
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await self._subscribe(pubsub)
+                while True:
+                    message = await pubsub.get_message(timeout=None)
+                    if message is None:
+                        continue
+                    if message["type"] == "subscribe":
+                        self.cache.set_active(True)
+                    elif message["type"] == "unsubscribe":
+                        self.cache.set_active(False)
+                    elif message["type"] == "message":
+                        self.cache.invalidate(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the cache may have missed invalidations, so it is not used until subscribed again
+                self.cache.set_active(False)
+                logger.error("StateRedisStorage: invalidation channel failed: %s", e)
+                await asyncio.sleep(1)
+            finally:
+                self.cache.set_active(False)
+                await pubsub.reset()
+
+    async def _subscribe(self, pubsub) -> None:
+        on_connect = pubsub.on_connect
+
+        async def reconnected(pubsub, connection):
+            # see telebot.storage.StateRedisStorage._subscribe
+            self.cache.set_active(False)
+            await on_connect(connection)
+
+        pubsub.on_connect = types.MethodType(reconnected, pubsub)
+        await pubsub.subscribe(self.invalidation_channel)
+
+    def _start_invalidator(self) -> None:
+        if self._invalidator is None:
+            self._invalidator = asyncio.get_running_loop().create_task(self._run_invalidator())
+
+    async def _get_fields(self, _key: str) -> dict:
+        self._start_invalidator()
+        generation = self.cache.generation
+        fields = self.cache.get(_key)
+        if fields is None:
+            fields = await self.redis.hgetall(_key)
+            self.cache.put(_key, fields, generation)
+        return fields
+
+    async def _write(self, _key: str, command: Callable[..., Coroutine], index_command: Optional[Callable] = None):
+        """
+        Run command(client) and in the same round trip index_command(client) and,
+        with the cache, publish the invalidation. Returns the result of command.
+        """
+        if self.cache is None and index_command is None:
+            return await command(self.redis)
+        if self.cache is not None:
+            self._start_invalidator()
+        try:
+            try:
+                return await self._write_pipeline(_key, command, index_command)
+            except redis.exceptions.NoScriptError:
+                # the server lost the scripts, e.g. after a restart; the other commands can be repeated
+                await self._load_scripts()
+                return await self._write_pipeline(_key, command, index_command)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(_key)
+
+    async def _write_pipeline(self, _key: str, command: Callable[..., Coroutine], index_command: Optional[Callable]):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            await command(pipe)
+            if index_command is not None:
+                index_command(pipe)
+            if self.cache is not None:
+                pipe.publish(self.invalidation_channel, _key)
+            return (await pipe.execute())[0]
+
+    async def _run_script(self, client, script, _key: str, args: list):
+        """
+        Run script on the client, or queue it if the client is a pipeline.
+        """
+        if client is self.redis:
+            return await script(keys=[_key], args=args, client=client)
+        # queued by its SHA: a script registered on the pipeline would make every execute()
+        # check it with SCRIPT EXISTS first, an extra round trip
+        return await client.evalsha(script.sha, 1, _key, *args)
+
+    async def _load_scripts(self) -> None:
+        scripts = (self._set_state_script, self._set_data_script, self._replace_data_script, self._update_data_script)
+        for script in scripts:
+            script.sha = await self.redis.script_load(script.script)
+
+    def _encode_data(self, data: dict) -> list:
+        """
+        Returns the hash fields and values of data in the configured layout.
+        """
+        if self.data_fields:
+            return encode_data(data)
+        return ["data", json.dumps(data)]
+
+    async def _change_data(self, _key: str, change: Callable[[dict], None]) -> bool:
+        """
+        Apply change to the data dict in the "data" field, in a transaction that is repeated
+        if the hash changes meanwhile. Values in data fields are moved into the dict.
+        Returns False if the key does not exist.
+        """
+        async def change_action(pipe):
+            fields = await pipe.hgetall(_key)
+            if not fields:
+                return False
+            data = decode_data(fields)
+            change(data)
+            pipe.multi()
+            names = data_field_names(fields)
+            if names:
+                pipe.hdel(_key, *names)
+            pipe.hset(_key, "data", json.dumps(data))
+            if self.cache is not None:
+                pipe.publish(self.invalidation_channel, _key)
+            return True
+
+        if self.cache is not None:
+            self._start_invalidator()
+        try:
+            return await self.redis.transaction(change_action, _key, value_from_callable=True)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(_key)
+
+    def _index_keys(self, chat_id: int, bot_id: Optional[int]) -> Tuple[str, str, str, str]:
+        """
+        Returns the index sets of a state: by chat and bot, by bot, by chat for any bot, and of all states.
+        """
+        bot = str(bot_id) if bot_id else ""
+        return (
+            self.separator.join((self.prefix, "chat_index", bot, str(chat_id))),
+            self.separator.join((self.prefix, "bot_index", bot)),
+            self.separator.join((self.prefix, "any_bot_chat_index", str(chat_id))),
+            self.separator.join((self.prefix, "any_bot_index")),
+        )
+
+    def _scope_index_key(self, chat_id: Optional[int], bot_id: Optional[int]) -> str:
+        """
+        Returns the index set of the states of a chat, or of all chats if chat_id is None,
+        of a bot, or of any bot if bot_id is None.
+        """
+        chat_index, bot_index, any_bot_chat_index, any_bot_index = self._index_keys(chat_id, bot_id)
+        if bot_id is None:
+            return any_bot_index if chat_id is None else any_bot_chat_index
+        return bot_index if chat_id is None else chat_index
+
+    def _index_command(
+        self,
+        method: str,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str],
+        message_thread_id: Optional[int],
+        bot_id: Optional[int],
+    ) -> Optional[Callable]:
+        """
+        Returns a command adding the user to the indexes (method "sadd") or removing it ("srem").
+        """
+        if not self.indexes:
+            return None
+        member = json.dumps([chat_id, user_id, business_connection_id, message_thread_id, bot_id or None])
+        index_keys = self._index_keys(chat_id, bot_id)
+
+        def index_command(pipe):
+            for index_key in index_keys:
+                getattr(pipe, method)(index_key, member)
+
+        return index_command
+
+    def _check_indexes(self) -> None:
+        if not self.indexes:
+            raise RuntimeError("StateRedisStorage: bulk operations need a storage created with indexes=True")
+
+    def _member_key(self, member: Union[str, bytes]) -> Tuple[list, str]:
+        chat_id, user_id, business_connection_id, message_thread_id, bot_id = json.loads(member)
+        key = self._get_key(
+            chat_id, user_id, self.prefix, self.separator, business_connection_id, message_thread_id, bot_id
+        )
+        return [chat_id, user_id, business_connection_id, message_thread_id, bot_id], key
+
+    def cache_stats(self) -> Optional[dict]:
+        """
+        Returns the number of cached users, hits and misses of the cache as a dict,
+        or None without a cache.
+        """
+        return None if self.cache is None else self.cache.stats()
+
+    async def close(self) -> None:
+        """
+        Stop the cache subscriber task.
+        """
+        if self._invalidator is not None:
+            self._invalidator.cancel()
+            try:
+                await self._invalidator
+            except asyncio.CancelledError:
+                pass
+            self._invalidator = None
 
-    @async_with_lock
-    @async_with_pipeline
     async def set_state(
         self,
-        pipe,
         chat_id: int,
         user_id: int,
         state: str,
@@ -119,14 +343,15 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        pipe.hget(_key, "data")
-        result = await pipe.execute()
-        data = result[0]
-        if data is None:
-            pipe.hset(_key, "data", json.dumps({}))
-
-        await pipe.hset(_key, "state", state)
-
+        if self.data_fields:
+            command = lambda client: client.hset(_key, "state", state)
+        else:
+            command = lambda client: self._run_script(client, self._set_state_script, _key, [state])
+        await self._write(
+            _key,
+            command,
+            self._index_command("sadd", chat_id, user_id, business_connection_id, message_thread_id, bot_id),
+        )
         return True
 
     async def get_state(
@@ -146,6 +371,8 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
+        if self.cache is not None:
+            return decode_state(await self._get_fields(_key))
         state_bytes = await self.redis.hget(_key, "state")
         return state_bytes.decode("utf-8") if state_bytes else None
 
@@ -166,14 +393,15 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        result = await self.redis.delete(_key)
+        result = await self._write(
+            _key,
+            lambda client: client.delete(_key),
+            self._index_command("srem", chat_id, user_id, business_connection_id, message_thread_id, bot_id),
+        )
         return result > 0
 
-    @async_with_lock
-    @async_with_pipeline
     async def set_data(
         self,
-        pipe,
         chat_id: int,
         user_id: int,
         key: str,
@@ -191,15 +419,15 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = await pipe.hget(_key, "data")
-        data = await pipe.execute()
-        data = data[0]
-        if data is None:
-            raise RuntimeError(f"StateRedisStorage: key {_key} does not exist.")
+        if self.data_fields:
+            args = [DATA_FIELD_PREFIX + str(key), json.dumps(value)]
+            result = await self._write(
+                _key, lambda client: self._run_script(client, self._set_data_script, _key, args)
+            )
         else:
-            data = json.loads(data)
-            data[key] = value
-            await pipe.hset(_key, "data", json.dumps(data))
+            result = await self._change_data(_key, lambda data: data.update({key: value}))
+        if not result:
+            raise RuntimeError(f"StateRedisStorage: key {_key} does not exist.")
         return True
 
     async def get_data(
@@ -219,14 +447,12 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = await self.redis.hget(_key, "data")
-        return json.loads(data) if data else {}
+        if self.cache is not None:
+            return decode_data(await self._get_fields(_key))
+        return decode_data(await self.redis.hgetall(_key))
 
-    @async_with_lock
-    @async_with_pipeline
     async def reset_data(
         self,
-        pipe,
         chat_id: int,
         user_id: int,
         business_connection_id: Optional[str] = None,
@@ -242,11 +468,10 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        if await pipe.exists(_key):
-            await pipe.hset(_key, "data", "{}")
-        else:
-            return False
-        return True
+        args = self._encode_data({})
+        return bool(await self._write(
+            _key, lambda client: self._run_script(client, self._replace_data_script, _key, args)
+        ))
 
     def get_interactive_data(
         self,
@@ -265,11 +490,8 @@ class StateRedisStorage(StateStorageBase):
             bot_id=bot_id,
         )
 
-    @async_with_lock
-    @async_with_pipeline
     async def save(
         self,
-        pipe,
         chat_id: int,
         user_id: int,
         data: dict,
@@ -286,11 +508,132 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        if await pipe.exists(_key):
-            await pipe.hset(_key, "data", json.dumps(data))
-        else:
-            return False
-        return True
+        args = self._encode_data(data)
+        return bool(await self._write(
+            _key, lambda client: self._run_script(client, self._replace_data_script, _key, args)
+        ))
+
+    async def update_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        changed: dict,
+        removed: list,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        _key = self._get_key(
+            chat_id,
+            user_id,
+            self.prefix,
+            self.separator,
+            business_connection_id,
+            message_thread_id,
+            bot_id,
+        )
+        if not self.data_fields:
+            def change(data):
+                data.update(changed)
+                for name in removed:
+                    data.pop(name, None)
+            return await self._change_data(_key, change)
+
+        args = encode_data_changes(changed, removed)
+        result = await self._write(
+            _key, lambda client: self._run_script(client, self._update_data_script, _key, args)
+        )
+        if result == -1:
+            # data saved by an older version, it is converted to fields by save()
+            return await super().update_data(
+                chat_id, user_id, changed, removed, business_connection_id, message_thread_id, bot_id
+            )
+        return bool(result)
+
+    async def get_states(
+        self,
+        chat_user_ids: List[Tuple[int, int]],
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> List[Union[str, None]]:
+        """
+        Get the states of many users in one round trip.
+
+        :param chat_user_ids: (chat_id, user_id) pairs
+        :type chat_user_ids: List[Tuple[int, int]]
+
+        :return: States in the order of chat_user_ids, None for users without a state.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for chat_id, user_id in chat_user_ids:
+                pipe.hget(
+                    self._get_key(
+                        chat_id,
+                        user_id,
+                        self.prefix,
+                        self.separator,
+                        business_connection_id,
+                        message_thread_id,
+                        bot_id,
+                    ),
+                    "state",
+                )
+            states = await pipe.execute()
+        return [state.decode("utf-8") if state else None for state in states]
+
+    async def delete_states_for_chat(self, chat_id: int, bot_id: Optional[int] = None) -> int:
+        self._check_indexes()
+        members = list(await self.redis.smembers(self._scope_index_key(chat_id, bot_id)))
+        if not members:
+            return 0
+        records = [self._member_key(member) for member in members]
+        keys = [key for _, key in records]
+        if self.cache is not None:
+            self._start_invalidator()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.delete(*keys)
+                for member, (user, _) in zip(members, records):
+                    for index_key in self._index_keys(user[0], user[4]):
+                        pipe.srem(index_key, member)
+                if self.cache is not None:
+                    for key in keys:
+                        pipe.publish(self.invalidation_channel, key)
+                return (await pipe.execute())[0]
+        finally:
+            if self.cache is not None:
+                for key in keys:
+                    self.cache.invalidate(key)
+
+    async def count_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> int:
+        self._check_indexes()
+        return await self.redis.scard(self._scope_index_key(chat_id, bot_id))
+
+    async def iter_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> AsyncIterator[tuple]:
+        self._check_indexes()
+        # SSCAN may return a member more than once
+        members = set()
+        async for member in self.redis.sscan_iter(self._scope_index_key(chat_id, bot_id), count=100):
+            members.add(member)
+        members = list(members)
+        for start in range(0, len(members), 100):
+            for record in await self._get_indexed_states(members[start:start + 100]):
+                yield record
+
+    async def _get_indexed_states(self, members: Iterable) -> list:
+        users = []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for member in members:
+                user, key = self._member_key(member)
+                users.append(user)
+                pipe.hget(key, "state")
+            states = await pipe.execute()
+        return [
+            (*user, state.decode("utf-8") if isinstance(state, bytes) else state)
+            for user, state in zip(users, states)
+            if state is not None
+        ]
 
     def migrate_format(self, bot_id: int, prefix: Optional[str] = "telebot_"):
         """
@@ -0,0 +1,179 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union, AsyncIterator
+
+from telebot.asyncio_storage.base_storage import StateStorageBase, StateDataContext
+from telebot.storage.sqlite_storage import StateSQLiteStorage as SyncStateSQLiteStorage
+
+
+class StateSQLiteStorage(StateStorageBase):
+    """
+    State storage based on an SQLite database.
+
+    Uses the same database layout as :class:`telebot.storage.StateSQLiteStorage`.
+    All database calls run in a dedicated thread, so they never block the event loop.
+
+    .. code-block:: python3
+
+        storage = StateSQLiteStorage()
+        bot = AsyncTeleBot(token, state_storage=storage)
+
+    :param file_path: Path to the database file, default is "./.state-save/states.db".
+    :type file_path: str
+
+    :param table: Name of the table for states, default is "telebot_states".
+    :type table: Optional[str]
+    """
+
+    def __init__(
+        self,
+        file_path: str = "./.state-save/states.db",
+        table: Optional[str] = "telebot_states",
+    ) -> None:
+        self.storage = SyncStateSQLiteStorage(file_path=file_path, table=table)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="StateSQLiteStorage")
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def set_state(
+        self,
+        chat_id: int,
+        user_id: int,
+        state: str,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        return await self._run(
+            self.storage.set_state, chat_id, user_id, state, business_connection_id, message_thread_id, bot_id
+        )
+
+    async def get_state(
+        self,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> Union[str, None]:
+        return await self._run(
+            self.storage.get_state, chat_id, user_id, business_connection_id, message_thread_id, bot_id
+        )
+
+    async def delete_state(
+        self,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        return await self._run(
+            self.storage.delete_state, chat_id, user_id, business_connection_id, message_thread_id, bot_id
+        )
+
+    async def set_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        key: str,
+        value: Union[str, int, float, dict],
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        return await self._run(
+            self.storage.set_data, chat_id, user_id, key, value, business_connection_id, message_thread_id, bot_id
+        )
+
+    async def get_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> dict:
+        return await self._run(
+            self.storage.get_data, chat_id, user_id, business_connection_id, message_thread_id, bot_id
+        )
+
+    async def reset_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        return await self._run(
+            self.storage.reset_data, chat_id, user_id, business_connection_id, message_thread_id, bot_id
+        )
+
+    def get_interactive_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> Optional[dict]:
+        return StateDataContext(
+            self,
+            chat_id=chat_id,
+            user_id=user_id,
+            business_connection_id=business_connection_id,
+            message_thread_id=message_thread_id,
+            bot_id=bot_id,
+        )
+
+    async def save(
+        self,
+        chat_id: int,
+        user_id: int,
+        data: dict,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        return await self._run(
+            self.storage.save, chat_id, user_id, data, business_connection_id, message_thread_id, bot_id
+        )
+
+    async def update_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        changed: dict,
+        removed: list,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        return await self._run(
+            self.storage.update_data, chat_id, user_id, changed, removed, business_connection_id, message_thread_id, bot_id
+        )
+
+    async def delete_states_for_chat(self, chat_id: int, bot_id: Optional[int] = None) -> int:
+        return await self._run(self.storage.delete_states_for_chat, chat_id, bot_id)
+
+    async def count_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> int:
+        return await self._run(self.storage.count_states, chat_id, bot_id)
+
+    async def iter_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> AsyncIterator[tuple]:
+        records = await self._run(lambda: list(self.storage.iter_states(chat_id, bot_id)))
+        for record in records:
+            yield record
+
+    async def close(self) -> None:
+        """
+        Close the database connection and stop the database thread.
+        """
+        await self._run(self.storage.close)
+        self.executor.shutdown(wait=True)
+
+    def __str__(self) -> str:
+        return f"StateSQLiteStorage({self.storage.file_path}, {self.storage.table})"
@@ -4,7 +4,6 @@ from telebot.handler_backends import State
 
 from telebot import types
 
-from telebot.states import resolve_context
 
 class SimpleCustomFilter(ABC):
     """
@@ -404,11 +403,6 @@ class StateFilter(AdvancedCustomFilter):
         :meta private:
         """
         
-        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_context(message, self.bot.bot_id)
-
-        if chat_id is None:
-            chat_id = user_id # May change in future
-
         if isinstance(text, list):
             new_text = []
             for i in text:
@@ -418,13 +412,7 @@ class StateFilter(AdvancedCustomFilter):
         elif isinstance(text, State):
             text = text.name
         
-        user_state = self.bot.current_states.get_state(
-            chat_id=chat_id,
-            user_id=user_id,
-            business_connection_id=business_connection_id,
-            bot_id=bot_id,
-            message_thread_id=message_thread_id
-        )
+        user_state = self.bot._get_update_state(message)
 
         # CHANGED BEHAVIOUR
         if text == "*" and user_state is not None:
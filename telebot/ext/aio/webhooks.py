@@ -98,6 +98,9 @@ class AsyncWebhookListener:
             return JSONResponse(status_code=403, content={"error": "Forbidden"})
         if request.headers.get('content-type') == 'application/json':
             json_string = update
+            if await self._bot.is_known_update(json_string.get('update_id')):
+                # redelivered update, drop it before decoding
+                return JSONResponse('', status_code=200)
             asyncio.create_task(self._bot.process_new_updates([Update.de_json(json_string)]))
             return JSONResponse('', status_code=200)
 
@@ -94,6 +94,9 @@ class SyncWebhookListener:
             # secret token didn't match
             return JSONResponse(status_code=403, content={"error": "Forbidden"})
         if request.headers.get('content-type') == 'application/json':
+            if self._bot.is_known_update(update.get('update_id')):
+                # redelivered update, drop it before decoding
+                return JSONResponse('', status_code=200)
             self._bot.process_new_updates([Update.de_json(update)])
             return JSONResponse('', status_code=200)
 
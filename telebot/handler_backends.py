@@ -1,6 +1,11 @@
+import io
 import os
 import pickle
+import sqlite3
+import sys
 import threading
+import time
+from collections import OrderedDict, deque
 
 from telebot import apihelper
 try:
@@ -33,25 +38,173 @@ class HandlerBackend(object):
         raise NotImplementedError()
 
 
+def estimate_handler_size(handler):
+    """
+    Estimates the memory used by a (next step|reply) handler in bytes: the handler object,
+    its arguments and their direct contents.
+
+    :meta private:
+    """
+    args = getattr(handler, 'args', ())
+    kwargs = getattr(handler, 'kwargs', {})
+    size = sys.getsizeof(handler) + sys.getsizeof(getattr(handler, '__dict__', None))
+    size += sys.getsizeof(args) + sum(sys.getsizeof(arg) for arg in args)
+    size += sys.getsizeof(kwargs) + sum(sys.getsizeof(value) for value in kwargs.values())
+    return size
+
+
 class MemoryHandlerBackend(HandlerBackend):
     """
+    Keeps handlers in a dict.
+
+    The dict can be bounded for handlers that may never be used, e.g. reply handlers of prompts
+    nobody answers. Set ttl to drop the handlers of a group that got no new handler for ttl
+    seconds, max_entries to drop the least recently registered groups when there are more, and
+    max_memory to do the same when the estimated size of the handlers exceeds max_memory bytes.
+    Expired groups are dropped when they are looked up and by a background thread every
+    eviction_interval seconds. See :meth:`stats` for eviction metrics.
+
     :meta private:
     """
+    def __init__(self, handlers=None, ttl=None, max_entries=None, max_memory=None, eviction_interval=60):
+        super(MemoryHandlerBackend, self).__init__(handlers)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.eviction_interval = eviction_interval
+        self.expired_count = 0
+        self.overflow_count = 0
+        self.memory_usage = 0
+        self.lock = threading.Lock()
+        # group ids in the order of their last registration, with its time
+        self.registered = OrderedDict()
+        # estimated sizes of the groups, only if max_memory is set
+        self.sizes = {}
+        if self.bounded:
+            now = time.monotonic()
+            for handler_group_id, handlers in self.handlers.items():
+                self.registered[handler_group_id] = now
+                self._add_size(handler_group_id, handlers)
+            self._evict_overflow()
+        self._stop_event = threading.Event()
+        self._evictor = None
+
+    @property
+    def bounded(self):
+        return self.ttl is not None or self.max_entries is not None or self.max_memory is not None
+
+    @property
+    def evicted_count(self):
+        return self.expired_count + self.overflow_count
+
     def register_handler(self, handler_group_id, handler):
-        if handler_group_id in self.handlers:
-            self.handlers[handler_group_id].append(handler)
-        else:
-            self.handlers[handler_group_id] = [handler]
+        with self.lock:
+            if handler_group_id in self.handlers:
+                self.handlers[handler_group_id].append(handler)
+            else:
+                self.handlers[handler_group_id] = [handler]
+            if self.bounded:
+                self.registered[handler_group_id] = time.monotonic()
+                self.registered.move_to_end(handler_group_id)
+                self._add_size(handler_group_id, [handler])
+                self._evict_overflow()
+        if self.ttl is not None and self._evictor is None:
+            self._start_evictor()
 
     def clear_handlers(self, handler_group_id):
-        self.handlers.pop(handler_group_id, None)
+        with self.lock:
+            self._remove(handler_group_id)
 
     def get_handlers(self, handler_group_id):
-        return self.handlers.pop(handler_group_id, None)
+        with self.lock:
+            registered = self.registered.get(handler_group_id)
+            handlers = self._remove(handler_group_id)
+            if handlers and registered is not None and self._is_expired(registered, time.monotonic()):
+                self.expired_count += 1
+                return None
+            return handlers
 
     def load_handlers(self, filename, del_file_after_loading):
         raise NotImplementedError()
 
+    def evict_expired(self):
+        """
+        Drops the groups whose handlers expired.
+
+        :return: Number of dropped groups
+        """
+        if self.ttl is None:
+            return 0
+        evicted = 0
+        with self.lock:
+            now = time.monotonic()
+            while self.registered:
+                registered = next(iter(self.registered.values()))
+                if not self._is_expired(registered, now):
+                    break
+                self._remove(next(iter(self.registered)))
+                evicted += 1
+            self.expired_count += evicted
+        return evicted
+
+    def stats(self):
+        """
+        Returns the number of groups, the estimated memory usage and eviction counters as a dict.
+        """
+        with self.lock:
+            return {
+                'entries': len(self.handlers),
+                'memory_usage': self.memory_usage,
+                'expired_count': self.expired_count,
+                'overflow_count': self.overflow_count,
+                'evicted_count': self.evicted_count,
+            }
+
+    def close(self):
+        """
+        Stops the background eviction thread.
+        """
+        self._stop_event.set()
+        if self._evictor is not None:
+            self._evictor.join()
+            self._evictor = None
+        self._stop_event.clear()
+
+    def _is_expired(self, registered, now):
+        return self.ttl is not None and now - registered > self.ttl
+
+    def _add_size(self, handler_group_id, handlers):
+        if self.max_memory is not None:
+            size = sum(estimate_handler_size(handler) for handler in handlers)
+            self.sizes[handler_group_id] = self.sizes.get(handler_group_id, 0) + size
+            self.memory_usage += size
+
+    def _remove(self, handler_group_id):
+        self.registered.pop(handler_group_id, None)
+        self.memory_usage -= self.sizes.pop(handler_group_id, 0)
+        return self.handlers.pop(handler_group_id, None)
+
+    def _is_overflowing(self):
+        if self.max_entries is not None and len(self.registered) > self.max_entries:
+            return True
+        return self.max_memory is not None and self.memory_usage > self.max_memory
+
+    def _evict_overflow(self):
+        while self.registered and self._is_overflowing():
+            self._remove(next(iter(self.registered)))
+            self.overflow_count += 1
+
+    def _start_evictor(self):
+        with self.lock:
+            if self._evictor is not None:
+                return
+            self._evictor = threading.Thread(target=self._run_evictor, name='HandlerEvictor', daemon=True)
+        self._evictor.start()
+
+    def _run_evictor(self):
+        while not self._stop_event.wait(self.eviction_interval):
+            self.evict_expired()
+
 
 class FileHandlerBackend(HandlerBackend):
     """
@@ -129,40 +282,242 @@ class FileHandlerBackend(HandlerBackend):
         return None
 
 
+class SQLiteHandlerBackend(HandlerBackend):
+    """
+    Keeps handlers in memory and persists every change as a single row operation in an
+    SQLite database in WAL mode, instead of rewriting a pickle file of all handlers.
+    Handlers are loaded from the database on creation, so restarts only read live handlers.
+    The handlers passed on creation are only imported if the database has no handlers.
+
+    :meta private:
+    """
+    def __init__(self, handlers=None, filename='./.handler-saves/handlers.db'):
+        super(SQLiteHandlerBackend, self).__init__()
+        self.filename = filename
+        self.lock = threading.Lock()
+        dirs = os.path.dirname(filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS handlers (id INTEGER PRIMARY KEY AUTOINCREMENT, handler_group_id, handler BLOB)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS handlers_group ON handlers (handler_group_id)')
+        self.load_handlers(filename)
+        # the seed handlers are only imported into an empty database, not again on every restart
+        if handlers and not self.handlers:
+            self._import_handlers(handlers)
+
+    def register_handler(self, handler_group_id, handler):
+        with self.lock:
+            self.connection.execute('INSERT INTO handlers (handler_group_id, handler) VALUES (?, ?)',
+                                    (handler_group_id, self._dumps(handler)))
+            self.handlers.setdefault(handler_group_id, []).append(handler)
+
+    def clear_handlers(self, handler_group_id):
+        with self.lock:
+            if self.handlers.pop(handler_group_id, None) is not None:
+                self.connection.execute('DELETE FROM handlers WHERE handler_group_id = ?', (handler_group_id,))
+
+    def get_handlers(self, handler_group_id):
+        # called for every message, so the database is only touched if there are handlers
+        with self.lock:
+            handlers = self.handlers.pop(handler_group_id, None)
+            if handlers is not None:
+                self.connection.execute('DELETE FROM handlers WHERE handler_group_id = ?', (handler_group_id,))
+            return handlers
+
+    def load_handlers(self, filename=None, del_file_after_loading=True):
+        """
+        Reloads the handlers from the database. If filename is a save file of
+        :class:`FileHandlerBackend`, its handlers are imported into the database instead.
+        """
+        if filename and filename != self.filename:
+            handlers = FileHandlerBackend.return_load_handlers(filename, del_file_after_loading=del_file_after_loading)
+            if handlers:
+                self._import_handlers(handlers)
+            return
+        handlers = {}
+        with self.lock:
+            for handler_group_id, value in self.connection.execute(
+                    'SELECT handler_group_id, handler FROM handlers ORDER BY id'):
+                handlers.setdefault(handler_group_id, []).append(self._loads(value))
+            self.handlers = handlers
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _import_handlers(self, handlers):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                for handler_group_id, group in handlers.items():
+                    self.connection.executemany(
+                        'INSERT INTO handlers (handler_group_id, handler) VALUES (?, ?)',
+                        [(handler_group_id, self._dumps(handler)) for handler in group])
+                    self.handlers.setdefault(handler_group_id, []).extend(group)
+
+    @staticmethod
+    def _dumps(handler):
+        if apihelper.CUSTOM_SERIALIZER is None:
+            return pickle.dumps(handler)
+        file = io.BytesIO()
+        apihelper.CUSTOM_SERIALIZER.dump(handler, file)
+        return file.getvalue()
+
+    @staticmethod
+    def _loads(value):
+        if apihelper.CUSTOM_SERIALIZER is None:
+            return pickle.loads(value)
+        return apihelper.CUSTOM_SERIALIZER.load(io.BytesIO(value))
+
+
 class RedisHandlerBackend(HandlerBackend):
     """
+    Keeps the handlers of a group in a Redis list, one pickled handler per element.
+    Every operation is a single atomic script call, so concurrent workers or bot instances
+    do not lose handlers. Keys expire after ttl seconds if set. Keys written by older versions
+    (a pickled list of handlers) are still read and are converted when a handler is added.
+    Pass redis to reuse an existing connection.
+
     :meta private:
     """
-    def __init__(self, handlers=None, host='localhost', port=6379, db=0, prefix='telebot', password=None):
+    # a string key is a pickled list of handlers written by older versions
+    REGISTER_SCRIPT = """
+        if redis.call('TYPE', KEYS[1]).ok == 'string' then
+            local legacy = redis.call('GET', KEYS[1])
+            redis.call('DEL', KEYS[1])
+            redis.call('RPUSH', KEYS[1], legacy)
+        end
+        redis.call('RPUSH', KEYS[1], ARGV[1])
+        if tonumber(ARGV[2]) > 0 then
+            redis.call('EXPIRE', KEYS[1], ARGV[2])
+        end
+    """
+    POP_SCRIPT = """
+        local key_type = redis.call('TYPE', KEYS[1]).ok
+        local values = {}
+        if key_type == 'list' then
+            values = redis.call('LRANGE', KEYS[1], 0, -1)
+        elseif key_type == 'string' then
+            values = {redis.call('GET', KEYS[1])}
+        end
+        if key_type ~= 'none' then
+            redis.call('DEL', KEYS[1])
+        end
+        return values
+    """
+
+    def __init__(self, handlers=None, host='localhost', port=6379, db=0, prefix='telebot', password=None,
+                 ttl=None, redis=None):
         super(RedisHandlerBackend, self).__init__(handlers)
-        if not redis_installed:
-            raise Exception("Redis is not installed. Install it via 'pip install redis'")
+        if redis is None:
+            if not redis_installed:
+                raise Exception("Redis is not installed. Install it via 'pip install redis'")
+            redis = Redis(host, port, db, password)
         self.prefix = prefix
-        self.redis = Redis(host, port, db, password)
+        self.ttl = ttl
+        self.redis = redis
+        self._register = self.redis.register_script(self.REGISTER_SCRIPT)
+        self._pop = self.redis.register_script(self.POP_SCRIPT)
 
     def _key(self, handle_group_id):
         return ':'.join((self.prefix, str(handle_group_id)))
 
     def register_handler(self, handler_group_id, handler):
-        handlers = []
-        value = self.redis.get(self._key(handler_group_id))
-        if value:
-            handlers = pickle.loads(value)
-        handlers.append(handler)
-        self.redis.set(self._key(handler_group_id), pickle.dumps(handlers))
+        self._register(keys=[self._key(handler_group_id)], args=[pickle.dumps(handler), self.ttl or 0])
 
     def clear_handlers(self, handler_group_id):
         self.redis.delete(self._key(handler_group_id))
 
     def get_handlers(self, handler_group_id):
-        handlers = None
-        value = self.redis.get(self._key(handler_group_id))
-        if value:
-            handlers = pickle.loads(value)
-            self.clear_handlers(handler_group_id)
+        values = self._pop(keys=[self._key(handler_group_id)])
+        if not values:
+            return None
+        handlers = []
+        for value in values:
+            handler = pickle.loads(value)
+            if isinstance(handler, list):
+                handlers.extend(handler)
+            else:
+                handlers.append(handler)
         return handlers
 
 
+class UpdateDeduplicator(object):
+    """
+    Class for dropping updates that were already received, e.g. redelivered by Telegram
+    after a slow webhook response or fetched again after a restart.
+
+    :meta private:
+    """
+    def is_duplicate(self, update_id):
+        """
+        Checks whether update_id was seen before and remembers it.
+        """
+        raise NotImplementedError()
+
+    def seen(self, update_id):
+        """
+        Checks whether update_id was seen before without remembering it.
+        """
+        raise NotImplementedError()
+
+
+class MemoryUpdateDeduplicator(UpdateDeduplicator):
+    """
+    Remembers the last max_size update ids in a ring buffer.
+
+    :meta private:
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.ids = set()
+        self.order = deque()
+        self.lock = threading.Lock()
+
+    def is_duplicate(self, update_id):
+        with self.lock:
+            if update_id in self.ids:
+                return True
+            self.ids.add(update_id)
+            self.order.append(update_id)
+            if len(self.order) > self.max_size:
+                self.ids.discard(self.order.popleft())
+            return False
+
+    def seen(self, update_id):
+        return update_id in self.ids
+
+
+class RedisUpdateDeduplicator(UpdateDeduplicator):
+    """
+    Remembers update ids in Redis for ttl seconds, so that several bot instances
+    can share them. Pass redis to reuse an existing connection.
+
+    :meta private:
+    """
+    def __init__(self, host='localhost', port=6379, db=0, prefix='telebot', password=None, ttl=86400, redis=None):
+        if redis is None:
+            if not redis_installed:
+                raise Exception("Redis is not installed. Install it via 'pip install redis'")
+            redis = Redis(host, port, db, password)
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, update_id):
+        return ':'.join((self.prefix, 'update', str(update_id)))
+
+    def is_duplicate(self, update_id):
+        return not self.redis.set(self._key(update_id), 1, nx=True, ex=self.ttl)
+
+    def seen(self, update_id):
+        return bool(self.redis.exists(self._key(update_id)))
+
+
 class BaseMiddleware:
     """
     Base class for middleware.
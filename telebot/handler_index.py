@@ -0,0 +1,422 @@
+"""
+Registration-time indexes for handler lists.
+
+Both :class:`telebot.TeleBot` and :class:`telebot.async_telebot.AsyncTeleBot` keep
+their handlers in lists of handler dicts (see ``_build_handler_dict``), which are
+:class:`HandlerList` instances counting their changes.
+Testing every handler of such a list against every update is linear in the number
+of handlers, so the bots build a :class:`HandlerIndex` for each list and only test
+the handlers that can possibly match an update.
+
+:meta private:
+"""
+import heapq
+import inspect
+from operator import attrgetter
+from typing import Any, Dict, Iterable, List, Optional
+
+from telebot import util
+from telebot.states import State
+from telebot.text_matching import COMPILED_FILTER, TextMatcher
+
+
+class HandlerList(list):
+    """
+    List of handler dicts that counts its changes in :attr:`version`, so that an index built
+    for it can tell cheaply whether handlers were added, removed or replaced since.
+
+    :meta private:
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.version = 0
+
+
+def _counting(name: str):
+    method = getattr(list, name)
+
+    def changed(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+    changed.__name__ = name
+    return changed
+
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort', 'reverse',
+              '__setitem__', '__delitem__', '__iadd__', '__imul__'):
+    setattr(HandlerList, _name, _counting(_name))
+del _name
+
+
+class HandlerEntry:
+    """
+    Indexed representation of a handler dict.
+
+    :meta private:
+
+    :param position: Position of the handler in the handler list
+    :param handler: Handler dict
+    :param filters: Filters that still have to be tested for this handler, in registration order
+    """
+    __slots__ = ('position', 'handler', 'filters', 'function', '_params', '_accepted')
+
+    def __init__(self, position: int, handler: dict, filters: list):
+        self.position = position
+        self.handler = handler
+        self.filters = filters
+        #: Callable that runs the handler function; the bot may replace it (e.g. to run it in a process pool)
+        self.function = handler['function']
+        self._params = None
+        self._accepted = None
+
+    @property
+    def params(self) -> tuple:
+        """
+        Parameter names of the handler function, inspected once.
+        """
+        if self._params is None:
+            self._params = tuple(inspect.signature(self.handler['function']).parameters)
+        return self._params
+
+    @property
+    def accepted(self) -> frozenset:
+        """
+        Names of the parameters that can receive middleware data (all but the first one).
+        """
+        if self._accepted is None:
+            self._accepted = frozenset(self.params[1:])
+        return self._accepted
+
+
+_position = attrgetter('position')
+
+
+class DispatchContext:
+    """
+    Values of an update that are computed once and shared by all handlers tested against it.
+
+    :meta private:
+
+    :param message: Update part (message, callback query, ...)
+    """
+    __slots__ = ('message', 'command', 'text_matches', 'state')
+
+    def __init__(self, message):
+        self.message = message
+        self.command = HandlerIndex.extract_command(message)
+        self.text_matches = {}
+        #: State of the user, set by the bot if the index has state buckets (see :attr:`HandlerIndex.needs_state`)
+        self.state = None
+
+
+def _hashable_values(values) -> Optional[frozenset]:
+    """
+    Returns values as a frozenset if they can be used as index keys, else None.
+    """
+    if not isinstance(values, (list, tuple, set, frozenset)):
+        return None
+    try:
+        return frozenset(values)
+    except TypeError:
+        return None
+
+
+def _state_names(value) -> Optional[frozenset]:
+    """
+    Returns the state names accepted by a ``state`` filter value with the semantics of
+    :class:`telebot.custom_filters.StateFilter`, :data:`ANY_STATE` for ``"*"``, or None
+    if the value cannot be indexed.
+    """
+    if value == '*':
+        return frozenset((ANY_STATE,))
+    values = value if type(value) is list else (value,)
+    names = []
+    for state in values:
+        if isinstance(state, State):
+            state = state.name
+        if not isinstance(state, str):
+            return None
+        names.append(state)
+    return frozenset(names)
+
+
+def build_middleware_chain(middlewares: list, update_type: str) -> list:
+    """
+    Selects the middlewares for `update_type` and resolves their hooks once.
+
+    Returns a list of ``(middleware, pre_process, post_process)`` tuples. For update
+    sensitive middlewares the hooks are ``pre_process_<update_type>`` and
+    ``post_process_<update_type>``; a missing hook is None.
+
+    :meta private:
+    """
+    chain = []
+    for middleware in middlewares:
+        if update_type not in middleware.update_types:
+            continue
+        if middleware.update_sensitive:
+            pre_process = getattr(middleware, f'pre_process_{update_type}', None)
+            post_process = getattr(middleware, f'post_process_{update_type}', None)
+        else:
+            pre_process = middleware.pre_process
+            post_process = middleware.post_process
+        chain.append((middleware, pre_process, post_process))
+    return chain
+
+
+def iter_update_parts(update) -> Iterable[tuple]:
+    """
+    Yields ``(update_type, part)`` for the fields of `update` that are set.
+
+    Updates decoded by :meth:`telebot.types.Update.de_json` remember which fields were present,
+    for others all update types are tested.
+
+    :meta private:
+    """
+    update_types = getattr(update, '_update_types', None)
+    if update_types is None:
+        update_types = util.update_types
+    for update_type in update_types:
+        part = getattr(update, update_type, None)
+        if part:
+            yield update_type, part
+
+
+#: Key of the state bucket of handlers with ``state="*"``, which accept any state
+ANY_STATE = object()
+
+
+class _Buckets:
+    """
+    Handler entries bucketed by command and content type.
+
+    :meta private:
+    """
+    __slots__ = ('by_command', 'by_content_type', 'unindexed')
+
+    def __init__(self):
+        self.by_command: Dict[str, List[HandlerEntry]] = {}
+        self.by_content_type: Dict[Any, List[HandlerEntry]] = {}
+        self.unindexed: List[HandlerEntry] = []
+
+    def add(self, entry: HandlerEntry, keys: Optional[frozenset], by_command: bool):
+        if keys is None:
+            self.unindexed.append(entry)
+            return
+        buckets = self.by_command if by_command else self.by_content_type
+        for key in keys:
+            buckets.setdefault(key, []).append(entry)
+
+    def collect(self, context: DispatchContext, buckets: list):
+        """
+        Appends the buckets that may match the update to `buckets`.
+        """
+        if context.command is not None and self.by_command:
+            bucket = self.by_command.get(context.command)
+            if bucket:
+                buckets.append(bucket)
+        if self.by_content_type:
+            bucket = self.by_content_type.get(getattr(context.message, 'content_type', None))
+            if bucket:
+                buckets.append(bucket)
+        if self.unindexed:
+            buckets.append(self.unindexed)
+
+
+class HandlerIndex:
+    """
+    Index of a handler list.
+
+    Handlers with a ``commands`` filter are bucketed by command name, handlers with a
+    ``content_types`` filter are bucketed by content type, everything else (``func``-only
+    handlers, custom filters, update types without content types) goes to a residual list.
+    Each handler lands in exactly one kind of bucket, so merging the buckets that apply to
+    an update by position yields the candidates in registration order.
+
+    Filters that are guaranteed by the bucket a handler was found in are not tested again;
+    list-valued ``content_types`` and ``chat_types`` filters are converted to frozensets.
+    ``regexp`` filters and the built-in text custom filters listed in `text_filters` are
+    compiled into one :class:`telebot.text_matching.TextMatcher` and marked with
+    :data:`telebot.text_matching.COMPILED_FILTER`; a predicate returning
+    :data:`telebot.text_matching.UNCOMPILED` is tested as the filter in its ``uncompiled`` attribute.
+
+    If ``state`` is the built-in state filter, handlers with a ``state`` filter are first
+    partitioned by the state names they accept (``"*"`` goes to :data:`ANY_STATE`), and only
+    the partitions of the user's state are searched, so the number of states does not add to
+    the cost of dispatching an update. The bot sets :attr:`DispatchContext.state` if
+    :attr:`needs_state` is set.
+
+    The index is a snapshot: :meth:`is_stale` tells whether the handler list has been
+    changed since the index was built, by comparing the :attr:`HandlerList.version`; other
+    lists are compared handler by handler. Changes inside a handler dict are not noticed,
+    the bots rebuild their indexes on ``reset_handler_indexes()``.
+
+    :meta private:
+
+    :param handlers: List of handler dicts
+    :param text_filters: Keys of custom filters that are the built-in ``text``, ``text_contains``
+        and ``text_startswith`` filters
+    :param state_filter: Whether the ``state`` custom filter is the built-in state filter
+    :param asynchronous: Whether the text filters are the ones of :mod:`telebot.asyncio_filters`
+    """
+
+    def __init__(self, handlers: List[dict], text_filters: Iterable[str] = (), state_filter: bool = False,
+                 asynchronous: bool = False):
+        self.handlers = handlers
+        self.version = getattr(handlers, 'version', None)
+        self.text_filters = frozenset(text_filters)
+        self.state_filter = state_filter
+        self.text_matcher = TextMatcher(asynchronous)
+
+        #: Handlers without an indexed state filter
+        self.stateless = _Buckets()
+        self.by_command = self.stateless.by_command
+        self.by_content_type = self.stateless.by_content_type
+        self.unindexed = self.stateless.unindexed
+        #: Handlers with an indexed state filter by accepted state name or :data:`ANY_STATE`
+        self.by_state: Dict[Any, _Buckets] = {}
+        self.entries: List[HandlerEntry] = []
+
+        for position, handler in enumerate(handlers):
+            self._add(position, handler)
+        self.text_matcher.build()
+
+    def _add(self, position: int, handler: dict):
+        filters = handler['filters']
+        commands = _hashable_values(filters.get('commands'))
+        content_types = _hashable_values(filters.get('content_types'))
+        state = filters.get('state')
+        states = _state_names(state) if self.state_filter and state is not None else None
+
+        guaranteed = set()
+        if commands is not None and all(isinstance(command, str) for command in commands):
+            guaranteed.add('commands')
+            keys, by_command = commands, True
+        elif content_types is not None:
+            guaranteed.add('content_types')
+            keys, by_command = content_types, False
+        else:
+            keys, by_command = None, False
+        if states is not None:
+            guaranteed.add('state')
+
+        entry = HandlerEntry(position, handler, self._compile_filters(filters, guaranteed))
+        self.entries.append(entry)
+        if states is None:
+            self.stateless.add(entry, keys, by_command)
+            return
+        for state_name in states:
+            buckets = self.by_state.get(state_name)
+            if buckets is None:
+                buckets = self.by_state[state_name] = _Buckets()
+            buckets.add(entry, keys, by_command)
+
+    def _compile_filters(self, filters: dict, guaranteed: set) -> list:
+        compiled = []
+        for message_filter, filter_value in filters.items():
+            if filter_value is None or message_filter in guaranteed:
+                continue
+            if message_filter in ('content_types', 'chat_types'):
+                filter_value = _hashable_values(filter_value) or filter_value
+            elif message_filter == 'regexp' or message_filter in self.text_filters:
+                predicate = getattr(self.text_matcher, 'compile_' + message_filter)(filter_value)
+                if predicate is not None:
+                    predicate.uncompiled = (message_filter, filter_value)
+                    message_filter, filter_value = COMPILED_FILTER, predicate
+            compiled.append((message_filter, filter_value))
+        return compiled
+
+    def is_stale(self, handlers: List[dict]) -> bool:
+        """
+        Checks whether the index no longer describes `handlers`.
+
+        :param handlers: Handler list
+        """
+        if handlers is not self.handlers:
+            return True
+        if self.version is not None:
+            return handlers.version != self.version
+        return len(handlers) != len(self.entries) or any(
+            handler is not entry.handler for handler, entry in zip(handlers, self.entries))
+
+    @property
+    def needs_state(self) -> bool:
+        """
+        Whether :meth:`candidates` needs the user's state in :attr:`DispatchContext.state`.
+        """
+        return bool(self.by_state)
+
+    def candidates(self, context: DispatchContext) -> Iterable[HandlerEntry]:
+        """
+        Returns the handlers that may match the update, in registration order.
+
+        :param context: Dispatch context of the update
+        """
+        buckets = []
+        self.stateless.collect(context, buckets)
+        if self.by_state and context.state is not None:
+            for state_name in (context.state, ANY_STATE):
+                state_buckets = self.by_state.get(state_name)
+                if state_buckets is not None:
+                    state_buckets.collect(context, buckets)
+
+        if not buckets:
+            return ()
+        if len(buckets) == 1:
+            return buckets[0]
+        return heapq.merge(*buckets, key=_position)
+
+    def iter_candidates(self, context: DispatchContext) -> 'CandidateIterator':
+        """
+        Returns the handlers that may match the update, in registration order, as an iterator
+        that can follow a change of the user's state (see :meth:`CandidateIterator.update_state`).
+
+        :param context: Dispatch context of the update
+        """
+        return CandidateIterator(self, context)
+
+    @staticmethod
+    def extract_command(message) -> Optional[str]:
+        """
+        Extracts the command of `message` once, so that it is not parsed for every handler.
+        """
+        if getattr(message, 'content_type', None) != 'text':
+            return None
+        return util.extract_command(message.text)
+
+
+class CandidateIterator:
+    """
+    Iterator over the candidates of an update, see :meth:`HandlerIndex.iter_candidates`.
+
+    :meta private:
+    """
+    __slots__ = ('index', 'context', 'position', '_candidates')
+
+    def __init__(self, index: HandlerIndex, context: DispatchContext):
+        self.index = index
+        self.context = context
+        #: Position of the last returned handler
+        self.position = -1
+        self._candidates = iter(index.candidates(context))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> HandlerEntry:
+        entry = next(self._candidates)
+        self.position = entry.position
+        return entry
+
+    def update_state(self, state) -> None:
+        """
+        Passes the user's state read after a handler returned ContinueHandling. If the handler
+        changed the state, the remaining handlers are looked up in the buckets of the new state,
+        as a state filter tested handler by handler would see it.
+        """
+        if state == self.context.state:
+            return
+        self.context.state = state
+        position = self.position
+        self._candidates = (entry for entry in self.index.candidates(self.context) if entry.position > position)
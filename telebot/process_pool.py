@@ -0,0 +1,208 @@
+"""
+Process pool execution of CPU-bound handlers.
+
+Handler functions marked with :func:`run_in_process` are executed in a
+:class:`concurrent.futures.ProcessPoolExecutor` instead of the worker thread that
+dispatched the update, so that CPU-bound handlers of one bot can use all cores.
+
+.. code-block:: python3
+
+    from telebot.process_pool import run_in_process
+
+    @bot.message_handler(content_types=['photo'])
+    @run_in_process
+    def handle_photo(message, bot):
+        ...
+
+Handlers must be defined at module level, so that the child processes can import them.
+The child processes are started with the "forkserver" method where available, else "spawn",
+instead of forking the multi-threaded bot process; they import the bot's main module, so
+polling must be started under ``if __name__ == '__main__':``.
+
+The worker thread that dispatched the update waits for the handler's result, so that
+:class:`telebot.handler_backends.ContinueHandling`, middleware post-processing and the order
+of updates are kept. When the pool is created, the worker pool of a threaded bot gets one more
+thread per process, so that all processes can be busy while updates for regular handlers are
+still dispatched. :class:`telebot.util.ShardedThreadPool` keeps its number of shards, there
+process handlers run in parallel only for chats of different shards.
+The update is sent to the child process in a compact form (the raw json received from
+Telegram where available); the handler's return value (e.g. :class:`telebot.handler_backends.ContinueHandling`)
+and changes of the middleware ``data`` dict are sent back. A ``bot`` argument is replaced by a
+bot instance of the child process, which uses the same token and defaults, so API calls made by
+the handler go directly to Telegram. Next step and reply handlers marked with :func:`run_in_process`
+are executed in the pool too.
+
+The bot of a child process uses the parent's state storage only if the storage can be shared
+between processes, like :class:`telebot.storage.StateSQLiteStorage`. Other storages keep the
+states in the parent process or hold connections that can't be sent to a child, so there the
+state methods of the child's bot (``bot.set_state``, ``bot.retrieve_data``, ...) raise
+RuntimeError instead of changing a copy that is lost.
+
+:meta private:
+"""
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+from telebot import types
+from telebot.storage import StateMemoryStorage, StateStorageBase
+
+
+class _BotPlaceholder:
+    """
+    Replaces the bot instance in arguments sent to a child process.
+    """
+
+
+_BOT = _BotPlaceholder()
+
+#: Settings copied from the parent bot to the bot of a child process.
+_BOT_SETTINGS = ('parse_mode', 'disable_web_page_preview', 'disable_notification', 'protect_content',
+                 'allow_sending_without_reply')
+
+_child_bot = None
+
+
+def _state_storage_unavailable(self, *args, **kwargs):
+    raise RuntimeError("The bot's state storage can't be shared with process handlers, "
+                       "use a storage like StateSQLiteStorage or handle states outside of run_in_process handlers")
+
+
+class _UnavailableStateStorage(StateStorageBase):
+    """
+    State storage of the bots of child processes if the parent's storage can't be shared.
+    """
+    set_data = get_data = set_state = delete_state = reset_data = get_state = _state_storage_unavailable
+    get_interactive_data = save = update_data = _state_storage_unavailable
+
+
+def shareable_state_storage(state_storage: StateStorageBase) -> Optional[StateStorageBase]:
+    """
+    Returns `state_storage` if child processes can use it too, else None.
+    """
+    if isinstance(state_storage, StateMemoryStorage):
+        # a copy in the child process would not be shared
+        return None
+    try:
+        pickle.dumps(state_storage)
+    except Exception:
+        return None
+    return state_storage
+
+
+def run_in_process(function: Callable) -> Callable:
+    """
+    Marks a handler function to be executed in the bot's process pool.
+
+    :param function: Handler function, defined at module level
+    :return: The same function
+    """
+    function.run_in_process = True
+    return function
+
+
+def is_process_handler(function: Callable) -> bool:
+    """
+    Checks whether `function` was marked with :func:`run_in_process`.
+    """
+    return getattr(function, 'run_in_process', False) is True
+
+
+def dump_update(obj):
+    """
+    Returns a compact picklable form of an update part: the class name and the raw json
+    for objects that keep it (messages and callback queries), else the object itself.
+    """
+    raw = getattr(obj, 'json', None)
+    if isinstance(raw, (dict, str)) and raw and type(obj).__module__ == types.__name__:
+        return type(obj).__name__, raw
+    return None, obj
+
+
+def load_update(dumped):
+    """
+    Restores an update part dumped by :func:`dump_update`.
+    """
+    type_name, value = dumped
+    if type_name is None:
+        return value
+    return getattr(types, type_name).de_json(value)
+
+
+def default_start_method() -> str:
+    """
+    Returns the start method for child processes: "forkserver" where available, else "spawn".
+    Forking the bot process would copy the state of its threads and locks.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return 'forkserver'
+    return 'spawn'
+
+
+def _init_child(token: str, settings: dict, state_storage: Optional[StateStorageBase]):
+    global _child_bot
+    from telebot import TeleBot
+    if state_storage is None:
+        state_storage = _UnavailableStateStorage()
+    _child_bot = TeleBot(token, threaded=False, validate_token=False, state_storage=state_storage, **settings)
+
+
+def _run_child(function: Callable, dumped, args: tuple, kwargs: dict):
+    message = load_update(dumped)
+    args = tuple(_child_bot if isinstance(arg, _BotPlaceholder) else arg for arg in args)
+    kwargs = {key: _child_bot if isinstance(value, _BotPlaceholder) else value for key, value in kwargs.items()}
+    result = function(message, *args, **kwargs)
+    data = kwargs.get('data', args[0] if args and isinstance(args[0], dict) else None)
+    return result, data
+
+
+class ProcessPool:
+    """
+    Process pool of a bot.
+
+    :meta private:
+
+    :param bot: Parent bot; its token, default settings and state storage (if it can be shared) are used
+        for the bots of the child processes
+    :param max_workers: Number of processes, defaults to the number of CPUs
+    :param mp_context: Multiprocessing context, defaults to "forkserver" where available, else "spawn"
+    """
+
+    def __init__(self, bot, max_workers: Optional[int] = None, mp_context=None):
+        self.bot = bot
+        self.max_workers = max_workers or os.cpu_count() or 1
+        if mp_context is None:
+            mp_context = multiprocessing.get_context(default_start_method())
+        settings = {name: getattr(bot, name) for name in _BOT_SETTINGS}
+        state_storage = shareable_state_storage(bot.current_states)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=mp_context, initializer=_init_child,
+            initargs=(bot.token, settings, state_storage))
+
+    def wrap(self, function: Callable) -> Callable:
+        """
+        Returns a callable with the handler calling convention that runs `function` in the pool.
+        """
+        def call_in_process(message, *args, **kwargs):
+            return self.call(function, message, args, kwargs)
+        call_in_process.__wrapped__ = function
+        return call_in_process
+
+    def call(self, function: Callable, message, args: tuple, kwargs: dict):
+        """
+        Runs `function` in the pool and waits for its result.
+        """
+        data = kwargs.get('data', args[0] if args and isinstance(args[0], dict) else None)
+        args = tuple(_BOT if arg is self.bot else arg for arg in args)
+        kwargs = {key: _BOT if value is self.bot else value for key, value in kwargs.items()}
+        future = self.executor.submit(_run_child, function, dump_update(message), args, kwargs)
+        result, child_data = future.result()
+        if data is not None and child_data is not None:
+            data.clear()
+            data.update(child_data)
+        return result
+
+    def close(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
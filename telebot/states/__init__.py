@@ -126,3 +126,37 @@ def resolve_context(message, bot_id: int) -> tuple:
         )
     else:
         pass  # not yet supported :(
+
+
+def resolve_cached_context(message, bot_id: int) -> tuple:
+    """
+    Same as :func:`resolve_context`, memoized on the update object.
+    """
+    cached = getattr(message, "_state_context", None)
+    if cached is None or cached[0] != bot_id:
+        cached = (bot_id, resolve_context(message, bot_id))
+        message._state_context = cached
+    return cached[1]
+
+
+#: Returned by :func:`get_memoized_state` if no valid state is memoized.
+NOT_MEMOIZED = object()
+
+
+def get_memoized_state(message, generation: int):
+    """
+    Returns the state memoized on the update object by :func:`memoize_state`,
+    or NOT_MEMOIZED if there is none or states changed since (`generation` differs).
+    """
+    memo = getattr(message, "_state_memo", None)
+    if memo is not None and memo[0] == generation:
+        return memo[1]
+    return NOT_MEMOIZED
+
+
+def memoize_state(message, generation: int, state) -> None:
+    """
+    Memoizes the state of the user of an update object, valid while the
+    bot's state generation equals `generation`.
+    """
+    message._state_memo = (generation, state)
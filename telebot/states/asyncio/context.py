@@ -1,7 +1,7 @@
 from telebot.states import State
 from telebot.types import CallbackQuery, Message
 from telebot.async_telebot import AsyncTeleBot
-from telebot.states import resolve_context
+from telebot.states import resolve_cached_context
 
 from typing import Union
 
@@ -42,7 +42,7 @@ class StateContext:
         """
 
         chat_id, user_id, business_connection_id, bot_id, message_thread_id = (
-            resolve_context(self.message, self.bot.bot_id)
+            resolve_cached_context(self.message, self.bot.bot_id)
         )
         if isinstance(state, State):
             state = state.name
@@ -62,17 +62,7 @@ class StateContext:
         :return: Current state name.
         :rtype: str
         """
-
-        chat_id, user_id, business_connection_id, bot_id, message_thread_id = (
-            resolve_context(self.message, self.bot.bot_id)
-        )
-        return await self.bot.get_state(
-            chat_id=chat_id,
-            user_id=user_id,
-            business_connection_id=business_connection_id,
-            bot_id=bot_id,
-            message_thread_id=message_thread_id,
-        )
+        return await self.bot._get_update_state(self.message)
 
     async def delete(self) -> bool:
         """
@@ -83,7 +73,7 @@ class StateContext:
                 This method deletes state and associated data for current user.
         """
         chat_id, user_id, business_connection_id, bot_id, message_thread_id = (
-            resolve_context(self.message, self.bot.bot_id)
+            resolve_cached_context(self.message, self.bot.bot_id)
         )
         return await self.bot.delete_state(
             chat_id=chat_id,
@@ -100,7 +90,7 @@ class StateContext:
         """
 
         chat_id, user_id, business_connection_id, bot_id, message_thread_id = (
-            resolve_context(self.message, self.bot.bot_id)
+            resolve_cached_context(self.message, self.bot.bot_id)
         )
         return await self.bot.reset_data(
             chat_id=chat_id,
@@ -122,7 +112,7 @@ class StateContext:
         """
 
         chat_id, user_id, business_connection_id, bot_id, message_thread_id = (
-            resolve_context(self.message, self.bot.bot_id)
+            resolve_cached_context(self.message, self.bot.bot_id)
         )
         return self.bot.retrieve_data(
             chat_id=chat_id,
@@ -141,7 +131,7 @@ class StateContext:
         """
 
         chat_id, user_id, business_connection_id, bot_id, message_thread_id = (
-            resolve_context(self.message, self.bot.bot_id)
+            resolve_cached_context(self.message, self.bot.bot_id)
         )
         return await self.bot.add_data(
             chat_id=chat_id,
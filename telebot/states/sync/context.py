@@ -1,7 +1,7 @@
 from telebot.states import State, StatesGroup
 from telebot.types import CallbackQuery, Message
 from telebot import TeleBot, types
-from telebot.states import resolve_context
+from telebot.states import resolve_cached_context
 
 from typing import Union
 
@@ -42,7 +42,7 @@ class StateContext():
                 bot.send_message(message.chat.id, 'Hi, write me a name', reply_to_message_id=message.message_id)
         """
 
-        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_context(self.message, self.bot.bot_id)
+        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_cached_context(self.message, self.bot.bot_id)
         if isinstance(state, State):
             state = state.name
         return self.bot.set_state(
@@ -61,16 +61,8 @@ class StateContext():
         :return: Current state name.
         :rtype: str
         """
+        return self.bot._get_update_state(self.message)
 
-        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_context(self.message, self.bot.bot_id)
-        return self.bot.get_state(
-            chat_id=chat_id,
-            user_id=user_id,
-            business_connection_id=business_connection_id,
-            bot_id=bot_id,
-            message_thread_id=message_thread_id
-        )
-    
     def delete(self) -> bool:
         """
         Deletes state and data for current user.
@@ -79,7 +71,7 @@ class StateContext():
             
                 This method deletes state and associated data for current user.
         """
-        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_context(self.message, self.bot.bot_id)
+        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_cached_context(self.message, self.bot.bot_id)
         return self.bot.delete_state(
             chat_id=chat_id,
             user_id=user_id,
@@ -94,7 +86,7 @@ class StateContext():
         State will not be changed.
         """
 
-        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_context(self.message, self.bot.bot_id)
+        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_cached_context(self.message, self.bot.bot_id)
         return self.bot.reset_data(
             chat_id=chat_id,
             user_id=user_id,
@@ -114,7 +106,7 @@ class StateContext():
                 data['name'] = 'John'
         """
 
-        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_context(self.message, self.bot.bot_id)
+        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_cached_context(self.message, self.bot.bot_id)
         return self.bot.retrieve_data(
             chat_id=chat_id,
             user_id=user_id,
@@ -131,7 +123,7 @@ class StateContext():
         :type kwargs: dict
         """
 
-        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_context(self.message, self.bot.bot_id)
+        chat_id, user_id, business_connection_id, bot_id, message_thread_id = resolve_cached_context(self.message, self.bot.bot_id)
         return self.bot.add_data(
             chat_id=chat_id,
             user_id=user_id,
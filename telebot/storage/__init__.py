@@ -1,6 +1,7 @@
 from telebot.storage.memory_storage import StateMemoryStorage
 from telebot.storage.redis_storage import StateRedisStorage
 from telebot.storage.pickle_storage import StatePickleStorage
+from telebot.storage.sqlite_storage import StateSQLiteStorage
 from telebot.storage.base_storage import StateDataContext, StateStorageBase
 
 
@@ -10,4 +11,5 @@ __all__ = [
     "StateMemoryStorage",
     "StateRedisStorage",
     "StatePickleStorage",
+    "StateSQLiteStorage",
 ]
@@ -1,6 +1,24 @@
 import copy
 
 
+def get_data_changes(original: dict, data: dict):
+    """
+    Compare the data of a :class:`StateDataContext` with the data it was created with.
+
+    :return: Tuple of a dict with the new and changed keys and a list of the removed keys.
+    """
+    changed = {}
+    for key, value in data.items():
+        if key not in original:
+            changed[key] = value
+            continue
+        old_value = original[key]
+        if type(old_value) is not type(value) or old_value != value:
+            changed[key] = value
+    removed = [key for key in original if key not in data]
+    return changed, removed
+
+
 class StateStorageBase:
     def __init__(self) -> None:
         pass
@@ -63,6 +81,41 @@ class StateStorageBase:
     ):
         raise NotImplementedError
 
+    def get_states(self, chat_user_ids,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        """
+        Get states for many (chat_id, user_id) pairs, in their order.
+        Storages can override this to fetch them at once.
+        """
+        return [
+            self.get_state(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+            for chat_id, user_id in chat_user_ids
+        ]
+
+    def delete_states_for_chat(self, chat_id, bot_id=None):
+        """
+        Delete the states and data of all users in a chat, in all topics and business connections.
+        Returns the number of deleted states.
+        In these bulk operations, bot_id None matches the states of any bot.
+        """
+        raise NotImplementedError
+
+    def count_states(self, chat_id=None, bot_id=None):
+        """
+        Count the states in a chat, or in all chats if chat_id is None.
+        """
+        raise NotImplementedError
+
+    def iter_states(self, chat_id=None, bot_id=None):
+        """
+        Iterate over the states of a chat, or of all chats if chat_id is None,
+        as (chat_id, user_id, business_connection_id, message_thread_id, bot_id, state) tuples.
+        """
+        raise NotImplementedError
+
     def get_interactive_data(self, chat_id, user_id,
         business_connection_id=None,
         message_thread_id=None,
@@ -73,6 +126,28 @@ class StateStorageBase:
     def save(self, chat_id, user_id, data):
         raise NotImplementedError
 
+    def update_data(self, chat_id, user_id, changed, removed,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        """
+        Set the changed keys and remove the removed keys of the data of a user.
+        Called by :class:`StateDataContext` if the data was changed.
+        Storages can override this to write only these keys.
+        """
+        data = dict(self.get_data(
+            chat_id=chat_id,
+            user_id=user_id,
+            business_connection_id=business_connection_id,
+            message_thread_id=message_thread_id,
+            bot_id=bot_id,
+        ))
+        data.update(changed)
+        for key in removed:
+            data.pop(key, None)
+        return self.save(chat_id, user_id, data, business_connection_id, message_thread_id, bot_id)
+
     def _get_key(
         self,
         chat_id: int,
@@ -121,22 +196,33 @@ class StateDataContext:
             message_thread_id=message_thread_id,
             bot_id=bot_id,
         )
+        # kept to write only the keys changed in the context
+        self.original = copy.deepcopy(res)
         self.data = copy.deepcopy(res)
         self.chat_id = chat_id
         self.user_id = user_id
         self.bot_id = bot_id
         self.business_connection_id = business_connection_id
         self.message_thread_id = message_thread_id
+        #: Result of the storage write on exit, None if the data was not changed
+        self.saved = None
 
     def __enter__(self):
         return self.data
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        return self.obj.save(
+        # the result is kept as a status only: a true return value would swallow
+        # exceptions raised in the block
+        changed, removed = get_data_changes(self.original, self.data)
+        if not changed and not removed:
+            return None
+        self.saved = self.obj.update_data(
             self.chat_id,
             self.user_id,
-            self.data,
+            changed,
+            removed,
             self.business_connection_id,
             self.message_thread_id,
             self.bot_id,
         )
+        return None
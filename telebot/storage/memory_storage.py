@@ -1,5 +1,39 @@
+import threading
+import time
+from collections import OrderedDict
+
 from telebot.storage.base_storage import StateStorageBase, StateDataContext
-from typing import Optional, Union
+from typing import Optional, Union, Iterator
+
+
+class _StateRecord:
+    """
+    State and data of one user.
+
+    :meta private:
+    """
+    __slots__ = ("state", "data", "expires")
+
+    def __init__(self, state, data, expires):
+        self.state = state
+        self.data = data
+        self.expires = expires
+
+
+class _StateShard:
+    """
+    One part of the records, with its own lock.
+
+    :meta private:
+    """
+    __slots__ = ("lock", "records", "expired_count", "overflow_count")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # records in the order of their last use
+        self.records = OrderedDict()
+        self.expired_count = 0
+        self.overflow_count = 0
 
 
 class StateMemoryStorage(StateStorageBase):
@@ -8,43 +42,114 @@ class StateMemoryStorage(StateStorageBase):
 
     Stores states in memory as a dictionary.
 
+    Setting shards, ttl or max_entries stores the states split into shards with their own lock
+    instead, so worker threads can use it at the same time; records are keyed by
+    (bot_id, business_connection_id, message_thread_id, chat_id, user_id) tuples then, and
+    data is None.
+
+    The sharded storage can be bounded for conversations that are never finished. Set ttl to drop
+    the records that were not used for ttl seconds, and max_entries to drop the least recently
+    used records when there are more (the limit is split evenly between the shards). Expired
+    records are dropped when they are looked up, a few at a time when records are added, and by
+    a background thread every eviction_interval seconds, started with the first record if ttl is
+    set. See :meth:`stats` for eviction metrics.
+
+    :meth:`delete_states_for_chat`, :meth:`count_states` and :meth:`iter_states` walk all
+    records of the sharded storage, unless indexes is set: then the keys are also indexed by
+    chat and by bot, so they only visit the matching records, for some more work when a record
+    is added or dropped. The plain dictionary keeps nothing but the records, whose string keys
+    leave out the missing parts and cannot be read back exactly, so these methods raise
+    NotImplementedError for it unless indexes is set.
+
     .. code-block:: python3
 
-        storage = StateMemoryStorage()
-        bot = TeleBot(token, storage=storage)
+        storage = StateMemoryStorage(ttl=24 * 60 * 60, max_entries=100000)
+        bot = TeleBot(token, state_storage=storage)
 
     :param separator: Separator for keys, default is ":".
     :type separator: Optional[str]
 
     :param prefix: Prefix for keys, default is "telebot".
     :type prefix: Optional[str]
+
+    :param ttl: Seconds after the last use of a record until it expires, default is None (never).
+    :type ttl: Optional[float]
+
+    :param max_entries: Maximum number of records, default is None (unlimited).
+    :type max_entries: Optional[int]
+
+    :param shards: Number of shards, default is None (16 if ttl or max_entries is set, otherwise a single dictionary).
+    :type shards: Optional[int]
+
+    :param eviction_interval: Seconds between runs of the background eviction, default is 60.
+    :type eviction_interval: Optional[float]
+
+    :param indexes: Index the keys by chat and by bot (needed for bulk operations without shards), default is False.
+    :type indexes: Optional[bool]
     """
 
+    #: Number of expired records dropped from the shard when a record is added
+    sweep_batch = 8
+
     def __init__(
-        self, separator: Optional[str] = ":", prefix: Optional[str] = "telebot"
+        self,
+        separator: Optional[str] = ":",
+        prefix: Optional[str] = "telebot",
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        shards: Optional[int] = None,
+        eviction_interval: Optional[float] = 60,
+        indexes: Optional[bool] = False,
     ) -> None:
         self.separator = separator
         self.prefix = prefix
         if not self.prefix:
             raise ValueError("Prefix cannot be empty")
-
-        self.data = (
-            {}
-        )  # key: telebot:bot_id:business_connection_id:message_thread_id:chat_id:user_id
-
-    def set_state(
-        self,
+        if shards is None and (ttl is not None or max_entries is not None):
+            shards = 16
+        if shards is not None and shards < 1:
+            raise ValueError("Number of shards must be positive")
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.eviction_interval = eviction_interval
+        if shards is None:
+            self.shards = None
+            self._shard_max_entries = None
+            self.data = (
+                {}
+            )  # key: telebot:bot_id:business_connection_id:message_thread_id:chat_id:user_id
+        else:
+            self.shards = [_StateShard() for _ in range(shards)]
+            # limit per shard, rounded up
+            self._shard_max_entries = None if max_entries is None else -(-max_entries // shards)
+            self.data = None
+        self._stop_event = threading.Event()
+        self._evictor = None
+        self._evictor_lock = threading.Lock()
+        self.indexes = indexes
+        # keys by chat_id and by bot_id, only if indexes is set
+        self.chat_index = {}
+        self.bot_index = {}
+        self._index_lock = threading.Lock()
+
+    @property
+    def bounded(self) -> bool:
+        return self.ttl is not None or self.max_entries is not None
+
+    @staticmethod
+    def _make_key(
         chat_id: int,
         user_id: int,
-        state: str,
         business_connection_id: Optional[str] = None,
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
-    ) -> bool:
-        if hasattr(state, "name"):
-            state = state.name
+    ) -> tuple:
+        return bot_id, business_connection_id, message_thread_id, chat_id, user_id
 
-        _key = self._get_key(
+    def _get_plain_key(self, key: tuple) -> str:
+        bot_id, business_connection_id, message_thread_id, chat_id, user_id = key
+        return self._get_key(
             chat_id,
             user_id,
             self.prefix,
@@ -54,11 +159,66 @@ class StateMemoryStorage(StateStorageBase):
             bot_id,
         )
 
-        if self.data.get(_key) is None:
-            self.data[_key] = {"state": state, "data": {}}
-        else:
-            self.data[_key]["state"] = state
+    def _get_shard(self, key: tuple) -> _StateShard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def _lookup(self, shard: _StateShard, key: tuple, now: Optional[float]) -> Optional[_StateRecord]:
+        # must be called with the shard's lock held
+        record = shard.records.get(key)
+        if record is None or not self.bounded:
+            return record
+        if record.expires is not None and record.expires <= now:
+            del shard.records[key]
+            self._remove_from_indexes(key)
+            shard.expired_count += 1
+            return None
+        shard.records.move_to_end(key)
+        if self.ttl is not None:
+            record.expires = now + self.ttl
+        return record
+
+    def _now(self) -> Optional[float]:
+        return time.monotonic() if self.ttl is not None else None
 
+    def set_state(
+        self,
+        chat_id: int,
+        user_id: int,
+        state: str,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        if hasattr(state, "name"):
+            state = state.name
+
+        key = self._make_key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        if self.shards is None:
+            _key = self._get_plain_key(key)
+            if self.data.get(_key) is None:
+                self.data[_key] = {"state": state, "data": {}}
+                self._add_to_indexes(key)
+            else:
+                self.data[_key]["state"] = state
+            return True
+
+        shard = self._get_shard(key)
+        added = False
+        with shard.lock:
+            now = self._now()
+            record = self._lookup(shard, key, now)
+            if record is None:
+                expires = None if now is None else now + self.ttl
+                shard.records[key] = _StateRecord(state, {}, expires)
+                self._add_to_indexes(key)
+                if self.bounded:
+                    self._sweep(shard, now, self.sweep_batch)
+                    added = True
+            else:
+                record.state = state
+
+        if added and self.ttl is not None and self._evictor is None:
+            self._start_evictor()
         return True
 
     def get_state(
@@ -69,21 +229,15 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> Union[str, None]:
+        key = self._make_key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        if self.shards is None:
+            record = self.data.get(self._get_plain_key(key))
+            return None if record is None else record["state"]
 
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
-        )
-
-        if self.data.get(_key) is None:
-            return None
-
-        return self.data[_key]["state"]
+        shard = self._get_shard(key)
+        with shard.lock:
+            record = self._lookup(shard, key, self._now())
+            return None if record is None else record.state
 
     def delete_state(
         self,
@@ -93,21 +247,17 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
-        )
-
-        if self.data.get(_key) is None:
-            return False
-
-        del self.data[_key]
-        return True
+        key = self._make_key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        if self.shards is None:
+            return self._delete_plain(key)
+
+        shard = self._get_shard(key)
+        with shard.lock:
+            if self._lookup(shard, key, self._now()) is None:
+                return False
+            del shard.records[key]
+            self._remove_from_indexes(key)
+            return True
 
     def set_data(
         self,
@@ -119,20 +269,20 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
-
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
-        )
-
-        if self.data.get(_key) is None:
-            raise RuntimeError(f"StateMemoryStorage: key {_key} does not exist.")
-        self.data[_key]["data"][key] = value
+        _key = self._make_key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        if self.shards is None:
+            _key = self._get_plain_key(_key)
+            if self.data.get(_key) is None:
+                raise RuntimeError(f"StateMemoryStorage: key {_key} does not exist.")
+            self.data[_key]["data"][key] = value
+            return True
+
+        shard = self._get_shard(_key)
+        with shard.lock:
+            record = self._lookup(shard, _key, self._now())
+            if record is None:
+                raise RuntimeError(f"StateMemoryStorage: key {_key} does not exist.")
+            record.data[key] = value
         return True
 
     def get_data(
@@ -143,18 +293,14 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> dict:
+        key = self._make_key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        if self.shards is None:
+            return self.data.get(self._get_plain_key(key), {}).get("data", {})
 
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
-        )
-
-        return self.data.get(_key, {}).get("data", {})
+        shard = self._get_shard(key)
+        with shard.lock:
+            record = self._lookup(shard, key, self._now())
+            return {} if record is None else record.data
 
     def reset_data(
         self,
@@ -164,21 +310,21 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
-
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
-        )
-
-        if self.data.get(_key) is None:
-            return False
-        self.data[_key]["data"] = {}
-        return True
+        key = self._make_key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        if self.shards is None:
+            record = self.data.get(self._get_plain_key(key))
+            if record is None:
+                return False
+            record["data"] = {}
+            return True
+
+        shard = self._get_shard(key)
+        with shard.lock:
+            record = self._lookup(shard, key, self._now())
+            if record is None:
+                return False
+            record.data = {}
+            return True
 
     def get_interactive_data(
         self,
@@ -206,20 +352,216 @@ class StateMemoryStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
-        _key = self._get_key(
-            chat_id,
-            user_id,
-            self.prefix,
-            self.separator,
-            business_connection_id,
-            message_thread_id,
-            bot_id,
-        )
-
-        if self.data.get(_key) is None:
+        key = self._make_key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        if self.shards is None:
+            record = self.data.get(self._get_plain_key(key))
+            if record is None:
+                return False
+            record["data"] = data
+            return True
+
+        shard = self._get_shard(key)
+        with shard.lock:
+            record = self._lookup(shard, key, self._now())
+            if record is None:
+                return False
+            record.data = data
+            return True
+
+    def update_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        changed: dict,
+        removed: list,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        key = self._make_key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        if self.shards is None:
+            record = self.data.get(self._get_plain_key(key))
+            if record is None:
+                return False
+            record["data"].update(changed)
+            for name in removed:
+                record["data"].pop(name, None)
+            return True
+
+        shard = self._get_shard(key)
+        with shard.lock:
+            record = self._lookup(shard, key, self._now())
+            if record is None:
+                return False
+            record.data.update(changed)
+            for name in removed:
+                record.data.pop(name, None)
+            return True
+
+    def _delete_plain(self, key: tuple) -> bool:
+        _key = self._get_plain_key(key)
+        if self.data.pop(_key, None) is None:
             return False
-        self.data[_key]["data"] = data
+        self._remove_from_indexes(key)
         return True
 
+    def _add_to_indexes(self, key: tuple) -> None:
+        # must be called with the shard's lock held
+        if not self.indexes:
+            return
+        bot_id, chat_id = key[0], key[3]
+        with self._index_lock:
+            self.chat_index.setdefault(chat_id, set()).add(key)
+            self.bot_index.setdefault(bot_id, set()).add(key)
+
+    def _remove_from_indexes(self, key: tuple) -> None:
+        # must be called with the shard's lock held
+        if not self.indexes:
+            return
+        bot_id, chat_id = key[0], key[3]
+        with self._index_lock:
+            for index, index_key in ((self.chat_index, chat_id), (self.bot_index, bot_id)):
+                keys = index.get(index_key)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[index_key]
+
+    @staticmethod
+    def _key_matches(key: tuple, chat_id: Optional[int], bot_id: Optional[int]) -> bool:
+        # None matches any chat or any bot
+        return (bot_id is None or key[0] == bot_id) and (chat_id is None or key[3] == chat_id)
+
+    def _find_keys(self, chat_id: Optional[int], bot_id: Optional[int]) -> list:
+        if self.indexes and chat_id is not None:
+            with self._index_lock:
+                return [key for key in self.chat_index.get(chat_id, ()) if bot_id is None or key[0] == bot_id]
+        if self.indexes and bot_id is not None:
+            with self._index_lock:
+                return list(self.bot_index.get(bot_id, ()))
+        if self.indexes:
+            with self._index_lock:
+                keys = [key for keys in self.chat_index.values() for key in keys]
+            return [key for key in keys if self._key_matches(key, chat_id, bot_id)]
+        if self.shards is None:
+            raise NotImplementedError(
+                "StateMemoryStorage: bulk operations need indexes=True or shards, "
+                "the keys of the plain dictionary cannot be parsed reliably."
+            )
+        keys = []
+        for shard in self.shards:
+            with shard.lock:
+                keys.extend(key for key in shard.records if self._key_matches(key, chat_id, bot_id))
+        return keys
+
+    def delete_states_for_chat(self, chat_id: int, bot_id: Optional[int] = None) -> int:
+        deleted = 0
+        for key in self._find_keys(chat_id, bot_id):
+            if self.shards is None:
+                deleted += self._delete_plain(key)
+                continue
+            shard = self._get_shard(key)
+            with shard.lock:
+                if shard.records.pop(key, None) is not None:
+                    self._remove_from_indexes(key)
+                    deleted += 1
+        return deleted
+
+    def count_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> int:
+        if self.ttl is None:
+            return len(self._find_keys(chat_id, bot_id))
+        return sum(1 for _ in self.iter_states(chat_id, bot_id))
+
+    def iter_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> Iterator[tuple]:
+        for key in self._find_keys(chat_id, bot_id):
+            if self.shards is None:
+                record = self.data.get(self._get_plain_key(key))
+                if record is None:
+                    continue
+                state = record["state"]
+            else:
+                shard = self._get_shard(key)
+                with shard.lock:
+                    # expired records are skipped, but listing does not count as a use
+                    record = shard.records.get(key)
+                    if record is None or (record.expires is not None and record.expires <= time.monotonic()):
+                        continue
+                    state = record.state
+            key_bot_id, business_connection_id, message_thread_id, key_chat_id, user_id = key
+            yield key_chat_id, user_id, business_connection_id, message_thread_id, key_bot_id, state
+
+    def evict_expired(self) -> int:
+        """
+        Drops the expired records.
+
+        :return: Number of dropped records
+        """
+        if self.ttl is None:
+            return 0
+        evicted = 0
+        for shard in self.shards:
+            with shard.lock:
+                evicted += self._sweep(shard, time.monotonic(), None)
+        return evicted
+
+    def stats(self) -> dict:
+        """
+        Returns the number of records and eviction counters as a dict.
+        """
+        entries = expired_count = overflow_count = 0
+        if self.shards is None:
+            entries = len(self.data)
+        for shard in self.shards or ():
+            with shard.lock:
+                entries += len(shard.records)
+                expired_count += shard.expired_count
+                overflow_count += shard.overflow_count
+        return {
+            "entries": entries,
+            "expired_count": expired_count,
+            "overflow_count": overflow_count,
+            "evicted_count": expired_count + overflow_count,
+        }
+
+    def close(self) -> None:
+        """
+        Stops the background eviction thread.
+        """
+        self._stop_event.set()
+        if self._evictor is not None:
+            self._evictor.join()
+            self._evictor = None
+        self._stop_event.clear()
+
+    def _sweep(self, shard: _StateShard, now: Optional[float], limit: Optional[int]) -> int:
+        # must be called with the shard's lock held; the records are in the order of
+        # their last use, so the expired ones are at the front
+        records = shard.records
+        expired = 0
+        if now is not None:
+            while records and (limit is None or expired < limit):
+                record = next(iter(records.values()))
+                if record.expires is None or record.expires > now:
+                    break
+                self._remove_from_indexes(records.popitem(last=False)[0])
+                expired += 1
+            shard.expired_count += expired
+        if self._shard_max_entries is not None:
+            while len(records) > self._shard_max_entries:
+                self._remove_from_indexes(records.popitem(last=False)[0])
+                shard.overflow_count += 1
+        return expired
+
+    def _start_evictor(self) -> None:
+        with self._evictor_lock:
+            if self._evictor is not None:
+                return
+            self._evictor = threading.Thread(target=self._run_evictor, name="StateEvictor", daemon=True)
+        self._evictor.start()
+
+    def _run_evictor(self) -> None:
+        while not self._stop_event.wait(self.eviction_interval):
+            self.evict_expired()
+
     def __str__(self) -> str:
-        return f"<StateMemoryStorage: {self.data}>"
+        return f"<StateMemoryStorage: {self.stats()['entries']} states>"
@@ -1,7 +1,7 @@
 import os
 import pickle
 import threading
-from typing import Optional, Union, Callable
+from typing import Optional, Union, Callable, List, Tuple, Iterator
 from telebot.storage.base_storage import StateStorageBase, StateDataContext
 
 
@@ -13,6 +13,36 @@ def with_lock(func: Callable) -> Callable:
     return wrapper
 
 
+def record_ids(
+    chat_id: int,
+    user_id: int,
+    business_connection_id: Optional[str] = None,
+    message_thread_id: Optional[int] = None,
+    bot_id: Optional[int] = None,
+) -> tuple:
+    """
+    Returns the parts of a key that are stored in its record for the bulk operations,
+    with None for the parts that the key leaves out.
+    """
+    return chat_id, user_id, business_connection_id or None, message_thread_id or None, bot_id or None
+
+
+def find_records(states: dict, chat_id: Optional[int], bot_id: Optional[int]) -> List[Tuple[str, dict]]:
+    """
+    Returns the (key, record) pairs of the states of a chat, or of all chats if chat_id is None,
+    of a bot, or of any bot if bot_id is None.
+    """
+    found = []
+    for _key, record in states.items():
+        ids = record.get("ids")
+        # records of older versions do not know their key parts
+        if ids is None:
+            continue
+        if (chat_id is None or ids[0] == chat_id) and (bot_id is None or ids[4] == bot_id):
+            found.append((_key, record))
+    return found
+
+
 class StatePickleStorage(StateStorageBase):
     """
     State storage based on pickle file.
@@ -28,6 +58,17 @@ class StatePickleStorage(StateStorageBase):
         storage = StatePickleStorage()
         bot = TeleBot(token, storage=storage)
 
+    By default every call reads the whole file and every change rewrites it.
+    With write_behind=True the states are kept in memory: reads are dict lookups,
+    each change appends the changed record to a log file next to the snapshot,
+    and the snapshot is rewritten (and the log emptied) every snapshot_interval seconds
+    and on :meth:`close`. The log is replayed on start.
+
+    Each record also keeps the parts of its key, which :meth:`delete_states_for_chat`,
+    :meth:`count_states` and :meth:`iter_states` match while walking all records.
+    Records written by older versions do not have them, and are only found by these
+    methods once their state was set again.
+
     :param file_path: Path to file where states will be stored.
     :type file_path: str
 
@@ -36,6 +77,17 @@ class StatePickleStorage(StateStorageBase):
 
     :param separator: Separator for keys, default is ":".
     :type separator: Optional[str]
+
+    :param write_behind: Keep states in memory and append changes to a log, default is False.
+    :type write_behind: Optional[bool]
+
+    :param snapshot_interval: Seconds between snapshots in write_behind mode, default is 60.
+    :type snapshot_interval: Optional[float]
+
+    :param fsync: When to fsync in write_behind mode: "always" after each change,
+        "snapshot" only when a snapshot is written (changes survive a crash of the process,
+        but not of the OS) or "never". Default is "snapshot".
+    :type fsync: Optional[str]
     """
 
     def __init__(
@@ -43,13 +95,121 @@ class StatePickleStorage(StateStorageBase):
         file_path: str = "./.state-save/states.pkl",
         prefix="telebot",
         separator: Optional[str] = ":",
+        write_behind: Optional[bool] = False,
+        snapshot_interval: Optional[float] = 60,
+        fsync: Optional[str] = "snapshot",
     ) -> None:
+        if fsync not in ("always", "snapshot", "never"):
+            raise ValueError("fsync must be 'always', 'snapshot' or 'never'")
+
         self.file_path = file_path
         self.prefix = prefix
         self.separator = separator
         self.lock = threading.Lock()
+        self.write_behind = write_behind
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
 
         self.create_dir()
+        if write_behind:
+            self._start_write_behind()
+
+    def _start_write_behind(self) -> None:
+        self.log_path = self.file_path + ".log"
+        # the log being merged into a snapshot, kept until the snapshot is written
+        self.rotated_log_path = self.file_path + ".log.1"
+        self.snapshot_lock = threading.Lock()
+        self.states = self._read_from_file()
+        self._log_records = 0
+        for path in (self.rotated_log_path, self.log_path):
+            self._log_records += self._replay_log(path)
+        self._log = open(self.log_path, "ab")
+        self._stop_event = threading.Event()
+        self._snapshotter = threading.Thread(target=self._run_snapshots, name="StateSnapshotter", daemon=True)
+        self._snapshotter.start()
+
+    def _replay_log(self, path: str) -> int:
+        if not os.path.isfile(path):
+            return 0
+        records = 0
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    key, record = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    # end of the log or a record cut off by a crash
+                    break
+                if record is None:
+                    self.states.pop(key, None)
+                else:
+                    self.states[key] = record
+                records += 1
+        return records
+
+    def _load(self) -> dict:
+        if self.write_behind:
+            return self.states
+        return self._read_from_file()
+
+    def _commit(self, data: dict, *keys: str) -> None:
+        if not self.write_behind:
+            self._write_to_file(data)
+            return
+        for key in keys:
+            pickle.dump((key, data.get(key)), self._log)
+        self._log.flush()
+        if self.fsync == "always":
+            os.fsync(self._log.fileno())
+        self._log_records += len(keys)
+
+    def snapshot(self) -> bool:
+        """
+        Write all states to the snapshot file and empty the log (write_behind mode only).
+
+        :return: False if there were no changes since the last snapshot.
+        """
+        with self.snapshot_lock:
+            with self.lock:
+                if not self._log_records:
+                    return False
+                snapshot = pickle.dumps(self.states)
+                self._rotate_log()
+            tmp_path = self.file_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(snapshot)
+                f.flush()
+                if self.fsync != "never":
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.file_path)
+            os.remove(self.rotated_log_path)
+            return True
+
+    def _rotate_log(self) -> None:
+        self._log.close()
+        if os.path.isfile(self.rotated_log_path):
+            # the previous snapshot failed, its log is still needed
+            with open(self.rotated_log_path, "ab") as rotated, open(self.log_path, "rb") as log:
+                rotated.write(log.read())
+            os.remove(self.log_path)
+        else:
+            os.replace(self.log_path, self.rotated_log_path)
+        self._log = open(self.log_path, "ab")
+        self._log_records = 0
+
+    def _run_snapshots(self) -> None:
+        while not self._stop_event.wait(self.snapshot_interval):
+            self.snapshot()
+
+    def close(self) -> None:
+        """
+        Write a final snapshot and stop the snapshot thread (write_behind mode only).
+        """
+        if not self.write_behind:
+            return
+        self._stop_event.set()
+        self._snapshotter.join()
+        self.snapshot()
+        self._log.close()
 
     def _read_from_file(self) -> dict:
         with open(self.file_path, "rb") as f:
@@ -79,6 +239,9 @@ class StatePickleStorage(StateStorageBase):
         message_thread_id: Optional[int] = None,
         bot_id: Optional[int] = None,
     ) -> bool:
+        if hasattr(state, "name"):
+            state = state.name
+
         _key = self._get_key(
             chat_id,
             user_id,
@@ -88,12 +251,14 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = self._read_from_file()
+        ids = record_ids(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        data = self._load()
         if _key not in data:
-            data[_key] = {"state": state, "data": {}}
+            data[_key] = {"state": state, "data": {}, "ids": ids}
         else:
             data[_key]["state"] = state
-        self._write_to_file(data)
+            data[_key]["ids"] = ids
+        self._commit(data, _key)
         return True
 
     @with_lock
@@ -114,7 +279,7 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = self._read_from_file()
+        data = self._load()
         return data.get(_key, {}).get("state")
 
     @with_lock
@@ -135,10 +300,10 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = self._read_from_file()
+        data = self._load()
         if _key in data:
             del data[_key]
-            self._write_to_file(data)
+            self._commit(data, _key)
             return True
         return False
 
@@ -162,14 +327,12 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = self._read_from_file()
-        state_data = data.get(_key, {})
-        state_data["data"][key] = value
-
+        data = self._load()
         if _key not in data:
             raise RuntimeError(f"PickleStorage: key {_key} does not exist.")
 
-        self._write_to_file(data)
+        data[_key]["data"][key] = value
+        self._commit(data, _key)
         return True
 
     @with_lock
@@ -190,8 +353,8 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = self._read_from_file()
-        return data.get(_key, {}).get("data", {})
+        data = self._load()
+        return dict(data.get(_key, {}).get("data", {}))
 
     @with_lock
     def reset_data(
@@ -211,10 +374,10 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = self._read_from_file()
+        data = self._load()
         if _key in data:
             data[_key]["data"] = {}
-            self._write_to_file(data)
+            self._commit(data, _key)
             return True
         return False
 
@@ -254,10 +417,60 @@ class StatePickleStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        file_data = self._read_from_file()
+        file_data = self._load()
         file_data[_key]["data"] = data
-        self._write_to_file(file_data)
+        self._commit(file_data, _key)
         return True
 
+    @with_lock
+    def get_states(
+        self,
+        chat_user_ids: List[Tuple[int, int]],
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> List[Union[str, None]]:
+        """
+        Get the states of many users, reading the file once.
+
+        :param chat_user_ids: (chat_id, user_id) pairs
+        :type chat_user_ids: List[Tuple[int, int]]
+
+        :return: States in the order of chat_user_ids, None for users without a state.
+        """
+        data = self._load()
+        states = []
+        for chat_id, user_id in chat_user_ids:
+            _key = self._get_key(
+                chat_id,
+                user_id,
+                self.prefix,
+                self.separator,
+                business_connection_id,
+                message_thread_id,
+                bot_id,
+            )
+            states.append(data.get(_key, {}).get("state"))
+        return states
+
+    @with_lock
+    def delete_states_for_chat(self, chat_id: int, bot_id: Optional[int] = None) -> int:
+        data = self._load()
+        keys = [_key for _key, _ in find_records(data, chat_id, bot_id)]
+        for _key in keys:
+            del data[_key]
+        if keys:
+            self._commit(data, *keys)
+        return len(keys)
+
+    @with_lock
+    def count_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> int:
+        return len(find_records(self._load(), chat_id, bot_id))
+
+    def iter_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> Iterator[tuple]:
+        with self.lock:
+            states = [(*record["ids"], record["state"]) for _, record in find_records(self._load(), chat_id, bot_id)]
+        yield from states
+
     def __str__(self) -> str:
         return f"StatePickleStorage({self.file_path}, {self.prefix})"
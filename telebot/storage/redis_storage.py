@@ -1,6 +1,13 @@
 import json
+import logging
+import threading
+import time
+import types
+from collections import OrderedDict
 from telebot.storage.base_storage import StateStorageBase, StateDataContext
-from typing import Optional, Union
+from typing import Optional, Union, List, Tuple, Callable, Iterator, Iterable
+
+logger = logging.getLogger('TeleBot')
 
 redis_installed = True
 try:
@@ -9,6 +16,185 @@ except ImportError:
     redis_installed = False
 
 
+#: Prefix of the hash fields holding data values with data_fields set, one JSON encoded value
+#: per field. By default, as in older versions, the whole data dict is stored as JSON in the
+#: "data" field; both layouts are read, and a save or reset writes the configured one.
+DATA_FIELD_PREFIX = "d:"
+
+# sets the state, and the empty data that older versions expect with it
+SET_STATE_SCRIPT = """
+    redis.call('HSET', KEYS[1], 'state', ARGV[1])
+    redis.call('HSETNX', KEYS[1], 'data', '{}')
+    return 1
+"""
+
+SET_DATA_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+"""
+
+# replaces all data fields with the field/value pairs in ARGV
+REPLACE_DATA_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+        if field == 'data' or string.sub(field, 1, 2) == 'd:' then
+            redis.call('HDEL', KEYS[1], field)
+        end
+    end
+    for i = 1, #ARGV, 2 do
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    return 1
+"""
+
+# removes the ARGV[1] fields in ARGV[2..ARGV[1] + 1] and sets the field/value pairs after them;
+# returns -1 without changes if the data is still in the "data" field of older versions
+UPDATE_DATA_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    if redis.call('HEXISTS', KEYS[1], 'data') == 1 then
+        return -1
+    end
+    local removed = tonumber(ARGV[1])
+    for i = 2, removed + 1 do
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+    for i = removed + 2, #ARGV, 2 do
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    return 1
+"""
+
+
+def encode_data(data: dict) -> list:
+    """
+    Convert a data dict to a flat list of hash fields and values.
+    """
+    args = []
+    for key, value in data.items():
+        args.append(DATA_FIELD_PREFIX + str(key))
+        args.append(json.dumps(value))
+    return args
+
+
+def decode_data(fields: dict) -> dict:
+    """
+    Convert the fields of a state hash to a data dict.
+    """
+    data = {}
+    values = {}
+    for field, value in fields.items():
+        if isinstance(field, bytes):
+            field = field.decode("utf-8")
+        if field == "data":
+            data.update(json.loads(value))
+        elif field.startswith(DATA_FIELD_PREFIX):
+            values[field[len(DATA_FIELD_PREFIX):]] = json.loads(value)
+    data.update(values)
+    return data
+
+
+def encode_data_changes(changed: dict, removed: list) -> list:
+    """
+    Convert changed and removed data keys to the arguments of UPDATE_DATA_SCRIPT.
+    """
+    return [len(removed)] + [DATA_FIELD_PREFIX + str(key) for key in removed] + encode_data(changed)
+
+
+def data_field_names(fields: dict) -> list:
+    """
+    Get the names of the hash fields holding data values, as stored in the hash.
+    """
+    names = []
+    for field in fields:
+        name = field.decode("utf-8") if isinstance(field, bytes) else field
+        if name.startswith(DATA_FIELD_PREFIX):
+            names.append(field)
+    return names
+
+
+def decode_state(fields: dict) -> Optional[str]:
+    """
+    Get the state from the fields of a state hash.
+    """
+    state = fields.get(b"state", fields.get("state"))
+    if isinstance(state, bytes):
+        return state.decode("utf-8")
+    return state or None
+
+
+class NearCache:
+    """
+    In-process LRU cache of state hashes with a time to live, used by the Redis storages
+    when cache_size is set.
+
+    Entries are only kept while the storage is subscribed to its invalidation channel.
+    A read stores its result only if no key was invalidated since the read started,
+    so a value read before a change can not replace the invalidation of the change.
+
+    :meta private:
+    """
+
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.active = False
+        # incremented on every invalidation
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self.lock:
+            if not self.active:
+                return None
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, fields: dict, generation: int) -> None:
+        with self.lock:
+            if not self.active or generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, fields)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key: Union[str, bytes]) -> None:
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(key, None)
+
+    def set_active(self, active: bool) -> None:
+        # entries may have missed invalidations while the channel was not subscribed
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.active = active
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
 class StateRedisStorage(StateStorageBase):
     """
     State storage based on Redis.
@@ -42,6 +228,51 @@ class StateRedisStorage(StateStorageBase):
     :param separator: Separator for keys, default is ":".
     :type separator: Optional[str]
 
+    :param cache_size: Number of users whose state and data are cached in the process,
+        default is None (no cache).
+    :type cache_size: Optional[int]
+
+    :param cache_ttl: Seconds a cached state is used, default is 5.
+    :type cache_ttl: Optional[float]
+
+    :param indexes: Keep sets of the users with a state per chat and per bot, needed by
+        :meth:`delete_states_for_chat`, :meth:`count_states` and :meth:`iter_states`,
+        default is False.
+    :type indexes: Optional[bool]
+
+    :param data_fields: Store each data value in its own hash field, default is False
+        (the whole data dict in the "data" field, as older versions do).
+    :type data_fields: Optional[bool]
+
+    By default the data is stored as one JSON encoded dict in the "data" field of the hash,
+    which older versions read and write too. Setting the state, saving and resetting the data
+    are single round trips; :meth:`set_data` and leaving :meth:`get_interactive_data` with
+    changes read the dict and write it back in a transaction, which is repeated if the hash
+    changed in the meantime.
+
+    With data_fields set, each data value is stored as JSON in a "d:<key>" hash field, so every
+    operation is a single round trip: changing one value or replacing the data is done by a
+    server-side script without reading the data first, and leaving :meth:`get_interactive_data`
+    only writes the changed fields. Versions without data_fields only read the "data" field and
+    do not see these values, so only enable it once all bots using the database are upgraded.
+    Both layouts are read either way, and a hash is converted to the configured layout when its
+    data is written; to go back, run the bots with data_fields off until their data was written.
+
+    With cache_size set, reads are served from an in-process cache, and a miss reads the whole
+    hash, so the state and the data of a user are fetched together. Every change publishes the
+    key to the "<prefix><separator>invalidate" channel, and all storages with a cache drop it
+    when they receive it, so bots sharing the database do not read stale states. The cache is
+    only used while that channel is subscribed, and it is emptied when the subscription fails or
+    the connection is reestablished; cache_ttl bounds the time a stale entry could be used if an
+    invalidation is lost otherwise. Call :meth:`close` to stop the subscriber thread.
+
+    With indexes set, setting and deleting a state also adds the user to or removes it from the
+    "<prefix><separator>chat_index<separator><bot_id><separator><chat_id>",
+    "<prefix><separator>bot_index<separator><bot_id>",
+    "<prefix><separator>any_bot_chat_index<separator><chat_id>" and
+    "<prefix><separator>any_bot_index" sets, in the same round trip, so the bulk operations only
+    read the matching users, for one bot or for any bot. States set before indexes was enabled
+    are not in them.
     """
 
     def __init__(
@@ -54,6 +285,10 @@ class StateRedisStorage(StateStorageBase):
         redis_url=None,
         connection_pool: "redis.ConnectionPool" = None,
         separator: Optional[str] = ":",
+        cache_size: Optional[int] = None,
+        cache_ttl: Optional[float] = 5,
+        indexes: Optional[bool] = False,
+        data_fields: Optional[bool] = False,
     ) -> None:
 
         if not redis_installed:
@@ -73,6 +308,217 @@ class StateRedisStorage(StateStorageBase):
         else:
             self.redis = redis.Redis(host=host, port=port, db=db, password=password)
 
+        self._set_state_script = self.redis.register_script(SET_STATE_SCRIPT)
+        self._set_data_script = self.redis.register_script(SET_DATA_SCRIPT)
+        self._replace_data_script = self.redis.register_script(REPLACE_DATA_SCRIPT)
+        self._update_data_script = self.redis.register_script(UPDATE_DATA_SCRIPT)
+
+        self.indexes = indexes
+        self.data_fields = data_fields
+        self.invalidation_channel = separator.join((prefix, "invalidate"))
+        self.cache = None
+        if cache_size:
+            self.cache = NearCache(cache_size, cache_ttl)
+            self._stop_event = threading.Event()
+            self._invalidator = threading.Thread(
+                target=self._run_invalidator, name="StateCacheInvalidator", daemon=True
+            )
+            self._invalidator.start()
+
+    def _run_invalidator(self) -> None:
+        while not self._stop_event.is_set():
+            pubsub = self.redis.pubsub()
+            try:
+                self._subscribe(pubsub)
+                while not self._stop_event.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    if message["type"] == "subscribe":
+                        self.cache.set_active(True)
+                    elif message["type"] == "unsubscribe":
+                        self.cache.set_active(False)
+                    elif message["type"] == "message":
+                        self.cache.invalidate(message["data"])
+            except Exception as e:
+                # the cache may have missed invalidations, so it is not used until subscribed again
+                self.cache.set_active(False)
+                logger.error("StateRedisStorage: invalidation channel failed: %s", e)
+                self._stop_event.wait(1)
+            finally:
+                self.cache.set_active(False)
+                pubsub.close()
+
+    def _subscribe(self, pubsub) -> None:
+        on_connect = pubsub.on_connect
+
+        def reconnected(pubsub, connection):
+            # the pubsub reconnects and subscribes again by itself after a disconnect;
+            # invalidations published in the meantime are lost, so the cache is dropped
+            # until the subscription is confirmed
+            self.cache.set_active(False)
+            on_connect(connection)
+
+        # the connection keeps a weak reference to the callback, which must be a bound method
+        pubsub.on_connect = types.MethodType(reconnected, pubsub)
+        pubsub.subscribe(self.invalidation_channel)
+
+    def _get_fields(self, _key: str) -> dict:
+        generation = self.cache.generation
+        fields = self.cache.get(_key)
+        if fields is None:
+            fields = self.redis.hgetall(_key)
+            self.cache.put(_key, fields, generation)
+        return fields
+
+    def _write(self, _key: str, command: Callable, index_command: Optional[Callable] = None):
+        """
+        Run command(client) and in the same round trip index_command(client) and,
+        with the cache, publish the invalidation. Returns the result of command.
+        """
+        if self.cache is None and index_command is None:
+            return command(self.redis)
+        try:
+            try:
+                return self._write_pipeline(_key, command, index_command)
+            except redis.exceptions.NoScriptError:
+                # the server lost the scripts, e.g. after a restart; the other commands can be repeated
+                self._load_scripts()
+                return self._write_pipeline(_key, command, index_command)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(_key)
+
+    def _write_pipeline(self, _key: str, command: Callable, index_command: Optional[Callable]):
+        pipe = self.redis.pipeline(transaction=False)
+        command(pipe)
+        if index_command is not None:
+            index_command(pipe)
+        if self.cache is not None:
+            pipe.publish(self.invalidation_channel, _key)
+        return pipe.execute()[0]
+
+    def _run_script(self, client, script, _key: str, args: list):
+        """
+        Run script on the client, or queue it if the client is a pipeline.
+        """
+        if client is self.redis:
+            return script(keys=[_key], args=args, client=client)
+        # queued by its SHA: a script registered on the pipeline would make every execute()
+        # check it with SCRIPT EXISTS first, an extra round trip
+        return client.evalsha(script.sha, 1, _key, *args)
+
+    def _load_scripts(self) -> None:
+        scripts = (self._set_state_script, self._set_data_script, self._replace_data_script, self._update_data_script)
+        for script in scripts:
+            script.sha = self.redis.script_load(script.script)
+
+    def _encode_data(self, data: dict) -> list:
+        """
+        Returns the hash fields and values of data in the configured layout.
+        """
+        if self.data_fields:
+            return encode_data(data)
+        return ["data", json.dumps(data)]
+
+    def _change_data(self, _key: str, change: Callable[[dict], None]) -> bool:
+        """
+        Apply change to the data dict in the "data" field, in a transaction that is repeated
+        if the hash changes meanwhile. Values in data fields are moved into the dict.
+        Returns False if the key does not exist.
+        """
+        def change_action(pipe):
+            fields = pipe.hgetall(_key)
+            if not fields:
+                return False
+            data = decode_data(fields)
+            change(data)
+            pipe.multi()
+            names = data_field_names(fields)
+            if names:
+                pipe.hdel(_key, *names)
+            pipe.hset(_key, "data", json.dumps(data))
+            if self.cache is not None:
+                pipe.publish(self.invalidation_channel, _key)
+            return True
+
+        try:
+            return self.redis.transaction(change_action, _key, value_from_callable=True)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(_key)
+
+    def _index_keys(self, chat_id: int, bot_id: Optional[int]) -> Tuple[str, str, str, str]:
+        """
+        Returns the index sets of a state: by chat and bot, by bot, by chat for any bot, and of all states.
+        """
+        bot = str(bot_id) if bot_id else ""
+        return (
+            self.separator.join((self.prefix, "chat_index", bot, str(chat_id))),
+            self.separator.join((self.prefix, "bot_index", bot)),
+            self.separator.join((self.prefix, "any_bot_chat_index", str(chat_id))),
+            self.separator.join((self.prefix, "any_bot_index")),
+        )
+
+    def _scope_index_key(self, chat_id: Optional[int], bot_id: Optional[int]) -> str:
+        """
+        Returns the index set of the states of a chat, or of all chats if chat_id is None,
+        of a bot, or of any bot if bot_id is None.
+        """
+        chat_index, bot_index, any_bot_chat_index, any_bot_index = self._index_keys(chat_id, bot_id)
+        if bot_id is None:
+            return any_bot_index if chat_id is None else any_bot_chat_index
+        return bot_index if chat_id is None else chat_index
+
+    def _index_command(
+        self,
+        method: str,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str],
+        message_thread_id: Optional[int],
+        bot_id: Optional[int],
+    ) -> Optional[Callable]:
+        """
+        Returns a command adding the user to the indexes (method "sadd") or removing it ("srem").
+        """
+        if not self.indexes:
+            return None
+        member = json.dumps([chat_id, user_id, business_connection_id, message_thread_id, bot_id or None])
+        index_keys = self._index_keys(chat_id, bot_id)
+
+        def index_command(client):
+            for index_key in index_keys:
+                getattr(client, method)(index_key, member)
+
+        return index_command
+
+    def _check_indexes(self) -> None:
+        if not self.indexes:
+            raise RuntimeError("StateRedisStorage: bulk operations need a storage created with indexes=True")
+
+    def _member_key(self, member: Union[str, bytes]) -> Tuple[list, str]:
+        chat_id, user_id, business_connection_id, message_thread_id, bot_id = json.loads(member)
+        key = self._get_key(
+            chat_id, user_id, self.prefix, self.separator, business_connection_id, message_thread_id, bot_id
+        )
+        return [chat_id, user_id, business_connection_id, message_thread_id, bot_id], key
+
+    def cache_stats(self) -> Optional[dict]:
+        """
+        Returns the number of cached users, hits and misses of the cache as a dict,
+        or None without a cache.
+        """
+        return None if self.cache is None else self.cache.stats()
+
+    def close(self) -> None:
+        """
+        Stop the cache subscriber thread.
+        """
+        if self.cache is not None:
+            self._stop_event.set()
+            self._invalidator.join()
+
     def set_state(
         self,
         chat_id: int,
@@ -94,21 +540,15 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-
-        def set_state_action(pipe):
-            pipe.multi()
-
-            data = pipe.hget(_key, "data")
-            result = pipe.execute()
-            data = result[0]
-            if data is None:
-                # If data is None, set it to an empty dictionary
-                data = {}
-                pipe.hset(_key, "data", json.dumps(data))
-
-            pipe.hset(_key, "state", state)
-
-        self.redis.transaction(set_state_action, _key)
+        if self.data_fields:
+            command = lambda client: client.hset(_key, "state", state)
+        else:
+            command = lambda client: self._run_script(client, self._set_state_script, _key, [state])
+        self._write(
+            _key,
+            command,
+            self._index_command("sadd", chat_id, user_id, business_connection_id, message_thread_id, bot_id),
+        )
         return True
 
     def get_state(
@@ -128,6 +568,8 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
+        if self.cache is not None:
+            return decode_state(self._get_fields(_key))
         state_bytes = self.redis.hget(_key, "state")
         return state_bytes.decode("utf-8") if state_bytes else None
 
@@ -148,7 +590,11 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        return self.redis.delete(_key) > 0
+        return self._write(
+            _key,
+            lambda client: client.delete(_key),
+            self._index_command("srem", chat_id, user_id, business_connection_id, message_thread_id, bot_id),
+        ) > 0
 
     def set_data(
         self,
@@ -169,19 +615,13 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-
-        def set_data_action(pipe):
-            pipe.multi()
-            data = pipe.hget(_key, "data")
-            data = data.execute()[0]
-            if data is None:
-                raise RuntimeError(f"RedisStorage: key {_key} does not exist.")
-            else:
-                data = json.loads(data)
-                data[key] = value
-                pipe.hset(_key, "data", json.dumps(data))
-
-        self.redis.transaction(set_data_action, _key)
+        if self.data_fields:
+            args = [DATA_FIELD_PREFIX + str(key), json.dumps(value)]
+            result = self._write(_key, lambda client: self._run_script(client, self._set_data_script, _key, args))
+        else:
+            result = self._change_data(_key, lambda data: data.update({key: value}))
+        if not result:
+            raise RuntimeError(f"RedisStorage: key {_key} does not exist.")
         return True
 
     def get_data(
@@ -201,8 +641,9 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-        data = self.redis.hget(_key, "data")
-        return json.loads(data) if data else {}
+        if self.cache is not None:
+            return decode_data(self._get_fields(_key))
+        return decode_data(self.redis.hgetall(_key))
 
     def reset_data(
         self,
@@ -221,16 +662,8 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
-
-        def reset_data_action(pipe):
-            pipe.multi()
-            if pipe.exists(_key):
-                pipe.hset(_key, "data", "{}")
-            else:
-                return False
-
-        self.redis.transaction(reset_data_action, _key)
-        return True
+        args = self._encode_data({})
+        return bool(self._write(_key, lambda client: self._run_script(client, self._replace_data_script, _key, args)))
 
     def get_interactive_data(
         self,
@@ -267,16 +700,118 @@ class StateRedisStorage(StateStorageBase):
             message_thread_id,
             bot_id,
         )
+        args = self._encode_data(data)
+        return bool(self._write(_key, lambda client: self._run_script(client, self._replace_data_script, _key, args)))
 
-        def save_action(pipe):
-            pipe.multi()
-            if pipe.exists(_key):
-                pipe.hset(_key, "data", json.dumps(data))
-            else:
-                return False
+    def update_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        changed: dict,
+        removed: list,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        _key = self._get_key(
+            chat_id,
+            user_id,
+            self.prefix,
+            self.separator,
+            business_connection_id,
+            message_thread_id,
+            bot_id,
+        )
+        if not self.data_fields:
+            def change(data):
+                data.update(changed)
+                for name in removed:
+                    data.pop(name, None)
+            return self._change_data(_key, change)
+
+        args = encode_data_changes(changed, removed)
+        result = self._write(_key, lambda client: self._run_script(client, self._update_data_script, _key, args))
+        if result == -1:
+            # data saved by an older version, it is converted to fields by save()
+            return super().update_data(
+                chat_id, user_id, changed, removed, business_connection_id, message_thread_id, bot_id
+            )
+        return bool(result)
 
-        self.redis.transaction(save_action, _key)
-        return True
+    def get_states(
+        self,
+        chat_user_ids: List[Tuple[int, int]],
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> List[Union[str, None]]:
+        """
+        Get the states of many users in one round trip.
+
+        :param chat_user_ids: (chat_id, user_id) pairs
+        :type chat_user_ids: List[Tuple[int, int]]
+
+        :return: States in the order of chat_user_ids, None for users without a state.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for chat_id, user_id in chat_user_ids:
+            pipe.hget(
+                self._get_key(
+                    chat_id,
+                    user_id,
+                    self.prefix,
+                    self.separator,
+                    business_connection_id,
+                    message_thread_id,
+                    bot_id,
+                ),
+                "state",
+            )
+        return [state.decode("utf-8") if state else None for state in pipe.execute()]
+
+    def delete_states_for_chat(self, chat_id: int, bot_id: Optional[int] = None) -> int:
+        self._check_indexes()
+        members = list(self.redis.smembers(self._scope_index_key(chat_id, bot_id)))
+        if not members:
+            return 0
+        records = [self._member_key(member) for member in members]
+        keys = [key for _, key in records]
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(*keys)
+        for member, (user, _) in zip(members, records):
+            for index_key in self._index_keys(user[0], user[4]):
+                pipe.srem(index_key, member)
+        if self.cache is not None:
+            for key in keys:
+                pipe.publish(self.invalidation_channel, key)
+        try:
+            return pipe.execute()[0]
+        finally:
+            if self.cache is not None:
+                for key in keys:
+                    self.cache.invalidate(key)
+
+    def count_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> int:
+        self._check_indexes()
+        return self.redis.scard(self._scope_index_key(chat_id, bot_id))
+
+    def iter_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> Iterator[tuple]:
+        self._check_indexes()
+        # SSCAN may return a member more than once
+        members = list(set(self.redis.sscan_iter(self._scope_index_key(chat_id, bot_id), count=100)))
+        for start in range(0, len(members), 100):
+            yield from self._get_indexed_states(members[start:start + 100])
+
+    def _get_indexed_states(self, members: Iterable) -> Iterator[tuple]:
+        users = []
+        pipe = self.redis.pipeline(transaction=False)
+        for member in members:
+            user, key = self._member_key(member)
+            users.append(user)
+            pipe.hget(key, "state")
+        for user, state in zip(users, pipe.execute()):
+            if state is not None:
+                yield (*user, state.decode("utf-8") if isinstance(state, bytes) else state)
 
     def migrate_format(self, bot_id: int, prefix: Optional[str] = "telebot_"):
         """
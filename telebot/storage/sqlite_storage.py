@@ -0,0 +1,327 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Optional, Union, Callable, Iterator, Tuple
+
+from telebot.storage.base_storage import StateStorageBase, StateDataContext
+
+
+def with_lock(func: Callable) -> Callable:
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
+
+class StateSQLiteStorage(StateStorageBase):
+    """
+    State storage based on an SQLite database.
+
+    States are stored in one row per user, keyed by
+    (bot_id, business_connection_id, message_thread_id, chat_id, user_id), and keep their type,
+    so a state set as an int is read back as an int.
+    Data values are stored as JSON in one row per key in the "<table>_data" table,
+    so changing a value or leaving :meth:`get_interactive_data` only writes the changed keys.
+    The database uses WAL mode, so reads do not block writes. A pickled storage is reopened from
+    its file, so several processes can share the states.
+    Both tables have an index on (chat_id, bot_id), so :meth:`delete_states_for_chat`,
+    :meth:`count_states` and :meth:`iter_states` only visit the matching rows, for one bot or
+    for any bot.
+
+    .. code-block:: python3
+
+        storage = StateSQLiteStorage()
+        bot = TeleBot(token, state_storage=storage)
+
+    :param file_path: Path to the database file, default is "./.state-save/states.db".
+    :type file_path: str
+
+    :param table: Name of the table for states, default is "telebot_states".
+    :type table: Optional[str]
+    """
+
+    def __init__(
+        self,
+        file_path: str = "./.state-save/states.db",
+        table: Optional[str] = "telebot_states",
+    ) -> None:
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", table or ""):
+            raise ValueError("Table name must be a valid identifier")
+
+        self.file_path = file_path
+        self.table = table
+        self.lock = threading.Lock()
+
+        dirs = os.path.dirname(file_path)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        # the state column has BLOB affinity, which stores values as they are: with TEXT affinity
+        # a state 1 would be read back as "1" and never match
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "bot_id INTEGER NOT NULL, business_connection_id TEXT NOT NULL, message_thread_id INTEGER NOT NULL, "
+            "chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, state BLOB, "
+            "PRIMARY KEY (bot_id, business_connection_id, message_thread_id, chat_id, user_id)) WITHOUT ROWID"
+        )
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table}_data ("
+            "bot_id INTEGER NOT NULL, business_connection_id TEXT NOT NULL, message_thread_id INTEGER NOT NULL, "
+            "chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (bot_id, business_connection_id, message_thread_id, chat_id, user_id, name)) WITHOUT ROWID"
+        )
+        self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_chat ON {table} (chat_id, bot_id)")
+        self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_data_chat ON {table}_data (chat_id, bot_id)")
+
+        # statements are compiled once and reused from the connection's statement cache
+        columns = "bot_id, business_connection_id, message_thread_id, chat_id, user_id"
+        where = "bot_id = ? AND business_connection_id = ? AND message_thread_id = ? AND chat_id = ? AND user_id = ?"
+        self._set_state_sql = (
+            f"INSERT INTO {table} ({columns}, state) VALUES (?, ?, ?, ?, ?, ?) "
+            f"ON CONFLICT ({columns}) DO UPDATE SET state = excluded.state"
+        )
+        self._get_state_sql = f"SELECT state FROM {table} WHERE {where}"
+        self._get_data_sql = f"SELECT name, value FROM {table}_data WHERE {where}"
+        self._delete_sql = f"DELETE FROM {table} WHERE {where}"
+        self._set_value_sql = (
+            f"INSERT INTO {table}_data ({columns}, name, value) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            f"ON CONFLICT ({columns}, name) DO UPDATE SET value = excluded.value"
+        )
+        self._delete_value_sql = f"DELETE FROM {table}_data WHERE {where} AND name = ?"
+        self._delete_values_sql = f"DELETE FROM {table}_data WHERE {where}"
+        # completed by _scope_sql
+        self._delete_chat_sql = f"DELETE FROM {table}"
+        self._delete_chat_values_sql = f"DELETE FROM {table}_data"
+        self._list_sql = (
+            f"SELECT chat_id, user_id, business_connection_id, message_thread_id, bot_id, state FROM {table}"
+        )
+        self._count_sql = f"SELECT COUNT(*) FROM {table}"
+
+    def __reduce__(self):
+        # reopened by file path, e.g. in the child processes of process handlers
+        return type(self), (self.file_path, self.table)
+
+    @staticmethod
+    def _key_params(
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> tuple:
+        # missing parts are stored as 0 or "" because NULLs are never equal in a primary key
+        return bot_id or 0, business_connection_id or "", message_thread_id or 0, chat_id, user_id
+
+    @with_lock
+    def set_state(
+        self,
+        chat_id: int,
+        user_id: int,
+        state: str,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        if hasattr(state, "name"):
+            state = state.name
+
+        params = self._key_params(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        self.connection.execute(self._set_state_sql, params + (state,))
+        return True
+
+    @with_lock
+    def get_state(
+        self,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> Union[str, None]:
+        params = self._key_params(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        row = self.connection.execute(self._get_state_sql, params).fetchone()
+        return row[0] if row else None
+
+    @contextmanager
+    def _transaction(self):
+        # must be called with the lock held
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def _exists(self, params: tuple) -> bool:
+        # must be called with the lock held
+        return self.connection.execute(self._get_state_sql, params).fetchone() is not None
+
+    @with_lock
+    def delete_state(
+        self,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        params = self._key_params(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._transaction():
+            self.connection.execute(self._delete_values_sql, params)
+            return self.connection.execute(self._delete_sql, params).rowcount > 0
+
+    @with_lock
+    def set_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        key: str,
+        value: Union[str, int, float, dict],
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        params = self._key_params(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._transaction():
+            if not self._exists(params):
+                raise RuntimeError(f"StateSQLiteStorage: key {params} does not exist.")
+            self.connection.execute(self._set_value_sql, params + (str(key), json.dumps(value)))
+        return True
+
+    @with_lock
+    def get_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> dict:
+        params = self._key_params(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        rows = self.connection.execute(self._get_data_sql, params).fetchall()
+        return {name: json.loads(value) for name, value in rows}
+
+    @with_lock
+    def reset_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        params = self._key_params(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._transaction():
+            if not self._exists(params):
+                return False
+            self.connection.execute(self._delete_values_sql, params)
+        return True
+
+    def get_interactive_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> Optional[dict]:
+        return StateDataContext(
+            self,
+            chat_id=chat_id,
+            user_id=user_id,
+            business_connection_id=business_connection_id,
+            message_thread_id=message_thread_id,
+            bot_id=bot_id,
+        )
+
+    @with_lock
+    def save(
+        self,
+        chat_id: int,
+        user_id: int,
+        data: dict,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        params = self._key_params(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._transaction():
+            if not self._exists(params):
+                return False
+            self.connection.execute(self._delete_values_sql, params)
+            self.connection.executemany(
+                self._set_value_sql, [params + (str(name), json.dumps(value)) for name, value in data.items()]
+            )
+        return True
+
+    @with_lock
+    def update_data(
+        self,
+        chat_id: int,
+        user_id: int,
+        changed: dict,
+        removed: list,
+        business_connection_id: Optional[str] = None,
+        message_thread_id: Optional[int] = None,
+        bot_id: Optional[int] = None,
+    ) -> bool:
+        params = self._key_params(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._transaction():
+            if not self._exists(params):
+                return False
+            self.connection.executemany(self._delete_value_sql, [params + (str(name),) for name in removed])
+            self.connection.executemany(
+                self._set_value_sql, [params + (str(name), json.dumps(value)) for name, value in changed.items()]
+            )
+        return True
+
+    @staticmethod
+    def _scope_sql(sql: str, chat_id: Optional[int], bot_id: Optional[int]) -> Tuple[str, tuple]:
+        """
+        Completes a bulk operation with the conditions selecting a chat and a bot; None matches any.
+        """
+        conditions, params = [], []
+        if chat_id is not None:
+            conditions.append("chat_id = ?")
+            params.append(chat_id)
+        if bot_id is not None:
+            # states without a bot are stored with bot_id 0
+            conditions.append("bot_id = ?")
+            params.append(bot_id)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql, tuple(params)
+
+    @with_lock
+    def delete_states_for_chat(self, chat_id: int, bot_id: Optional[int] = None) -> int:
+        with self._transaction():
+            self.connection.execute(*self._scope_sql(self._delete_chat_values_sql, chat_id, bot_id))
+            return self.connection.execute(*self._scope_sql(self._delete_chat_sql, chat_id, bot_id)).rowcount
+
+    @with_lock
+    def count_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> int:
+        return self.connection.execute(*self._scope_sql(self._count_sql, chat_id, bot_id)).fetchone()[0]
+
+    def iter_states(self, chat_id: Optional[int] = None, bot_id: Optional[int] = None) -> Iterator[tuple]:
+        with self.lock:
+            rows = self.connection.execute(*self._scope_sql(self._list_sql, chat_id, bot_id)).fetchall()
+        for row_chat_id, user_id, business_connection_id, message_thread_id, row_bot_id, state in rows:
+            # missing key parts are stored as 0 or ""
+            yield row_chat_id, user_id, business_connection_id or None, message_thread_id or None, row_bot_id or None, state
+
+    @with_lock
+    def close(self) -> None:
+        """
+        Close the database connection.
+        """
+        self.connection.close()
+
+    def __str__(self) -> str:
+        return f"StateSQLiteStorage({self.file_path}, {self.table})"
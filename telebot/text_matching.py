@@ -0,0 +1,369 @@
+"""
+Multi-pattern text matching for handler filters.
+
+A :class:`TextMatcher` collects the text predicates of a handler list (``regexp``
+filters and the built-in ``text``, ``text_contains`` and ``text_startswith`` custom
+filters) and compiles them into:
+
+* one combined regular expression for all ``regexp`` filters,
+* an Aho-Corasick automaton for all "contains" keywords,
+* prefix and suffix tries for all "starts with" / "ends with" strings,
+* a dict for all "equals" strings.
+
+Each structure is evaluated at most once per text, however many handlers use it.
+Filter values are only compiled if the predicate gives the same result as the custom
+filter of the bot (:mod:`telebot.custom_filters` or :mod:`telebot.asyncio_filters`, which
+differ in how ``TextFilter`` ignores case); other values are tested as before.
+
+:meta private:
+"""
+import re
+from collections import deque
+from typing import Callable, Dict, List, Optional, Set
+
+from telebot import types
+
+#: Marks a filter of a :class:`telebot.handler_index.HandlerEntry` which was compiled by a
+#: :class:`TextMatcher`. The filter value of such a filter is a predicate taking the dispatch context.
+COMPILED_FILTER = object()
+
+#: Returned by a compiled predicate for an object without a text it could look at. The bot tests
+#: the filter as given to the handler then, which :class:`telebot.handler_index.HandlerIndex`
+#: keeps in the ``uncompiled`` attribute of the predicate as a (filter key, filter value) pair.
+UNCOMPILED = object()
+
+_END = None
+
+# Patterns which can't be safely embedded into the combined expression:
+# back references, named groups, conditional group references and inline global flags.
+_UNSAFE_PATTERN = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(|^\(\?[aiLmsux]+\)')
+
+
+class _AhoCorasick:
+    """
+    Aho-Corasick automaton: finds all keywords contained in a text in a single pass.
+    """
+
+    def __init__(self, words: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[int]] = [[]]
+        self.always: List[int] = []
+
+        for word_id, word in enumerate(words):
+            if not word:
+                # empty string is contained in any text
+                self.always.append(word_id)
+                continue
+            state = 0
+            for char in word:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.out[state].append(word_id)
+
+        # breadth-first, so that fail links always point to already processed states
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                if state == 0:
+                    continue
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    def find(self, text: str) -> Set[int]:
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set(self.always)
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class _Trie:
+    """
+    Trie that finds all stored words which are prefixes of a text.
+    """
+
+    def __init__(self, words: List[str]):
+        self.root: dict = {}
+        for word_id, word in enumerate(words):
+            node = self.root
+            for char in word:
+                node = node.setdefault(char, {})
+            node.setdefault(_END, []).append(word_id)
+
+    def find(self, chars) -> Set[int]:
+        node = self.root
+        found = set(node.get(_END, ()))
+        for char in chars:
+            node = node.get(char)
+            if node is None:
+                break
+            if _END in node:
+                found.update(node[_END])
+        return found
+
+
+class _KeywordSet:
+    """
+    Plain string predicates (equals / contains / starts with / ends with) of one case mode.
+    """
+
+    KINDS = ('equals', 'contains', 'starts_with', 'ends_with')
+
+    def __init__(self):
+        self.words: Dict[str, Dict[str, int]] = {kind: {} for kind in self.KINDS}
+        self.finders: Dict[str, Callable[[str], Set[int]]] = {}
+
+    def add(self, kind: str, word: str) -> int:
+        words = self.words[kind]
+        return words.setdefault(word, len(words))
+
+    def build(self):
+        equals = self.words['equals']
+        self.finders = {
+            'equals': lambda text: {equals[text]} if text in equals else set(),
+            'contains': _AhoCorasick(list(self.words['contains'])).find,
+            'starts_with': _Trie(list(self.words['starts_with'])).find,
+            'ends_with': lambda text, trie=_Trie([w[::-1] for w in self.words['ends_with']]): trie.find(reversed(text)),
+        }
+
+
+class _RegexSet:
+    """
+    Regular expressions searched with re.IGNORECASE, combined into a single expression where possible.
+    """
+
+    def __init__(self):
+        self.patterns: Dict[str, int] = {}
+        self.combined = None
+        self.groups: List[tuple] = []
+        self.separate: List[tuple] = []
+
+    def add(self, pattern: str) -> int:
+        return self.patterns.setdefault(pattern, len(self.patterns))
+
+    def build(self):
+        combined = []
+        for pattern, pattern_id in self.patterns.items():
+            if _UNSAFE_PATTERN.search(pattern):
+                self.separate.append((pattern_id, pattern))
+            else:
+                combined.append((pattern_id, pattern))
+        if not combined:
+            return
+        try:
+            self.combined = re.compile(
+                '^' + ''.join('(?:(?=[\\s\\S]*?(?P<_tm{0}>{1})))?'.format(pattern_id, pattern)
+                              for pattern_id, pattern in combined),
+                re.IGNORECASE)
+        except re.error:
+            # searched one by one, invalid patterns raise on use as before
+            self.separate.extend(combined)
+            return
+        self.groups = [(pattern_id, self.combined.groupindex['_tm{0}'.format(pattern_id)] - 1)
+                       for pattern_id, _ in combined]
+
+    def find(self, text: str) -> Set[int]:
+        found = set()
+        if self.combined is not None:
+            values = self.combined.match(text).groups()
+            found.update(pattern_id for pattern_id, group in self.groups if values[group] is not None)
+        for pattern_id, pattern in self.separate:
+            if re.search(pattern, text, re.IGNORECASE):
+                found.add(pattern_id)
+        return found
+
+
+def _filter_text(obj) -> Optional[str]:
+    """
+    Text that :class:`telebot.custom_filters.TextFilter` checks for obj.
+    """
+    if isinstance(obj, types.Poll):
+        return obj.question
+    elif isinstance(obj, types.Message):
+        return obj.text or obj.caption
+    elif isinstance(obj, types.CallbackQuery):
+        return obj.data
+    elif isinstance(obj, types.InlineQuery):
+        return obj.query
+    return None
+
+
+def _as_words(value) -> Optional[list]:
+    # like TextContainsFilter, which skips the items that are not strings
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [i for i in value if isinstance(i, str)]
+    return None
+
+
+def _all_str(values) -> bool:
+    return all(isinstance(value, str) for value in values)
+
+
+class TextMatcher:
+    """
+    Compiles text predicates of a handler list; see module documentation.
+
+    Predicates are registered with the ``compile_*`` methods, which return a callable
+    taking the dispatch context (any object with ``message`` and ``text_matches``
+    attributes, the latter being a dict used as per-update cache) or None if the
+    filter value can't be compiled. :meth:`build` must be called before predicates are used.
+
+    :meta private:
+
+    :param asynchronous: Compile the filters of :mod:`telebot.asyncio_filters` instead of
+        :mod:`telebot.custom_filters`
+    """
+
+    def __init__(self, asynchronous: bool = False):
+        self.asynchronous = asynchronous
+        self.regexps = _RegexSet()
+        self.exact = _KeywordSet()
+        self.folded = _KeywordSet()
+
+    def build(self):
+        self.regexps.build()
+        self.exact.build()
+        self.folded.build()
+
+    def _find(self, context, keywords: _KeywordSet, kind: str, text: str) -> Set[int]:
+        key = (id(keywords), kind, text)
+        found = context.text_matches.get(key)
+        if found is None:
+            found = context.text_matches[key] = keywords.finders[kind](text)
+        return found
+
+    def _find_regexps(self, context, text: str) -> Set[int]:
+        key = (id(self.regexps), text)
+        found = context.text_matches.get(key)
+        if found is None:
+            found = context.text_matches[key] = self.regexps.find(text)
+        return found
+
+    def compile_regexp(self, pattern) -> Optional[Callable]:
+        """
+        Compiles the ``regexp`` filter.
+        """
+        if not isinstance(pattern, str):
+            return None
+        pattern_id = self.regexps.add(pattern)
+
+        def predicate(context):
+            message = context.message
+            if message.content_type != 'text':
+                return False
+            if not isinstance(message.text, str):
+                return UNCOMPILED
+            return pattern_id in self._find_regexps(context, message.text)
+        return predicate
+
+    def compile_text_contains(self, value) -> Optional[Callable]:
+        """
+        Compiles :class:`telebot.custom_filters.TextContainsFilter`.
+        """
+        words = _as_words(value)
+        if words is None:
+            return None
+        ids = frozenset(self.exact.add('contains', word) for word in words)
+
+        def predicate(context):
+            text = context.message.text
+            if not isinstance(text, str):
+                return UNCOMPILED
+            return not ids.isdisjoint(self._find(context, self.exact, 'contains', text))
+        return predicate
+
+    def compile_text_startswith(self, value) -> Optional[Callable]:
+        """
+        Compiles :class:`telebot.custom_filters.TextStartsFilter`.
+        """
+        # str.startswith takes a string or a tuple of strings
+        if isinstance(value, str):
+            words = [value]
+        elif isinstance(value, tuple) and _all_str(value):
+            words = value
+        else:
+            return None
+        ids = frozenset(self.exact.add('starts_with', word) for word in words)
+
+        def predicate(context):
+            text = context.message.text
+            if not isinstance(text, str):
+                return UNCOMPILED
+            return not ids.isdisjoint(self._find(context, self.exact, 'starts_with', text))
+        return predicate
+
+    def compile_text(self, value) -> Optional[Callable]:
+        """
+        Compiles :class:`telebot.custom_filters.TextMatchFilter` (value: str, list of str or TextFilter).
+        """
+        if isinstance(value, str):
+            return lambda context: context.message.text == value
+        # the async filter only takes a list as such, not a subclass of it
+        if type(value) is list or (isinstance(value, list) and not self.asynchronous):
+            # the filter compares the text with each item, so only strings can match it
+            if not _all_str(value):
+                return None
+            words = frozenset(value)
+            return lambda context: context.message.text in words
+        if self.asynchronous:
+            from telebot.asyncio_filters import TextFilter
+        else:
+            from telebot.custom_filters import TextFilter
+        # subclasses may check differently
+        if type(value) is not TextFilter:
+            return None
+        return self._compile_text_filter(value)
+
+    def _compile_text_filter(self, text_filter) -> Optional[Callable]:
+        ignore_case = text_filter.ignore_case
+        keywords = self.folded if ignore_case else self.exact
+        kinds = []
+        for kind in _KeywordSet.KINDS:
+            words = getattr(text_filter, kind)
+            if not words:
+                continue
+            if kind == 'equals':
+                if not isinstance(words, str):
+                    return None
+                words = [words]
+            elif not isinstance(words, (list, tuple)) or not _all_str(words):
+                return None
+            kinds.append((kind, words))
+        if ignore_case:
+            # custom_filters.TextFilter only lowers the words of its first check,
+            # asyncio_filters.TextFilter lowers all of them
+            lowered = len(kinds) if self.asynchronous else 1
+            kinds = [(kind, [word.lower() for word in words]) if i < lowered else (kind, words)
+                     for i, (kind, words) in enumerate(kinds)]
+        checks = [(kind, frozenset(keywords.add(kind, word) for word in words)) for kind, words in kinds]
+
+        def predicate(context):
+            text = _filter_text(context.message)
+            if not isinstance(text, str):
+                return UNCOMPILED
+            if ignore_case:
+                text = text.lower()
+            for kind, ids in checks:
+                if not ids.isdisjoint(self._find(context, keywords, kind, text)):
+                    return True
+            return False
+        return predicate
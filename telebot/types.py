@@ -207,43 +207,37 @@ class Update(JsonDeserializable):
     :rtype: :class:`telebot.types.Update`
 
     """
+    #: Optional update fields and the names of the types they are decoded to.
+    _field_types = {
+        'message': 'Message', 'edited_message': 'Message', 'channel_post': 'Message',
+        'edited_channel_post': 'Message', 'inline_query': 'InlineQuery', 'chosen_inline_result': 'ChosenInlineResult',
+        'callback_query': 'CallbackQuery', 'shipping_query': 'ShippingQuery', 'pre_checkout_query': 'PreCheckoutQuery',
+        'poll': 'Poll', 'poll_answer': 'PollAnswer', 'my_chat_member': 'ChatMemberUpdated',
+        'chat_member': 'ChatMemberUpdated', 'chat_join_request': 'ChatJoinRequest',
+        'message_reaction': 'MessageReactionUpdated', 'message_reaction_count': 'MessageReactionCountUpdated',
+        'removed_chat_boost': 'ChatBoostRemoved', 'chat_boost': 'ChatBoostUpdated',
+        'business_connection': 'BusinessConnection', 'business_message': 'Message',
+        'edited_business_message': 'Message', 'deleted_business_messages': 'BusinessMessagesDeleted',
+        'purchased_paid_media': 'PaidMediaPurchased', 'managed_bot': 'ManagedBotUpdated', 'guest_message': 'Message',
+        'subscription': 'BotSubscriptionUpdated',
+    }
+
     @classmethod
     def de_json(cls, json_string):
         if json_string is None: return None
         obj = cls.check_json(json_string, dict_copy=False)
-        update_id = obj['update_id']
-        message = Message.de_json(obj.get('message'))
-        edited_message = Message.de_json(obj.get('edited_message'))
-        channel_post = Message.de_json(obj.get('channel_post'))
-        edited_channel_post = Message.de_json(obj.get('edited_channel_post'))
-        inline_query = InlineQuery.de_json(obj.get('inline_query'))
-        chosen_inline_result = ChosenInlineResult.de_json(obj.get('chosen_inline_result'))
-        callback_query = CallbackQuery.de_json(obj.get('callback_query'))
-        shipping_query = ShippingQuery.de_json(obj.get('shipping_query'))
-        pre_checkout_query = PreCheckoutQuery.de_json(obj.get('pre_checkout_query'))
-        poll = Poll.de_json(obj.get('poll'))
-        poll_answer = PollAnswer.de_json(obj.get('poll_answer'))
-        my_chat_member = ChatMemberUpdated.de_json(obj.get('my_chat_member'))
-        chat_member = ChatMemberUpdated.de_json(obj.get('chat_member'))
-        chat_join_request = ChatJoinRequest.de_json(obj.get('chat_join_request'))
-        message_reaction = MessageReactionUpdated.de_json(obj.get('message_reaction'))
-        message_reaction_count = MessageReactionCountUpdated.de_json(obj.get('message_reaction_count'))
-        removed_chat_boost = ChatBoostRemoved.de_json(obj.get('removed_chat_boost'))
-        chat_boost = ChatBoostUpdated.de_json(obj.get('chat_boost'))
-        business_connection = BusinessConnection.de_json(obj.get('business_connection'))
-        business_message = Message.de_json(obj.get('business_message'))
-        edited_business_message = Message.de_json(obj.get('edited_business_message'))
-        deleted_business_messages = BusinessMessagesDeleted.de_json(obj.get('deleted_business_messages'))
-        purchased_paid_media = PaidMediaPurchased.de_json(obj.get('purchased_paid_media'))
-        managed_bot = ManagedBotUpdated.de_json(obj.get('managed_bot'))
-        guest_message = Message.de_json(obj.get('guest_message'))
-        subscription = BotSubscriptionUpdated.de_json(obj.get('subscription'))
-
-        return cls(update_id, message, edited_message, channel_post, edited_channel_post, inline_query,
-                   chosen_inline_result, callback_query, shipping_query, pre_checkout_query, poll, poll_answer,
-                   my_chat_member, chat_member, chat_join_request, message_reaction, message_reaction_count,
-                   removed_chat_boost, chat_boost, business_connection, business_message, edited_business_message,
-                   deleted_business_messages, purchased_paid_media, managed_bot, guest_message, subscription)
+        fields = dict.fromkeys(cls._field_types)
+        present = []
+        # only the fields that are present are decoded, usually there is exactly one
+        for field, value in obj.items():
+            type_name = cls._field_types.get(field)
+            if type_name is not None and value is not None:
+                fields[field] = globals()[type_name].de_json(value)
+                present.append(field)
+        update = cls(obj['update_id'], **fields)
+        # used by the bots to route the update without testing every field
+        update._update_types = tuple(present)
+        return update
 
     def __init__(self, update_id, message, edited_message, channel_post, edited_channel_post, inline_query,
                  chosen_inline_result, callback_query, shipping_query, pre_checkout_query, poll, poll_answer,
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import re
 import threading
+import time
 import traceback
+from concurrent.futures import Executor, Future
 from typing import Any, Callable, List, Dict, Optional, Union
 import hmac
 from hashlib import sha256
@@ -123,22 +125,157 @@ class WorkerThread(threading.Thread):
         self._running = False
 
 
+class QueueStats:
+    """
+    Depth and wait time statistics of a task queue, also used to limit its size.
+
+    Wait time is the time between putting a task and a worker starting it.
+
+    :meta private:
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.put_count = 0
+        self.started_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+        self.average_wait = 0.0
+        self.blocked_count = 0
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def task_put(self, limit: int = 0):
+        """
+        Counts a new task. If `limit` is set, blocks while `limit` tasks are waiting.
+        """
+        with self._condition:
+            if limit and self.depth >= limit and not self._closed:
+                self.blocked_count += 1
+                while self.depth >= limit and not self._closed:
+                    self._condition.wait()
+            self.depth += 1
+            self.put_count += 1
+            if self.depth > self.max_depth:
+                self.max_depth = self.depth
+
+    def task_started(self, wait: float):
+        with self._condition:
+            self.depth -= 1
+            self.started_count += 1
+            self.total_wait += wait
+            self.last_wait = wait
+            if wait > self.max_wait:
+                self.max_wait = wait
+            # exponential moving average, weights roughly the last 20 tasks
+            self.average_wait += (wait - self.average_wait) * 0.1
+            self._condition.notify_all()
+
+    def wait_below(self, limit: int, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until less than `limit` tasks are waiting. Returns False on timeout.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.depth < limit or self._closed, timeout)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def as_dict(self) -> Dict[str, Union[int, float]]:
+        """
+        Returns a snapshot of the statistics.
+        """
+        with self._condition:
+            return {
+                'depth': self.depth,
+                'max_depth': self.max_depth,
+                'put_count': self.put_count,
+                'started_count': self.started_count,
+                'blocked_count': self.blocked_count,
+                'average_wait': self.average_wait,
+                'last_wait': self.last_wait,
+                'max_wait': self.max_wait,
+                'mean_wait': self.total_wait / self.started_count if self.started_count else 0.0,
+            }
+
+
 class ThreadPool:
     """
     :meta private:
+
+    :param telebot: Bot instance
+    :param num_threads: Number of threads
+    :param max_queue_size: Maximum number of waiting tasks, 0 for no limit. Putting a task into
+        a full queue blocks, except from the pool's own workers.
+    :param high_water_mark: Number of waiting tasks from which polling stops requesting new updates,
+        defaults to `max_queue_size`
     """
 
-    def __init__(self, telebot, num_threads=2):
+    #: Whether tasks of one conversation run one after another in the order they were put
+    keeps_chat_order = False
+
+    def __init__(self, telebot, num_threads=2, max_queue_size=0, high_water_mark=None):
         self.telebot = telebot
-        self.tasks = Queue.Queue()
-        self.workers = [WorkerThread(self.on_exception, self.tasks) for _ in range(num_threads)]
         self.num_threads = num_threads
+        self.max_queue_size = max_queue_size
+        self.high_water_mark = max_queue_size if high_water_mark is None else high_water_mark
+        self.stats = QueueStats()
 
         self.exception_event = threading.Event()
         self.exception_info = None
 
+        self.tasks = self._create_queue()
+        self.workers = self._create_workers(num_threads)
+
+    def _create_queue(self):
+        return Queue.Queue()
+
+    def _create_workers(self, num_threads):
+        return [WorkerThread(self.on_exception, self.tasks) for _ in range(num_threads)]
+
+    def add_threads(self, num_threads: int):
+        """
+        Adds `num_threads` workers, e.g. for tasks that wait for another process.
+        """
+        # the list is replaced, not mutated, as other threads iterate over it
+        self.workers = self.workers + self._create_workers(num_threads)
+        self.num_threads += num_threads
+
     def put(self, func, *args, **kwargs):
-        self.tasks.put((func, args, kwargs))
+        self._put(self.tasks, func, args, kwargs)
+
+    def _put(self, queue, func, args, kwargs):
+        self._reserve()
+        queue.put((self._run_task, (time.monotonic(), func, args, kwargs), {}))
+
+    def _reserve(self):
+        # workers never block on a full queue, that would deadlock the pool
+        self.stats.task_put(0 if self._in_worker() else self.max_queue_size)
+
+    def _in_worker(self) -> bool:
+        return threading.current_thread() in self.workers
+
+    def _run_task(self, put_time, func, args, kwargs):
+        self.stats.task_started(time.monotonic() - put_time)
+        func(*args, **kwargs)
+
+    def is_saturated(self) -> bool:
+        """
+        Checks whether the number of waiting tasks reached the high-water mark.
+        """
+        return bool(self.high_water_mark) and self.stats.depth >= self.high_water_mark
+
+    def wait_for_capacity(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until the number of waiting tasks is below the high-water mark. Returns False on timeout.
+        """
+        if not self.high_water_mark:
+            return True
+        return self.stats.wait_below(self.high_water_mark, timeout)
 
     def on_exception(self, worker_thread, exc_info):
         if self.telebot.exception_handler is not None:
@@ -158,6 +295,7 @@ class ThreadPool:
         self.exception_event.clear()
 
     def close(self):
+        self.stats.close()
         for worker in self.workers:
             worker.stop()
         for worker in self.workers:
@@ -165,6 +303,326 @@ class ThreadPool:
                 worker.join()
 
 
+class FuturesThreadPool(ThreadPool, Executor):
+    """
+    Lightweight thread pool, also usable as :class:`concurrent.futures.Executor`.
+
+    Idle workers block on a :class:`queue.SimpleQueue` instead of waking up every 0.5 seconds,
+    shutdown is signalled by a sentinel per worker, and tasks don't reset per-worker events.
+    Tasks put by the bot report exceptions through `exception_event` like :class:`ThreadPool`;
+    :meth:`submit` returns a future that receives the result or exception instead.
+    After :meth:`shutdown`, also while blocked on a full queue, :meth:`submit` raises RuntimeError;
+    ``cancel_futures=True`` drops the waiting tasks, cancels their futures and logs how many
+    tasks of the bot were dropped.
+
+    :meta private:
+
+    :param telebot: Bot instance
+    :param num_threads: Number of threads
+    :param kwargs: Queue limits, see :class:`ThreadPool`
+    """
+
+    def __init__(self, telebot, num_threads=2, **kwargs):
+        self._shutdown = False
+        self._shutdown_lock = threading.Lock()
+        super().__init__(telebot, num_threads=num_threads, **kwargs)
+
+    def _create_queue(self):
+        return Queue.SimpleQueue()
+
+    def _create_workers(self, num_threads):
+        workers = []
+        for _ in range(num_threads):
+            WorkerThread.count += 1
+            worker = threading.Thread(target=self._work, name="WorkerThread{0}".format(WorkerThread.count), daemon=True)
+            worker.start()
+            workers.append(worker)
+        return workers
+
+    def _work(self):
+        get = self.tasks.get
+        while True:
+            task = get()
+            if task is None:
+                return
+            func, args, kwargs = task
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.debug(type(e).__name__ + " occurred, args=" + str(e.args) + "\n" + traceback.format_exc())
+                self._on_task_exception(e)
+
+    def _on_task_exception(self, exc_info):
+        if self.telebot.exception_handler is not None:
+            handled = self.telebot.exception_handler.handle(exc_info)
+        else:
+            handled = False
+        if not handled:
+            self.exception_info = exc_info
+            self.exception_event.set()
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        """
+        Schedules fn(*args, **kwargs) and returns a :class:`concurrent.futures.Future` for its result.
+        """
+        task = _FutureTask(fn, args, kwargs)
+        with self._shutdown_lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+        # may block while the queue is full, so not under the lock that shutdown needs
+        self.put(task)
+        if self._shutdown:
+            # shut down in the meantime, the task may be behind the workers' sentinels,
+            # so it is cancelled for the workers to skip it
+            task.future.cancel()
+            raise RuntimeError('cannot schedule new futures after shutdown')
+        return task.future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._shutdown_lock:
+            self._shutdown = True
+            self.stats.close()
+            if cancel_futures:
+                self._cancel_waiting_tasks()
+            for _ in self.workers:
+                self.tasks.put(None)
+        if wait:
+            for worker in self.workers:
+                if worker is not threading.current_thread():
+                    worker.join()
+
+    def _cancel_waiting_tasks(self):
+        dropped = 0
+        while True:
+            try:
+                task = self.tasks.get_nowait()
+            except Queue.Empty:
+                break
+            if task is None:
+                continue
+            _, (_, func, _, _), _ = task
+            if isinstance(func, _FutureTask):
+                func.future.cancel()
+            else:
+                dropped += 1
+        if dropped:
+            logger.warning('Worker pool shutdown dropped %s waiting tasks of the bot', dropped)
+
+    def close(self):
+        self.shutdown()
+
+
+class _FutureTask:
+    """
+    Task of :meth:`FuturesThreadPool.submit`, passing the result or exception to its future.
+
+    :meta private:
+    """
+    __slots__ = ('future', 'fn', 'args', 'kwargs')
+
+    def __init__(self, fn, args, kwargs):
+        self.future = Future()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except BaseException as e:
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+
+
+def extract_shard_key(obj) -> Optional[Union[int, str]]:
+    """
+    Returns the key of the conversation `obj` (message, callback query, ...) belongs to:
+    the chat id if there is a chat, else the id of the user, else the business connection id.
+
+    :meta private:
+    """
+    chat = getattr(obj, 'chat', None)
+    if chat is None:
+        chat = getattr(getattr(obj, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    for attr in ('from_user', 'user'):
+        user = getattr(obj, attr, None)
+        if user is not None:
+            return user.id
+    return getattr(obj, 'business_connection_id', None)
+
+
+class ShardedThreadPool(ThreadPool):
+    """
+    Thread pool with one task queue per worker.
+
+    Tasks are routed by the key of their first argument (see :func:`extract_shard_key`),
+    so tasks of one conversation are executed one after another in the order they were
+    put, while different conversations are still processed in parallel. Tasks without
+    a key are distributed round-robin. The bot dispatches each message in a task on its
+    chat's shard, so next step and reply handlers registered by a handler apply to the
+    chat's following messages.
+
+    :meta private:
+
+    :param telebot: Bot instance
+    :param num_threads: Number of shards (and threads)
+    :param shard_key: Function returning the shard key of a task's first argument, defaults to :func:`extract_shard_key`
+    :param kwargs: Queue limits, see :class:`ThreadPool`; they apply to all shards together
+    """
+
+    keeps_chat_order = True
+
+    def __init__(self, telebot, num_threads=2, shard_key: Optional[Callable] = None, **kwargs):
+        self.shard_key = shard_key or extract_shard_key
+        self._next_shard = 0
+        super().__init__(telebot, num_threads=num_threads, **kwargs)
+
+    def _create_workers(self, num_threads):
+        # every worker creates its own queue
+        return [WorkerThread(self.on_exception) for _ in range(num_threads)]
+
+    def add_threads(self, num_threads: int):
+        """
+        Does nothing: more shards would move conversations to other queues while their tasks are waiting.
+        """
+
+    def shard(self, key) -> int:
+        """
+        Returns the index of the queue for `key`.
+        """
+        if key is None:
+            # a lost increment under concurrent puts only affects the distribution
+            self._next_shard = (self._next_shard + 1) % self.num_threads
+            return self._next_shard
+        return hash(key) % self.num_threads
+
+    def put(self, func, *args, **kwargs):
+        key = self.shard_key(args[0]) if args else None
+        self._put(self.workers[self.shard(key)].queue, func, args, kwargs)
+
+
+class ElasticThreadPool(ThreadPool):
+    """
+    Thread pool that grows and shrinks with the load.
+
+    A supervisor thread adds a worker when tasks have been waiting for longer than
+    `target_wait` while all workers are busy, and retires workers that have been idle
+    for `idle_timeout` seconds, keeping between `min_threads` and `max_threads` workers.
+
+    :meta private:
+
+    :param telebot: Bot instance
+    :param num_threads: Minimum number of threads, used if `min_threads` is not set
+    :param min_threads: Minimum number of threads
+    :param max_threads: Maximum number of threads, defaults to 8 times the minimum
+    :param target_wait: Wait time of tasks in seconds from which the pool grows
+    :param idle_timeout: Time in seconds after which idle workers above the minimum are retired
+    :param kwargs: Queue limits, see :class:`ThreadPool`
+    """
+
+    def __init__(self, telebot, num_threads=2, min_threads=None, max_threads=None, target_wait=0.1,
+                 idle_timeout=60, **kwargs):
+        self.min_threads = max(1, num_threads if min_threads is None else min_threads)
+        self.max_threads = max(self.min_threads, max_threads or self.min_threads * 8)
+        self.target_wait = target_wait
+        self.idle_timeout = idle_timeout
+        # guards _busy and _last_active, which are changed by the workers and the supervisor
+        self._lock = threading.Lock()
+        self._busy = set()
+        # only workers in self.workers, retired workers are removed
+        self._last_active: Dict[threading.Thread, float] = {}
+        self._saturated_since = None
+        super().__init__(telebot, num_threads=self.min_threads, **kwargs)
+
+        self._stopped = threading.Event()
+        self._supervisor = threading.Thread(target=self._supervise, name="ElasticThreadPoolSupervisor", daemon=True)
+        self._supervisor.start()
+
+    def _create_workers(self, num_threads):
+        workers = super()._create_workers(num_threads)
+        now = time.monotonic()
+        with self._lock:
+            for worker in workers:
+                self._last_active[worker] = now
+        return workers
+
+    def _in_worker(self) -> bool:
+        # a retired worker can still run a last task, it must not block on a full queue either
+        worker = threading.current_thread()
+        with self._lock:
+            if worker in self._busy:
+                return True
+        return super()._in_worker()
+
+    def _run_task(self, put_time, func, args, kwargs):
+        worker = threading.current_thread()
+        with self._lock:
+            self._busy.add(worker)
+        try:
+            super()._run_task(put_time, func, args, kwargs)
+        finally:
+            with self._lock:
+                self._busy.discard(worker)
+                if worker in self._last_active:
+                    self._last_active[worker] = time.monotonic()
+
+    def _supervise(self):
+        interval = min(max(self.target_wait / 2, 0.01), 1)
+        while not self._stopped.wait(interval):
+            self.scale()
+
+    def add_threads(self, num_threads: int):
+        """
+        Raises the minimum and maximum number of threads by `num_threads`, the supervisor adds the workers.
+        """
+        self.max_threads += num_threads
+        self.min_threads += num_threads
+
+    def scale(self):
+        """
+        Adds or retires workers according to the current load. Called periodically by the supervisor.
+        """
+        now = time.monotonic()
+        workers = self.workers
+        if len(workers) < self.min_threads:
+            self.workers = workers + self._create_workers(self.min_threads - len(workers))
+            return
+        with self._lock:
+            busy = len(self._busy)
+        if self.stats.depth > 0 and busy >= len(workers):
+            if self._saturated_since is None:
+                self._saturated_since = now
+            if now - self._saturated_since >= self.target_wait and len(workers) < self.max_threads:
+                logger.debug("Task wait time exceeds %ss, adding a worker thread", self.target_wait)
+                # the list is replaced, not mutated, as other threads iterate over it
+                self.workers = workers + self._create_workers(1)
+                self._saturated_since = now
+            return
+        self._saturated_since = None
+
+        with self._lock:
+            retired = [worker for worker in workers if worker not in self._busy
+                       and now - self._last_active.get(worker, now) >= self.idle_timeout][:len(workers) - self.min_threads]
+            for worker in retired:
+                self._last_active.pop(worker, None)
+        if retired:
+            logger.debug("Retiring %s idle worker threads", len(retired))
+            for worker in retired:
+                worker.stop()
+            self.workers = [worker for worker in workers if worker not in retired]
+
+    def close(self):
+        self._stopped.set()
+        if self._supervisor is not threading.current_thread():
+            self._supervisor.join()
+        super().close()
+
+
 class AsyncTask:
     """
     :meta private:
@@ -0,0 +1,52 @@
+"""
+Throughput benchmark of the worker pools used by TeleBot(threaded=True).
+
+Run with ``python tests/benchmark_worker_pool.py [tasks] [threads]``. For each pool class
+it puts `tasks` no-op tasks (dispatch overhead only) and `tasks` tasks releasing the GIL
+for 0.1 ms (I/O-bound handlers), and reports the time until all tasks are done.
+"""
+import sys
+
+sys.path.append('../')
+
+import threading
+import time
+
+import telebot
+from telebot import util
+
+POOLS = (util.ThreadPool, util.ShardedThreadPool, util.ElasticThreadPool, util.FuturesThreadPool)
+
+
+def run(pool_class, tasks, threads, work):
+    bot = telebot.TeleBot('1234:test', num_threads=threads, worker_pool_class=pool_class)
+    pool = bot.worker_pool
+    done = threading.Semaphore(0)
+
+    def task(number):
+        if work:
+            time.sleep(work)
+        done.release()
+
+    start = time.perf_counter()
+    for number in range(tasks):
+        pool.put(task, number)
+    for _ in range(tasks):
+        done.acquire()
+    elapsed = time.perf_counter() - start
+    pool.close()
+    return elapsed
+
+
+def main():
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print('{0} tasks, {1} threads'.format(tasks, threads))
+    print('{0:<20} {1:>14} {2:>14}'.format('pool', 'no-op [ms]', '0.1 ms I/O [ms]'))
+    for pool_class in POOLS:
+        results = [run(pool_class, tasks, threads, work) * 1000 for work in (0, 0.0001)]
+        print('{0:<20} {1:>14.1f} {2:>14.1f}'.format(pool_class.__name__, *results))
+
+
+if __name__ == '__main__':
+    main()
@@ -194,3 +194,28 @@ def test_async_antiflood_final_attempt_propagates_after_budget_exhausted():
     assert calls["n"] == budget, (
         f"Expected {budget} total attempts, got {calls['n']}"
     )
+
+
+def test_process_new_updates_dispatches_removed_chat_boost():
+    """AsyncTeleBot dispatches removed_chat_boost updates to their handlers, like TeleBot.
+
+    Before the update routing table, the updates were collected but never processed.
+    """
+    bot = AsyncTeleBot("1:fake", validate_token=False)
+    removed = []
+
+    @bot.removed_chat_boost_handler()
+    async def handle(boost):
+        removed.append(boost.boost_id)
+
+    update = types.Update.de_json({
+        "update_id": 1,
+        "removed_chat_boost": {
+            "chat": {"id": -100, "type": "channel", "title": "Channel"},
+            "boost_id": "boost",
+            "remove_date": 1700000000,
+            "source": {"source": "premium", "user": {"id": 10, "is_bot": False, "first_name": "User"}},
+        },
+    })
+    asyncio.run(bot.process_new_updates([update]))
+    assert removed == ["boost"]
@@ -5,16 +5,17 @@ sys.path.append('../')
 REDIS_TESTS = False
 
 import os
+import pickle
 import time
 
 import pytest
 
 import telebot
 from telebot import types
-from telebot.handler_backends import MemoryHandlerBackend, FileHandlerBackend
+from telebot.handler_backends import MemoryHandlerBackend, FileHandlerBackend, SQLiteHandlerBackend, MemoryUpdateDeduplicator
 
 if REDIS_TESTS:
-    from telebot.handler_backends import RedisHandlerBackend
+    from telebot.handler_backends import RedisHandlerBackend, RedisUpdateDeduplicator
 
 
 @pytest.fixture()
@@ -183,6 +184,60 @@ def test_memory_handler_backend_clear_reply_handler(telegram_bot, private_chat,
     assert reply_to_message_update_type.message.text == 'entered start'
 
 
+def test_next_step_handlers_consume_consecutive_messages(telegram_bot, user):
+    received = []
+    for chat_id in (1, 2):
+        telegram_bot.register_next_step_handler_by_chat_id(chat_id, lambda message: received.append(message.chat.id))
+    telegram_bot.register_message_handler(lambda message: received.append(('handler', message.chat.id)))
+
+    messages = [types.Message(1, user, None, types.Chat(chat_id, 'private'), 'text', {'text': 'hi'}, '')
+                for chat_id in (1, 2, 3)]
+    telegram_bot.process_new_messages(messages)
+    assert received == [1, 2, ('handler', 3)]
+    assert [message.chat.id for message in messages] == [3]
+
+
+def test_memory_handler_backend_ttl_and_max_entries():
+    backend = MemoryHandlerBackend(ttl=0.05, max_entries=2, eviction_interval=0.01)
+    backend.register_handler(1, 'a')
+    backend.register_handler(2, 'b')
+    backend.register_handler(1, 'c')
+    backend.register_handler(3, 'd')
+    assert backend.evicted_count == 1
+    assert sorted(backend.handlers) == [1, 3]
+    assert backend.get_handlers(1) == ['a', 'c']
+
+    deadline = time.time() + 5
+    while backend.handlers and time.time() < deadline:
+        time.sleep(0.01)
+    assert backend.handlers == {}
+    assert backend.get_handlers(3) is None
+    assert backend.evicted_count == 2
+    backend.close()
+
+    backend = MemoryHandlerBackend(ttl=0.01, eviction_interval=60)
+    backend.register_handler(1, 'a')
+    time.sleep(0.02)
+    assert backend.get_handlers(1) is None
+    backend.close()
+
+
+def test_memory_handler_backend_memory_ceiling():
+    backend = MemoryHandlerBackend(max_memory=2000)
+    telegram_bot = telebot.TeleBot('1234:test', threaded=False, reply_backend=backend)
+    for message_id in range(20):
+        telegram_bot.register_for_reply_by_message_id(message_id, next_handler, 'x' * 100)
+
+    stats = backend.stats()
+    assert 0 < stats['memory_usage'] <= 2000
+    assert stats['entries'] == 20 - stats['overflow_count'] > 0
+    assert sorted(backend.handlers) == list(range(stats['overflow_count'], 20))
+
+    telegram_bot.clear_reply_handlers_by_message_id(19)
+    assert backend.stats()['memory_usage'] < stats['memory_usage']
+    assert backend.stats()['evicted_count'] == stats['overflow_count']
+
+
 def test_file_handler_backend_register_next_step_handler(telegram_bot, private_chat, update_type):
     telegram_bot.next_step_backend=FileHandlerBackend(filename='./.handler-saves/step1.save', delay=0.1)
 
@@ -249,6 +304,57 @@ def test_file_handler_backend_clear_next_step_handler(telegram_bot, private_chat
         os.remove(telegram_bot.next_step_backend.filename)
 
 
+def test_sqlite_handler_backend(telegram_bot, private_chat, update_type, tmp_path):
+    filename = str(tmp_path / 'handlers.db')
+    telegram_bot.next_step_backend = SQLiteHandlerBackend(filename=filename)
+
+    @telegram_bot.message_handler(commands=['start'])
+    def start(message):
+        message.text = 'entered start'
+        telegram_bot.register_next_step_handler_by_chat_id(message.chat.id, next_handler)
+
+    telegram_bot.process_new_updates([update_type])
+    assert update_type.message.text == 'entered start'
+    telegram_bot.register_next_step_handler_by_chat_id(12, next_handler, 'argument')
+    telegram_bot.register_next_step_handler_by_chat_id(13, next_handler)
+    telegram_bot.clear_step_handler_by_chat_id(13)
+    telegram_bot.next_step_backend.close()
+
+    telegram_bot.next_step_backend = SQLiteHandlerBackend(filename=filename)
+    assert sorted(telegram_bot.next_step_backend.handlers) == [private_chat.id, 12]
+    assert telegram_bot.next_step_backend.handlers[12][0].args == ('argument',)
+
+    telegram_bot.process_new_updates([update_type])
+    assert update_type.message.text == 'entered next_handler'
+    telegram_bot.next_step_backend.load_handlers()
+    assert list(telegram_bot.next_step_backend.handlers) == [12]
+
+    legacy = str(tmp_path / 'step.save')
+    FileHandlerBackend.dump_handlers({14: [telebot.Handler(next_handler)]}, legacy)
+    telegram_bot.next_step_backend.load_handlers(legacy)
+    assert not os.path.exists(legacy)
+    telegram_bot.next_step_backend.load_handlers()
+    assert sorted(telegram_bot.next_step_backend.handlers) == [12, 14]
+    telegram_bot.next_step_backend.close()
+
+
+def test_sqlite_handler_backend_seed_handlers_on_restart(tmp_path):
+    filename = str(tmp_path / 'handlers.db')
+    seed = {12: [telebot.Handler(print, 'seed')]}
+    backend = SQLiteHandlerBackend(seed, filename=filename)
+    backend.register_handler(13, telebot.Handler(print))
+    backend.close()
+
+    # restarting with the same seed does not add its handlers again
+    backend = SQLiteHandlerBackend(seed, filename=filename)
+    assert sorted(backend.handlers) == [12, 13]
+    assert len(backend.handlers[12]) == 1
+    backend.close()
+    backend = SQLiteHandlerBackend(filename=filename)
+    assert [len(group) for group in backend.handlers.values()] == [1, 1]
+    backend.close()
+
+
 def test_redis_handler_backend_register_next_step_handler(telegram_bot, private_chat, update_type):
     if not REDIS_TESTS:
         pytest.skip('please install redis and configure redis server, then enable REDIS_TESTS')
@@ -285,3 +391,52 @@ def test_redis_handler_backend_clear_next_step_handler(telegram_bot, private_cha
 
     telegram_bot.process_new_updates([update_type])
     assert update_type.message.text == 'entered start'
+
+
+def test_redis_handler_backend_ttl_and_legacy_keys():
+    if not REDIS_TESTS:
+        pytest.skip('please install redis and configure redis server, then enable REDIS_TESTS')
+
+    backend = RedisHandlerBackend(prefix='pyTelegramBotApi:step_backend3', ttl=60)
+    key = backend._key(1)
+    backend.redis.set(key, pickle.dumps([telebot.Handler(next_handler, 'legacy')]))
+    backend.register_handler(1, telebot.Handler(next_handler, 'new'))
+    assert 0 < backend.redis.ttl(key) <= 60
+    assert [handler.args for handler in backend.get_handlers(1)] == [('legacy',), ('new',)]
+    assert not backend.redis.exists(key)
+    assert backend.get_handlers(1) is None
+
+    backend.redis.set(key, pickle.dumps([telebot.Handler(next_handler)]))
+    assert len(backend.get_handlers(1)) == 1
+
+
+def test_memory_update_deduplicator(update_type):
+    telegram_bot = telebot.TeleBot('1234:test', threaded=False, update_deduplicator=MemoryUpdateDeduplicator(max_size=2))
+    calls = []
+
+    @telegram_bot.message_handler(commands=['start'])
+    def start(message):
+        calls.append(message.message_id)
+
+    assert not telegram_bot.is_known_update(update_type.update_id)
+    telegram_bot.process_new_updates([update_type])
+    assert telegram_bot.is_known_update(update_type.update_id)
+    telegram_bot.process_new_updates([update_type, update_type])
+    assert calls == [1]
+
+    deduplicator = telegram_bot.update_deduplicator
+    assert not deduplicator.is_duplicate(1) and not deduplicator.is_duplicate(2)
+    assert not deduplicator.seen(update_type.update_id)
+    assert deduplicator.is_duplicate(2)
+
+
+def test_redis_update_deduplicator():
+    if not REDIS_TESTS:
+        pytest.skip('please install redis and configure redis server, then enable REDIS_TESTS')
+
+    deduplicator = RedisUpdateDeduplicator(prefix='pyTelegramBotApi:dedup', ttl=5)
+    deduplicator.redis.delete(deduplicator._key(1))
+    assert not deduplicator.seen(1)
+    assert not deduplicator.is_duplicate(1)
+    assert deduplicator.is_duplicate(1)
+    assert deduplicator.seen(1)
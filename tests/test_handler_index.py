@@ -0,0 +1,506 @@
+import sys
+
+sys.path.append('../')
+
+import pytest
+
+import telebot
+from telebot import types
+from telebot.handler_backends import ContinueHandling
+from telebot.states import State, StatesGroup
+from telebot import custom_filters
+from telebot.handler_index import DispatchContext, HandlerIndex, iter_update_parts
+from telebot.text_matching import COMPILED_FILTER
+
+
+@pytest.fixture()
+def telegram_bot():
+    return telebot.TeleBot('1234:test', threaded=False)
+
+
+def make_message(text=None, content_type='text', chat_type='private'):
+    params = {'text': text} if text is not None else {}
+    chat = types.Chat(id=11, type=chat_type)
+    user = types.User(id=10, is_bot=False, first_name='Some User')
+    return types.Message(
+        message_id=1, from_user=user, date=None, chat=chat, content_type=content_type, options=params, json_string=""
+    )
+
+
+def make_update(message):
+    return types.Update(1, message, *([None] * 25))
+
+
+def test_handler_index_buckets():
+    bot = telebot.TeleBot('1234:test', threaded=False)
+    bot.register_message_handler(lambda m: None, commands=['start', 'help'])
+    bot.register_message_handler(lambda m: None, content_types=['photo'])
+    bot.register_message_handler(lambda m: None, func=lambda m: True)
+
+    index = HandlerIndex(bot.message_handlers)
+    assert [e.position for e in index.by_command['start']] == [0]
+    assert [e.position for e in index.by_command['help']] == [0]
+    assert [e.position for e in index.by_content_type['photo']] == [1]
+    assert [e.position for e in index.unindexed] == [2]
+
+    message = make_message('/start')
+    candidates = list(index.candidates(DispatchContext(message)))
+    assert [e.position for e in candidates] == [0, 2]
+
+    assert not index.is_stale(bot.message_handlers)
+    bot.register_message_handler(lambda m: None, commands=['stop'])
+    assert index.is_stale(bot.message_handlers)
+
+
+def test_handler_index_notices_changes_in_place():
+    bot = telebot.TeleBot('1234:test', threaded=False)
+    calls = []
+    bot.register_message_handler(lambda m: calls.append('first'), commands=['start'])
+    bot.register_message_handler(lambda m: calls.append('second'), commands=['start'])
+    handlers = bot.message_handlers
+    index = bot._get_handler_index(handlers)
+    assert bot._get_handler_index(handlers) is index
+
+    # removed by hand, it must not run any more
+    removed = handlers[0]
+    handlers.remove(removed)
+    assert index.is_stale(handlers)
+    bot.process_new_messages([make_message('/start')])
+    assert calls == ['second']
+
+    handlers.insert(0, removed)
+    bot.process_new_messages([make_message('/start')])
+    assert calls == ['second', 'first']
+
+    handlers.clear()
+    bot.process_new_messages([make_message('/start')])
+    assert calls == ['second', 'first']
+
+    # changes inside a handler dict need reset_handler_indexes
+    bot.register_message_handler(lambda m: calls.append('help'), commands=['help'])
+    bot.process_new_messages([make_message('/start')])
+    handlers[0]['filters']['commands'] = ['start']
+    bot.reset_handler_indexes()
+    bot.process_new_messages([make_message('/start')])
+    assert calls == ['second', 'first', 'help']
+
+
+def test_handler_index_compares_plain_lists():
+    handlers = [{'function': print, 'filters': {'commands': ['start']}}]
+    index = HandlerIndex(handlers)
+    assert not index.is_stale(handlers)
+    handlers[0] = {'function': print, 'filters': {'commands': ['start']}}
+    assert index.is_stale(handlers)
+    index = HandlerIndex(handlers)
+    handlers.append({'function': print, 'filters': {}})
+    assert index.is_stale(handlers)
+
+
+def test_indexed_dispatch_keeps_registration_order(telegram_bot):
+    calls = []
+
+    @telegram_bot.message_handler(func=lambda m: True)
+    def first(message):
+        calls.append('first')
+        return ContinueHandling()
+
+    @telegram_bot.message_handler(commands=['start'])
+    def start(message):
+        calls.append('start')
+        return ContinueHandling()
+
+    @telegram_bot.message_handler(content_types=['text'], chat_types=['group'])
+    def group_text(message):
+        calls.append('group_text')
+
+    @telegram_bot.message_handler(content_types=['text'])
+    def text(message):
+        calls.append('text')
+
+    @telegram_bot.message_handler(commands=['start'])
+    def unreachable(message):
+        calls.append('unreachable')
+
+    telegram_bot.process_new_updates([make_update(make_message('/start'))])
+    assert calls == ['first', 'start', 'text']
+
+    calls.clear()
+    telegram_bot.process_new_updates([make_update(make_message('hello', chat_type='group'))])
+    assert calls == ['first', 'group_text']
+
+    calls.clear()
+    telegram_bot.process_new_updates([make_update(make_message(content_type='photo'))])
+    assert calls == []
+
+
+def test_indexed_dispatch_sees_new_handlers(telegram_bot):
+    calls = []
+    telegram_bot.register_message_handler(lambda m: calls.append('help'), commands=['help'])
+    telegram_bot.process_new_updates([make_update(make_message('/start'))])
+    assert calls == []
+
+    telegram_bot.register_message_handler(lambda m: calls.append('start'), commands=['start'])
+    telegram_bot.process_new_updates([make_update(make_message('/start@bot arg'))])
+    assert calls == ['start']
+
+
+def test_middleware_chain_is_compiled_once():
+    from telebot.handler_backends import BaseMiddleware
+
+    class Middleware(BaseMiddleware):
+        def __init__(self):
+            super().__init__()
+            self.update_types = ['message']
+            self.update_sensitive = True
+            self.calls = []
+
+        def pre_process_message(self, message, data):
+            data['value'] = 42
+            self.calls.append('pre')
+
+        def post_process_message(self, message, data, exception):
+            self.calls.append('post')
+
+    bot = telebot.TeleBot('1234:test', threaded=False, use_class_middlewares=True)
+    middleware = Middleware()
+    bot.setup_middleware(middleware)
+    received = []
+
+    @bot.message_handler(commands=['start'])
+    def start(message, value):
+        received.append(value)
+
+    bot.process_new_updates([make_update(make_message('/start'))])
+    bot.process_new_updates([make_update(make_message('/start'))])
+    assert received == [42, 42]
+    assert middleware.calls == ['pre', 'post', 'pre', 'post']
+    assert bot._get_middleware_chain('message') is bot._get_middleware_chain('message')
+    assert bot._get_middleware_chain('callback_query') == []
+
+    bot.setup_middleware(Middleware())
+    assert len(bot._get_middleware_chain('message')) == 2
+
+    # replaced in the list directly, same length
+    replacement = Middleware()
+    bot.middlewares[0] = replacement
+    assert bot._get_middleware_chain('message')[0][0] is replacement
+
+
+@pytest.mark.parametrize('text', ['Hello world', 'HELLO', 'say hi there', 'sir, yes sir', 'account 42', '/start', 'nothing'])
+def test_compiled_text_filters_match_custom_filters(text):
+    bot = telebot.TeleBot('1234:test', threaded=False)
+    for custom_filter in (custom_filters.TextMatchFilter(), custom_filters.TextContainsFilter(),
+                          custom_filters.TextStartsFilter()):
+        bot.add_custom_filter(custom_filter)
+
+    filters = [
+        {'regexp': 'hel+o'},
+        {'regexp': r'^\w+ (\w+) \1$'},
+        {'regexp': r'^(sir)?(?(1), yes sir|\w+ \w+)$'},
+        {'regexp': r'\d+$'},
+        {'text_contains': ['hi', 'account']},
+        {'text_contains': 'world'},
+        {'text_startswith': 'sir'},
+        {'text_startswith': ('say', '/st')},
+        {'text': 'HELLO'},
+        {'text': ['nothing', 'Hello world']},
+        {'text': custom_filters.TextFilter(equals='hello', ignore_case=True)},
+        {'text': custom_filters.TextFilter(contains=['YES'], ends_with='there', ignore_case=True)},
+        {'text': custom_filters.TextFilter(starts_with=['Hell', 'acc'])},
+    ]
+    for handler_filters in filters:
+        bot.register_message_handler(lambda m: None, **handler_filters)
+
+    message = make_message(text)
+    index = bot._get_handler_index(bot.message_handlers)
+    context = DispatchContext(message)
+    assert all(entry.filters[0][0] is COMPILED_FILTER for entry in index.unindexed)
+    compiled = [bot._test_handler_entry(entry, context) for entry in index.candidates(context)]
+    expected = [bool(bot._test_message_handler(handler, message)) for handler in bot.message_handlers]
+    assert compiled == expected
+
+
+class PrefixTextFilter(custom_filters.TextFilter):
+    def check(self, obj):
+        return True
+
+
+def make_parity_objects():
+    objects = [make_message(text) for text in (
+        'Hello world', 'HELLO', 'hi', 'Hi', 'say hi there', 'Say Hi THERE', 'sir, yes sir', 'Yes sir',
+        'account 42', 'ACCOUNT', '5', 'nothing')]
+    photo = make_message(content_type='photo')
+    photo.caption = 'Photo Caption'
+    objects.append(photo)
+    objects.append(make_message(content_type='photo'))
+    user = types.User(id=10, is_bot=False, first_name='Some User')
+    objects.append(types.CallbackQuery(1, user, 'Say hi', 'instance', ''))
+    objects.append(types.CallbackQuery(2, user, None, 'instance', '', game_short_name='game'))
+    return objects
+
+
+def make_parity_filters(filters):
+    """
+    (handler filters, whether they are compiled) of the parity tests, using the TextFilter of `filters`.
+    """
+    TextFilter = filters.TextFilter
+    return [
+        ({'text': 'HELLO'}, True),
+        ({'text': ['nothing', 'Hello world']}, True),
+        # compared with ==, so not compiled
+        ({'text': ['nothing', 5, 'Hello world']}, False),
+        ({'text': 5}, False),
+        ({'text': TextFilter(equals='hello', ignore_case=True)}, True),
+        # custom_filters.TextFilter only lowers the words of its first check
+        ({'text': TextFilter(equals='Hi', contains=['YES'], ignore_case=True)}, True),
+        ({'text': TextFilter(contains=['Sir', 'ACC'], starts_with='Say', ends_with=['THERE'], ignore_case=True)}, True),
+        ({'text': TextFilter(starts_with=['Say', 'acc'], ends_with='There', ignore_case=True)}, True),
+        ({'text': TextFilter(starts_with=['Hell', 5, 'acc'])}, True),
+        ({'text': TextFilter(equals='Photo Caption')}, True),
+        ({'text': TextFilter(contains=['caption', 'HI'], ignore_case=True)}, True),
+        ({'text': TextFilter(equals=5)}, False),
+        ({'text_contains': ['hi', 5, 'account']}, True),
+        ({'text_contains': 'world'}, True),
+        ({'text_contains': 5}, False),
+        ({'text_startswith': 'sir'}, True),
+        ({'text_startswith': ('say', '/st')}, True),
+        ({'text_startswith': ('say', 5)}, False),
+        ({'text_startswith': ['say']}, False),
+        ({'regexp': 'hel+o'}, True),
+    ]
+
+
+def outcome(check):
+    try:
+        return bool(check())
+    except Exception as e:
+        return type(e)
+
+
+def test_compiled_text_filters_keep_custom_filter_results():
+    bot = telebot.TeleBot('1234:test', threaded=False)
+    for custom_filter in (custom_filters.TextMatchFilter(), custom_filters.TextContainsFilter(),
+                          custom_filters.TextStartsFilter()):
+        bot.add_custom_filter(custom_filter)
+    filters = make_parity_filters(custom_filters) + [({'text': PrefixTextFilter(equals='x')}, False)]
+    for handler_filters, _ in filters:
+        # the bucket guarantees the content type, compared are the text filters
+        bot.register_message_handler(lambda m: None, content_types=['text', 'photo'], **handler_filters)
+        bot.register_callback_query_handler(lambda c: None, None, **handler_filters)
+
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        index = bot._get_handler_index(handlers)
+        assert [entry.filters[-1][0] is COMPILED_FILTER for entry in index.entries] == [
+            is_compiled for _, is_compiled in filters]
+        update_type = types.Message if handlers is bot.message_handlers else types.CallbackQuery
+        for obj in make_parity_objects():
+            if not isinstance(obj, update_type):
+                continue
+            context = DispatchContext(obj)
+            compiled = [outcome(lambda: bot._test_handler_entry(entry, context)) for entry in index.entries]
+            expected = [outcome(lambda: bot._test_message_handler(handler, obj)) for handler in handlers]
+            assert compiled == expected, (handlers is bot.message_handlers, getattr(obj, 'text', None))
+
+
+def test_async_compiled_text_filters_keep_custom_filter_results():
+    from telebot import asyncio_filters
+    from telebot.async_telebot import AsyncTeleBot
+
+    async def async_outcome(check):
+        try:
+            return bool(await check())
+        except Exception as e:
+            return type(e)
+
+    async def run():
+        bot = AsyncTeleBot('1234:test')
+        for custom_filter in (asyncio_filters.TextMatchFilter(), asyncio_filters.TextContainsFilter(),
+                              asyncio_filters.TextStartsFilter()):
+            bot.add_custom_filter(custom_filter)
+        filters = make_parity_filters(asyncio_filters) + [
+            # the async filter only takes a list as such, and not the TextFilter of custom_filters
+            ({'text': type('Words', (list,), {})(['HELLO'])}, False),
+            ({'text': custom_filters.TextFilter(equals='HELLO')}, False),
+        ]
+        for handler_filters, _ in filters:
+            bot.register_message_handler(lambda m: None, content_types=['text', 'photo'], **handler_filters)
+
+        index = bot._get_handler_index(bot.message_handlers)
+        assert [entry.filters[-1][0] is COMPILED_FILTER for entry in index.entries] == [
+            is_compiled for _, is_compiled in filters]
+        for obj in make_parity_objects():
+            if not isinstance(obj, types.Message):
+                continue
+            context = DispatchContext(obj)
+            compiled = [await async_outcome(lambda: bot._test_handler_entry(entry, context)) for entry in index.entries]
+            expected = [await async_outcome(lambda: bot._test_message_handler(handler, obj))
+                        for handler in bot.message_handlers]
+            assert compiled == expected, getattr(obj, 'text', None)
+
+    import asyncio
+    asyncio.run(run())
+
+
+def test_update_de_json_remembers_present_fields():
+    update = types.Update.de_json({
+        'update_id': 5,
+        'callback_query': {'id': '1', 'from': {'id': 10, 'is_bot': False, 'first_name': 'User'},
+                           'chat_instance': 'instance', 'data': 'data'},
+    })
+    assert update._update_types == ('callback_query',)
+    assert update.message is None and update.callback_query.data == 'data'
+    assert list(iter_update_parts(update)) == [('callback_query', update.callback_query)]
+    message_update = make_update(make_message('hi'))
+    assert list(iter_update_parts(message_update)) == [('message', message_update.message)]
+
+
+def test_router_processes_types_in_order_and_skips_unhandled():
+    calls = []
+
+    class Bot(telebot.TeleBot):
+        def process_new_poll(self, polls):
+            calls.append(('poll', len(polls)))
+
+    bot = Bot('1234:test', threaded=False)
+    bot.register_callback_query_handler(lambda call: calls.append(('callback_query', call.data)), func=None)
+    bot.register_message_handler(lambda message: calls.append(('message', message.text)))
+    callback_query = types.CallbackQuery(1, types.User(10, False, 'User'), 'data', 'instance', '')
+    fields = dict.fromkeys(types.Update._field_types)
+    updates = [
+        types.Update(1, **dict(fields, callback_query=callback_query)),
+        make_update(make_message('hi')),
+        types.Update(3, **dict(fields, poll=object())),
+    ]
+    bot.process_new_updates(updates)
+    assert calls == [('message', 'hi'), ('callback_query', 'data'), ('poll', 1)]
+    assert bot.last_update_id == 3
+
+    assert bot._can_skip_update_type('process_new_inline_query', 'inline_handlers', 'inline_query')
+    assert not bot._can_skip_update_type('process_new_poll', 'poll_handlers', 'poll')
+    assert not bot._can_skip_update_type('process_new_messages', None, 'message')
+    assert not bot._can_skip_update_type('process_new_callback_query', 'callback_query_handlers', 'callback_query')
+
+
+class Steps(StatesGroup):
+    first = State()
+    second = State()
+
+
+def test_state_index_keeps_registration_order():
+    bot = telebot.TeleBot('1234:test', threaded=False)
+    bot.add_custom_filter(custom_filters.StateFilter(bot))
+    calls = []
+
+    def handler(name):
+        def handle(message):
+            calls.append(name)
+            return ContinueHandling()
+        return handle
+
+    bot.register_message_handler(handler('any'), state='*')
+    bot.register_message_handler(handler('stateless'))
+    bot.register_message_handler(handler('first'), state=Steps.first)
+    bot.register_message_handler(handler('start in both'), commands=['start'], state=[Steps.first, Steps.second.name])
+    bot.register_message_handler(handler('photo in second'), content_types=['photo'], state=Steps.second)
+    bot.register_message_handler(handler('custom'), state=Steps.second, func=lambda m: True)
+    for number in range(50):
+        bot.register_message_handler(handler(number), state='other{0}'.format(number))
+
+    index = bot._get_handler_index(bot.message_handlers)
+    assert index.needs_state
+    assert [e.position for e in index.stateless.unindexed] == [1]
+    assert [e.position for e in index.by_state[Steps.first.name].by_command['start']] == [3]
+    assert [e.position for e in index.by_state[Steps.second.name].by_content_type['photo']] == [4]
+    assert all('state' not in dict(entry.filters) for entry in index.entries)
+
+    bot.process_new_updates([make_update(make_message('/start'))])
+    assert calls == ['stateless']
+
+    calls.clear()
+    bot.set_state(10, Steps.first, 11)
+    bot.process_new_updates([make_update(make_message('/start'))])
+    assert calls == ['any', 'stateless', 'first', 'start in both']
+
+    calls.clear()
+    bot.set_state(10, Steps.second, 11)
+    bot.process_new_updates([make_update(make_message('/start'))])
+    assert calls == ['any', 'stateless', 'start in both', 'custom']
+
+    calls.clear()
+    bot.process_new_updates([make_update(make_message(content_type='photo'))])
+    assert calls == ['any', 'stateless', 'photo in second', 'custom']
+
+    calls.clear()
+    bot.set_state(10, 'other42', 11)
+    bot.process_new_updates([make_update(make_message('hi'))])
+    assert calls == ['any', 'stateless', 42]
+
+
+@pytest.mark.parametrize('use_class_middlewares', [False, True])
+def test_state_changed_by_continuing_handler(use_class_middlewares):
+    bot = telebot.TeleBot('1234:test', threaded=False, use_class_middlewares=use_class_middlewares)
+    bot.add_custom_filter(custom_filters.StateFilter(bot))
+    calls = []
+
+    @bot.message_handler(state=Steps.first)
+    def first(message):
+        calls.append('first')
+        bot.set_state(message.from_user.id, Steps.second, message.chat.id)
+        return ContinueHandling()
+
+    @bot.message_handler(state=Steps.first)
+    def still_first(message):
+        calls.append('still first')
+
+    @bot.message_handler(state=Steps.second)
+    def second(message):
+        calls.append('second')
+
+    bot.set_state(10, Steps.first, 11)
+    bot.process_new_updates([make_update(make_message('hi'))])
+    assert calls == ['first', 'second']
+
+
+def test_async_state_changed_by_continuing_handler():
+    import asyncio
+    from telebot.async_telebot import AsyncTeleBot
+    from telebot import asyncio_filters
+    from telebot.asyncio_handler_backends import ContinueHandling
+
+    bot = AsyncTeleBot('1234:test')
+    bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+    calls = []
+
+    @bot.message_handler(state=Steps.first)
+    async def first(message):
+        calls.append('first')
+        await bot.set_state(message.from_user.id, Steps.second, message.chat.id)
+        return ContinueHandling()
+
+    @bot.message_handler(state=Steps.first)
+    async def still_first(message):
+        calls.append('still first')
+
+    @bot.message_handler(state=Steps.second)
+    async def second(message):
+        calls.append('second')
+
+    async def run():
+        await bot.set_state(10, Steps.first, 11)
+        await bot.process_new_updates([make_update(make_message('hi'))])
+
+    asyncio.run(run())
+    assert calls == ['first', 'second']
+
+
+def test_state_filter_is_kept_without_builtin_state_filter():
+    class MyStateFilter(custom_filters.StateFilter):
+        pass
+
+    bot = telebot.TeleBot('1234:test', threaded=False)
+    bot.add_custom_filter(MyStateFilter(bot))
+    bot.register_message_handler(lambda m: None, state=Steps.first)
+    bot.register_message_handler(lambda m: None, state=(Steps.first.name,))
+    index = bot._get_handler_index(bot.message_handlers)
+    assert not index.needs_state
+    assert [dict(entry.filters).get('state') for entry in index.entries] == [Steps.first, (Steps.first.name,)]
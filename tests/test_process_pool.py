@@ -0,0 +1,117 @@
+import sys
+
+sys.path.append('../')
+
+import multiprocessing
+import os
+
+import pytest
+
+import telebot
+from telebot import storage, types
+from telebot.handler_backends import ContinueHandling
+from telebot.process_pool import ProcessPool, default_start_method, dump_update, load_update, run_in_process
+
+
+MESSAGE_JSON = {
+    'message_id': 1, 'date': 1700000000, 'text': '/start hello',
+    'chat': {'id': 11, 'type': 'private'},
+    'from': {'id': 10, 'is_bot': False, 'first_name': 'Some User'},
+    'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+}
+
+
+@run_in_process
+def process_handler(message, bot):
+    assert bot.token == '1234:test'
+    return ContinueHandling()
+
+
+@run_in_process
+def data_handler(message, data):
+    data['pid'] = os.getpid()
+    data['text'] = message.text
+
+
+@run_in_process
+def state_handler(message, bot):
+    bot.set_state(message.from_user.id, 'set in child', message.chat.id)
+
+
+def test_dump_update_is_compact():
+    message = types.Message.de_json(MESSAGE_JSON)
+    type_name, raw = dump_update(message)
+    assert type_name == 'Message'
+    assert raw is message.json
+    restored = load_update((type_name, raw))
+    assert restored.text == message.text
+    assert restored.chat.id == 11
+    assert restored.entities[0].type == 'bot_command'
+
+
+def test_process_handlers_run_in_child_process():
+    bot = telebot.TeleBot('1234:test', threaded=False, process_pool_workers=1)
+    bot.process_pool = ProcessPool(bot, max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    calls = []
+    bot.register_message_handler(process_handler, commands=['start'], pass_bot=True)
+    bot.register_message_handler(lambda message: calls.append(message.text), commands=['start'])
+    try:
+        update = types.Update.de_json({'update_id': 1, 'message': MESSAGE_JSON})
+        bot.process_new_updates([update])
+        assert calls == ['/start hello']
+
+        entry = bot._get_handler_index(bot.message_handlers).entries[0]
+        assert entry.function.__wrapped__ is process_handler
+        assert isinstance(entry.function(update.message, bot=bot), ContinueHandling)
+    finally:
+        bot.process_pool.close()
+
+
+def test_process_handler_updates_middleware_data():
+    bot = telebot.TeleBot('1234:test', threaded=False, use_class_middlewares=True)
+    bot.process_pool = ProcessPool(bot, max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    data = {'text': None}
+    try:
+        result = bot.process_pool.wrap(data_handler)(types.Message.de_json(MESSAGE_JSON), data)
+        assert result is None
+        assert data['text'] == '/start hello'
+        assert data['pid'] != os.getpid()
+    finally:
+        bot.process_pool.close()
+
+
+def test_process_next_step_handler_shares_sqlite_state_storage(tmp_path):
+    state_storage = storage.StateSQLiteStorage(str(tmp_path / 'states.db'))
+    bot = telebot.TeleBot('1234:test', threaded=False, state_storage=state_storage)
+    bot.process_pool = ProcessPool(bot, max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        bot.register_next_step_handler_by_chat_id(11, state_handler, bot)
+        bot.process_new_updates([types.Update.de_json({'update_id': 1, 'message': MESSAGE_JSON})])
+        assert bot.get_state(10, 11) == 'set in child'
+    finally:
+        bot.process_pool.close()
+        state_storage.close()
+
+
+def test_process_handler_rejects_unshared_state_storage():
+    bot = telebot.TeleBot('1234:test', threaded=False, state_storage=storage.StateMemoryStorage())
+    bot.process_pool = ProcessPool(bot, max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        with pytest.raises(RuntimeError):
+            bot.process_pool.wrap(state_handler)(types.Message.de_json(MESSAGE_JSON), bot)
+        assert bot.get_state(10, 11) is None
+    finally:
+        bot.process_pool.close()
+
+
+def test_process_pool_adds_worker_threads():
+    bot = telebot.TeleBot('1234:test', num_threads=2, process_pool_workers=3)
+    process_pool = bot._get_process_pool()
+    try:
+        assert process_pool.executor._mp_context.get_start_method() == default_start_method() != 'fork'
+        assert len(bot.worker_pool.workers) == 5
+        assert bot._get_process_pool() is process_pool
+        assert len(bot.worker_pool.workers) == 5
+    finally:
+        process_pool.close()
+        bot.worker_pool.close()
@@ -0,0 +1,1109 @@
+import sys
+
+sys.path.append('../')
+
+import asyncio
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+import pytest
+
+import telebot
+from telebot import asyncio_filters, asyncio_storage, custom_filters, storage, types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.states.sync.context import StateContext
+from telebot.states.sync.middleware import StateMiddleware
+from telebot.states import State, StatesGroup
+from telebot.storage import memory_storage, redis_storage
+from telebot.storage.redis_storage import NearCache, decode_data, decode_state, encode_data, encode_data_changes
+
+REDIS_TESTS = False
+
+
+class Form(StatesGroup):
+    name = State()
+    age = State()
+
+
+def check_storage(state_storage):
+    assert state_storage.get_state(1, 2) is None
+    assert state_storage.get_data(1, 2) == {}
+    with pytest.raises(RuntimeError):
+        state_storage.set_data(1, 2, 'key', 'value')
+
+    assert state_storage.set_state(1, 2, Form.name)
+    assert state_storage.get_state(1, 2) == Form.name.name
+    assert state_storage.get_state(1, 2, message_thread_id=5) is None
+    state_storage.set_state(1, 2, 'other', business_connection_id='connection', message_thread_id=5, bot_id=9)
+    assert state_storage.get_state(1, 2, business_connection_id='connection', message_thread_id=5, bot_id=9) == 'other'
+
+    state_storage.set_data(1, 2, 'key', 'value')
+    with state_storage.get_interactive_data(1, 2) as data:
+        data['number'] = 42
+    assert state_storage.get_data(1, 2) == {'key': 'value', 'number': 42}
+    state_storage.set_state(1, 2, Form.age)
+    assert state_storage.get_data(1, 2) == {'key': 'value', 'number': 42}
+
+    assert state_storage.reset_data(1, 2)
+    assert state_storage.get_data(1, 2) == {}
+    assert state_storage.delete_state(1, 2)
+    assert not state_storage.delete_state(1, 2)
+    assert state_storage.get_state(1, 2) is None
+    assert state_storage.get_state(1, 2, business_connection_id='connection', message_thread_id=5, bot_id=9) == 'other'
+
+
+async def check_async_storage(state_storage):
+    assert await state_storage.get_state(1, 2) is None
+    with pytest.raises(RuntimeError):
+        await state_storage.set_data(1, 2, 'key', 'value')
+
+    assert await state_storage.set_state(1, 2, Form.name)
+    assert await state_storage.get_state(1, 2) == Form.name.name
+    await state_storage.set_data(1, 2, 'key', 'value')
+    async with state_storage.get_interactive_data(1, 2) as data:
+        data['number'] = 42
+    assert await state_storage.get_data(1, 2) == {'key': 'value', 'number': 42}
+
+    assert await state_storage.reset_data(1, 2)
+    assert await state_storage.get_data(1, 2) == {}
+    assert await state_storage.delete_state(1, 2)
+    assert await state_storage.get_state(1, 2) is None
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'shards': 1}, {'ttl': 60, 'max_entries': 100}])
+def test_memory_storage(kwargs):
+    state_storage = storage.StateMemoryStorage(**kwargs)
+    check_storage(state_storage)
+    state_storage.close()
+
+    async def run():
+        async_storage = asyncio_storage.StateMemoryStorage(**kwargs)
+        await check_async_storage(async_storage)
+        await async_storage.close()
+
+    asyncio.run(run())
+
+
+def test_memory_storage_is_a_plain_dict_by_default():
+    state_storage = storage.StateMemoryStorage()
+    state_storage.set_state(1, 2, 'state', bot_id=9)
+    state_storage.set_data(1, 2, 'key', 'value', bot_id=9)
+    assert state_storage.shards is None
+    assert state_storage.data == {'telebot:9:1:2': {'state': 'state', 'data': {'key': 'value'}}}
+    assert state_storage._evictor is None
+
+    # a size limit alone shards the storage, but does not need the eviction thread
+    bounded = storage.StateMemoryStorage(max_entries=10)
+    bounded.set_state(1, 2, 'state')
+    assert bounded.data is None and len(bounded.shards) == 16
+    assert bounded._evictor is None
+
+    async def run():
+        async_storage = asyncio_storage.StateMemoryStorage()
+        await async_storage.set_state(1, 2, 'state')
+        assert async_storage.data == {'telebot:1:2': {'state': 'state', 'data': {}}}
+
+    asyncio.run(run())
+
+
+def test_memory_storage_expiration(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(memory_storage.time, 'monotonic', lambda: now[0])
+    state_storage = storage.StateMemoryStorage(ttl=10, max_entries=4, shards=1, eviction_interval=3600)
+    for user_id in range(3):
+        state_storage.set_state(1, user_id, 'state')
+    now[0] += 8
+    assert state_storage.get_state(1, 0) == 'state'  # used records do not expire
+    now[0] += 8
+    assert state_storage.get_state(1, 0) == 'state'
+    assert state_storage.get_state(1, 1) is None
+    assert state_storage.evict_expired() == 1
+    assert state_storage.stats() == {'entries': 1, 'expired_count': 2, 'overflow_count': 0, 'evicted_count': 2}
+
+    # the least recently used records are dropped
+    for user_id in range(10, 20):
+        state_storage.set_state(1, user_id, 'state')
+    assert state_storage.stats()['entries'] == 4
+    assert state_storage.stats()['overflow_count'] == 7
+    assert state_storage._evictor.name == 'StateEvictor'
+    state_storage.close()
+    assert state_storage._evictor is None
+
+
+def test_memory_storage_threads():
+    state_storage = storage.StateMemoryStorage(max_entries=1000)
+
+    def work(chat_id):
+        for user_id in range(200):
+            state_storage.set_state(chat_id, user_id, 'state')
+            state_storage.set_data(chat_id, user_id, 'user', user_id)
+            assert state_storage.get_data(chat_id, user_id) == {'user': user_id}
+            state_storage.delete_state(chat_id, user_id)
+
+    threads = [threading.Thread(target=work, args=(chat_id,)) for chat_id in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert state_storage.stats()['entries'] == 0
+
+
+def fill_bulk_states(state_storage):
+    state_storage.set_state(1, 1, 'a', bot_id=5)
+    state_storage.set_state(1, 2, 'b', bot_id=5)
+    state_storage.set_data(1, 2, 'key', 'value', bot_id=5)
+    state_storage.set_state(1, 3, 'c', message_thread_id=7, bot_id=5)
+    state_storage.set_state(2, 1, 'other chat', bot_id=5)
+    state_storage.set_state(1, 1, 'other bot', bot_id=6)
+    state_storage.set_state(1, 9, 'no bot')
+
+
+def check_bulk_operations(state_storage):
+    fill_bulk_states(state_storage)
+    assert state_storage.count_states(1, bot_id=5) == 3
+    assert state_storage.count_states(bot_id=5) == 4
+    # None matches any bot
+    assert state_storage.count_states(1) == 5
+    assert state_storage.count_states() == 6
+    assert sorted(state_storage.iter_states(1, bot_id=5)) == [
+        (1, 1, None, None, 5, 'a'), (1, 2, None, None, 5, 'b'), (1, 3, None, 7, 5, 'c')
+    ]
+    assert sorted(state[5] for state in state_storage.iter_states(bot_id=5)) == ['a', 'b', 'c', 'other chat']
+
+    assert state_storage.delete_states_for_chat(1, bot_id=5) == 3
+    assert state_storage.delete_states_for_chat(1, bot_id=5) == 0
+    assert state_storage.count_states(1, bot_id=5) == 0
+    assert list(state_storage.iter_states(1, bot_id=5)) == []
+    assert state_storage.count_states(bot_id=5) == 1
+    assert state_storage.get_state(1, 1, bot_id=6) == 'other bot'
+    state_storage.set_state(1, 2, 'again', bot_id=5)
+    assert state_storage.get_data(1, 2, bot_id=5) == {}
+    assert sorted(state[5] for state in state_storage.iter_states(1)) == ['again', 'no bot', 'other bot']
+    assert state_storage.delete_states_for_chat(1) == 3
+    assert list(state_storage.iter_states()) == [(2, 1, None, None, 5, 'other chat')]
+
+
+@pytest.mark.parametrize('make_storage', [
+    lambda tmp_path: storage.StateMemoryStorage(indexes=True),
+    lambda tmp_path: storage.StateMemoryStorage(indexes=True, shards=4),
+    lambda tmp_path: storage.StateSQLiteStorage(str(tmp_path / 'states.db')),
+    lambda tmp_path: storage.StatePickleStorage(str(tmp_path / 'states.pkl')),
+])
+def test_bulk_operations_on_bot_states(make_storage, tmp_path):
+    state_storage = make_storage(tmp_path)
+    bot = telebot.TeleBot('1234:test', state_storage=state_storage)
+    bot.set_state(10, 'a', 1)
+    bot.set_state(11, 'b', 1, message_thread_id=3)
+    bot.set_state(10, 'c', 2)
+    assert state_storage.count_states(1) == 2
+    assert state_storage.count_states(1, bot_id=bot.bot_id) == 2
+    assert state_storage.count_states(bot_id=4321) == 0
+    assert sorted(state_storage.iter_states(1)) == [(1, 10, None, None, 1234, 'a'), (1, 11, None, 3, 1234, 'b')]
+    assert state_storage.delete_states_for_chat(1) == 2
+    assert bot.get_state(10, 1) is None
+    assert bot.get_state(10, 2) == 'c'
+
+    async def run():
+        async_storage = asyncio_storage.StateMemoryStorage(shards=1)
+        async_bot = AsyncTeleBot('1234:test', state_storage=async_storage)
+        await async_bot.set_state(10, 'a', 1)
+        assert await async_storage.count_states(1) == 1
+        assert await async_storage.delete_states_for_chat(1) == 1
+        assert await async_bot.get_state(10, 1) is None
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('kwargs', [{'indexes': True}, {'shards': 4}, {'indexes': True, 'ttl': 60}])
+def test_memory_storage_bulk_operations(kwargs):
+    state_storage = storage.StateMemoryStorage(**kwargs)
+    check_bulk_operations(state_storage)
+    if state_storage.indexes:
+        assert set(state_storage.chat_index) == {2}
+    state_storage.close()
+
+    async def run():
+        async_storage = asyncio_storage.StateMemoryStorage(**kwargs)
+        fill_bulk_states(async_storage.storage)
+        assert await async_storage.count_states(1, bot_id=5) == 3
+        assert len([state async for state in async_storage.iter_states(bot_id=5)]) == 4
+        assert await async_storage.delete_states_for_chat(1, bot_id=5) == 3
+        await async_storage.close()
+
+    asyncio.run(run())
+
+
+def test_memory_storage_plain_keys_need_indexes():
+    state_storage = storage.StateMemoryStorage()
+    state_storage.set_state(-100, 2, 'b', business_connection_id='bc', message_thread_id=7)
+    with pytest.raises(NotImplementedError):
+        state_storage.count_states(-100)
+    with pytest.raises(NotImplementedError):
+        list(state_storage.iter_states(-100))
+    with pytest.raises(NotImplementedError):
+        state_storage.delete_states_for_chat(-100)
+    assert state_storage.get_state(-100, 2, business_connection_id='bc', message_thread_id=7) == 'b'
+
+    # the indexes keep the key tuples, so a thread id is never taken for a bot id
+    state_storage = storage.StateMemoryStorage(indexes=True)
+    state_storage.set_state(-100, 1, 'a', business_connection_id='bc', message_thread_id=7, bot_id=5)
+    state_storage.set_state(-100, 2, 'b', business_connection_id='bc', message_thread_id=7)
+    state_storage.set_state(-100, 3, 'c', message_thread_id=7)
+    state_storage.set_state(-100, 4, 'd', message_thread_id=7, bot_id=5)
+    assert sorted(state_storage.iter_states(-100)) == [
+        (-100, 1, 'bc', 7, 5, 'a'), (-100, 2, 'bc', 7, None, 'b'),
+        (-100, 3, None, 7, None, 'c'), (-100, 4, None, 7, 5, 'd'),
+    ]
+    assert state_storage.delete_states_for_chat(-100, bot_id=5) == 2
+    assert state_storage.get_state(-100, 3, message_thread_id=7) == 'c'
+
+
+def test_sqlite_storage_bulk_operations(tmp_path):
+    state_storage = storage.StateSQLiteStorage(str(tmp_path / 'states.db'))
+    check_bulk_operations(state_storage)
+    plan = state_storage.connection.execute(
+        'EXPLAIN QUERY PLAN ' + state_storage._scope_sql(state_storage._count_sql, 1, 5)[0], (1, 5)).fetchall()
+    assert 'telebot_states_chat' in str(plan)
+    assert state_storage.connection.execute('SELECT COUNT(*) FROM telebot_states_data').fetchone()[0] == 0
+    state_storage.close()
+
+    async def run():
+        async_storage = asyncio_storage.StateSQLiteStorage(str(tmp_path / 'async.db'))
+        fill_bulk_states(async_storage.storage)
+        assert await async_storage.count_states(bot_id=5) == 4
+        assert sorted([state[5] async for state in async_storage.iter_states(1)]) == ['a', 'b', 'c', 'no bot', 'other bot']
+        assert await async_storage.delete_states_for_chat(1, bot_id=5) == 3
+        await async_storage.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('write_behind', [False, True])
+def test_pickle_storage_bulk_operations(tmp_path, write_behind):
+    file_path = str(tmp_path / 'states.pkl')
+    state_storage = storage.StatePickleStorage(file_path, write_behind=write_behind)
+    check_bulk_operations(state_storage)
+    assert state_storage.get_states([(2, 1), (1, 2)], bot_id=5) == ['other chat', None]
+    state_storage.close()
+    # the key parts are kept in the file
+    assert list(storage.StatePickleStorage(file_path).iter_states()) == [(2, 1, None, None, 5, 'other chat')]
+
+    # a record written by an older version is found once its state was set again
+    state_storage = storage.StatePickleStorage(file_path)
+    records = state_storage._read_from_file()
+    records['telebot:5:3:4'] = {'state': 'old', 'data': {'key': 'value'}}
+    state_storage._write_to_file(records)
+    assert state_storage.count_states(3) == 0
+    state_storage.set_state(3, 4, 'new', bot_id=5)
+    assert list(state_storage.iter_states(3)) == [(3, 4, None, None, 5, 'new')]
+    assert state_storage.get_data(3, 4, bot_id=5) == {'key': 'value'}
+
+    async def run():
+        async_storage = asyncio_storage.StatePickleStorage(str(tmp_path / 'async.pkl'))
+        await async_storage.set_state(1, 1, 'a', bot_id=5)
+        await async_storage.set_state(1, 2, 'b', bot_id=5)
+        await async_storage.set_state(1, 3, 'c', message_thread_id=7, bot_id=5)
+        await async_storage.set_state(2, 1, 'other chat', bot_id=5)
+        await async_storage.set_state(1, 1, 'other bot', bot_id=6)
+        await async_storage.set_state(1, 9, 'no bot')
+        async with async_storage.get_interactive_data(1, 2, bot_id=5) as data:
+            data['other'] = 1
+        await async_storage.reset_data(1, 1, bot_id=5)
+        assert await async_storage.count_states(1, bot_id=5) == 3
+        assert sorted([state async for state in async_storage.iter_states(1)]) == [
+            (1, 1, None, None, 5, 'a'), (1, 1, None, None, 6, 'other bot'), (1, 2, None, None, 5, 'b'),
+            (1, 3, None, 7, 5, 'c'), (1, 9, None, None, None, 'no bot'),
+        ]
+        assert await async_storage.delete_states_for_chat(1, bot_id=5) == 3
+        assert await async_storage.count_states(bot_id=5) == 1
+        await async_storage.close()
+        assert storage.StatePickleStorage(str(tmp_path / 'async.pkl')).count_states(1) == 2
+
+    asyncio.run(run())
+
+
+def test_sqlite_storage(tmp_path):
+    file_path = str(tmp_path / 'states.db')
+    state_storage = storage.StateSQLiteStorage(file_path)
+    check_storage(state_storage)
+    state_storage.set_state(3, 4, 'persistent')
+    state_storage.close()
+
+    state_storage = storage.StateSQLiteStorage(file_path)
+    assert state_storage.get_state(3, 4) == 'persistent'
+    assert state_storage.connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    state_storage.close()
+
+
+def test_sqlite_storage_keeps_state_types(tmp_path):
+    file_path = str(tmp_path / 'states.db')
+    state_storage = storage.StateSQLiteStorage(file_path)
+    state_storage.set_state(1, 2, 1)
+    state_storage.set_state(1, 3, '1')
+    state_storage.set_state(1, 4, 2.5)
+    assert state_storage.get_state(1, 2) == 1 and isinstance(state_storage.get_state(1, 2), int)
+    assert state_storage.get_state(1, 3) == '1'
+    assert state_storage.get_state(1, 4) == 2.5
+    assert {state[5] for state in state_storage.iter_states(1)} == {1, '1', 2.5}
+    state_storage.close()
+    assert storage.StateSQLiteStorage(file_path).get_state(1, 2) == 1
+
+    # an int state matches in the handlers
+    bot = telebot.TeleBot('1234:test', threaded=False, state_storage=storage.StateSQLiteStorage(file_path))
+    bot.add_custom_filter(custom_filters.StateFilter(bot))
+    handled = []
+    bot.message_handler(state=1)(lambda message: handled.append(message.text))
+    bot.set_state(10, 1, 11)
+    bot.process_new_updates([make_state_update(1, 'text')])
+    assert handled == ['text']
+
+    async def run():
+        async_storage = asyncio_storage.StateSQLiteStorage(file_path)
+        await async_storage.set_state(5, 6, 3)
+        assert await async_storage.get_state(5, 6) == 3
+        await async_storage.close()
+
+    asyncio.run(run())
+
+
+def test_async_sqlite_storage(tmp_path):
+    async def run():
+        state_storage = asyncio_storage.StateSQLiteStorage(str(tmp_path / 'states.db'))
+        await check_async_storage(state_storage)
+        await state_storage.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('write_behind', [False, True])
+def test_pickle_storage(tmp_path, write_behind):
+    state_storage = storage.StatePickleStorage(str(tmp_path / 'states.pkl'), write_behind=write_behind)
+    check_storage(state_storage)
+    state_storage.close()
+
+
+def test_pickle_storage_write_behind_log(tmp_path):
+    file_path = str(tmp_path / 'states.pkl')
+    state_storage = storage.StatePickleStorage(file_path, write_behind=True, fsync='always')
+    state_storage.set_state(1, 2, 'first')
+    state_storage.set_data(1, 2, 'key', 'value')
+    state_storage.set_state(3, 4, 'deleted')
+    state_storage.delete_state(3, 4)
+    assert os.path.getsize(file_path + '.log') > 0
+
+    # the files of a process that did not write a snapshot are replayed
+    copy_path = str(tmp_path / 'copy.pkl')
+    shutil.copy(file_path, copy_path)
+    shutil.copy(file_path + '.log', copy_path + '.log')
+    replayed = storage.StatePickleStorage(copy_path, write_behind=True)
+    assert replayed.states == state_storage.states
+    replayed.close()
+
+    with open(file_path + '.log', 'ab') as log:
+        log.write(b'\x80\x04\x95')  # record cut off by a crash
+    assert state_storage.snapshot()
+    assert not state_storage.snapshot()
+    state_storage.set_state(5, 6, 'after snapshot')
+    state_storage.close()
+    assert os.path.getsize(file_path + '.log') == 0
+    assert not os.path.exists(file_path + '.log.1')
+
+    state_storage = storage.StatePickleStorage(file_path)
+    assert state_storage.get_state(1, 2) == 'first'
+    assert state_storage.get_data(1, 2) == {'key': 'value'}
+    assert state_storage.get_state(3, 4) is None
+    assert state_storage.get_state(5, 6) == 'after snapshot'
+
+
+def test_async_pickle_storage(tmp_path):
+    file_path = str(tmp_path / 'states.pkl')
+    writes = []
+
+    async def run():
+        state_storage = asyncio_storage.StatePickleStorage(file_path, flush_delay=0.05)
+        write_to_file = state_storage._write_to_file
+        state_storage._write_to_file = lambda data: writes.append(data) or write_to_file(data)
+        await check_async_storage(state_storage)
+        for user_id in range(100):
+            await state_storage.set_state(1, user_id, 'state')
+            await state_storage.set_data(1, user_id, 'user', user_id)
+        assert writes == []
+        await asyncio.sleep(0.2)
+        assert len(writes) == 1
+        assert not await state_storage.flush()
+
+        await state_storage.delete_state(1, 0)
+        await state_storage.close()
+        assert len(writes) == 2
+
+        state_storage = asyncio_storage.StatePickleStorage(file_path)
+        assert await state_storage.get_state(1, 0) is None
+        assert await state_storage.get_data(1, 99) == {'user': 99}
+        await state_storage.close()
+
+    asyncio.run(run())
+    # the sync storage reads the same file
+    assert storage.StatePickleStorage(file_path).get_state(1, 5) == 'state'
+
+
+def test_async_pickle_storage_writes_immediately(tmp_path):
+    file_path = str(tmp_path / 'states.pkl')
+
+    async def run():
+        state_storage = asyncio_storage.StatePickleStorage(file_path)
+        await state_storage.set_state(1, 2, 'state')
+        # on disk before the call returns, without close()
+        assert storage.StatePickleStorage(file_path).get_state(1, 2) == 'state'
+        await state_storage.set_data(1, 2, 'key', 'value')
+        assert storage.StatePickleStorage(file_path).get_data(1, 2) == {'key': 'value'}
+        assert state_storage._flush_task is None
+        assert not await state_storage.flush()
+
+    asyncio.run(run())
+
+
+def test_get_states():
+    state_storage = storage.StateMemoryStorage()
+    state_storage.set_state(1, 2, 'first')
+    state_storage.set_state(3, 4, 'second', bot_id=5)
+    assert state_storage.get_states([(1, 2), (3, 4), (7, 8)]) == ['first', None, None]
+    assert state_storage.get_states([(3, 4)], bot_id=5) == ['second']
+
+    async def run():
+        async_storage = asyncio_storage.StateMemoryStorage()
+        await async_storage.set_state(1, 2, 'first')
+        return await async_storage.get_states([(1, 2), (3, 4)])
+
+    assert asyncio.run(run()) == ['first', None]
+
+
+def test_redis_data_fields():
+    fields = dict(zip(*[iter(encode_data({'name': 'Bob', 'tags': [], 'age': 2 ** 60}))] * 2))
+    fields = {field.encode(): value.encode() for field, value in fields.items()}
+    fields[b'state'] = b'Form:name'
+    assert decode_data(fields) == {'name': 'Bob', 'tags': [], 'age': 2 ** 60}
+
+    # the whole dict in the "data" field was written by older versions, fields written since take precedence
+    fields[b'data'] = b'{"name": "Alice", "city": "Paris"}'
+    assert decode_data(fields) == {'name': 'Bob', 'tags': [], 'age': 2 ** 60, 'city': 'Paris'}
+
+
+def test_redis_scripts_in_pipelines(monkeypatch):
+    if not redis_storage.redis_installed:
+        pytest.skip('redis is not installed')
+    state_storage = storage.StateRedisStorage(indexes=True)
+    pipe = state_storage.redis.pipeline(transaction=False)
+    state_storage._run_script(pipe, state_storage._update_data_script, 'key', ['name'])
+    # no SCRIPT EXISTS check on execute
+    assert not pipe.scripts
+    assert pipe.command_stack[0][0][:3] == ('EVALSHA', state_storage._update_data_script.sha, 1)
+
+    results = [redis_storage.redis.exceptions.NoScriptError('NOSCRIPT'), [1]]
+    executed = []
+
+    def execute(self, raise_on_error=True):
+        executed.append([args[0] for args, _ in self.command_stack])
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(type(pipe), 'execute', execute)
+    monkeypatch.setattr(state_storage.redis, 'script_load', lambda script: 'loaded')
+    command = lambda client: state_storage._run_script(client, state_storage._set_data_script, 'key', ['a', '1'])
+    assert state_storage._write('key', command, lambda client: client.sadd('index', 'member')) == 1
+    assert executed == [['EVALSHA', 'SADD'], ['EVALSHA', 'SADD']]
+    assert state_storage._set_data_script.sha == 'loaded'
+
+    async def run():
+        async_storage = asyncio_storage.StateRedisStorage(indexes=True)
+        async_pipe = async_storage.redis.pipeline(transaction=False)
+        await async_storage._run_script(async_pipe, async_storage._update_data_script, 'key', ['name'])
+        assert not async_pipe.scripts
+        assert async_pipe.command_stack[0][0][0] == 'EVALSHA'
+
+    asyncio.run(run())
+
+
+def test_redis_storage():
+    if not REDIS_TESTS:
+        pytest.skip('please install redis and configure redis server, then enable REDIS_TESTS')
+
+    state_storage = storage.StateRedisStorage(prefix='pyTelegramBotApi_states')
+    state_storage.redis.delete(*state_storage.redis.keys('pyTelegramBotApi_states*') or ['none'])
+    check_storage(state_storage)
+    state_storage.set_state(5, 6, 'other')
+    assert state_storage.get_states([(1, 2), (5, 6)]) == [None, 'other']
+
+    async def run():
+        async_storage = asyncio_storage.StateRedisStorage(prefix='pyTelegramBotApi_async_states')
+        await async_storage.delete_state(1, 2)
+        await check_async_storage(async_storage)
+        await async_storage.set_state(5, 6, 'other')
+        assert await async_storage.get_states([(1, 2), (5, 6)]) == [None, 'other']
+
+    asyncio.run(run())
+
+
+def fake_redis_pools():
+    """
+    Connection pools of an in-process fake Redis server, for the sync and the async storages.
+    """
+    redis = pytest.importorskip('redis')
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')  # runs the scripts
+    import redis.asyncio
+    server = fakeredis.FakeServer()
+    connection = getattr(fakeredis, 'FakeRedisConnection', fakeredis.FakeConnection)
+    async_connection = getattr(fakeredis, 'FakeAsyncRedisConnection', fakeredis.aioredis.FakeConnection)
+    return (
+        redis.ConnectionPool(connection_class=connection, server=server),
+        redis.asyncio.ConnectionPool(connection_class=async_connection, server=server),
+    )
+
+
+# with indexes, the scripts run in pipelines
+@pytest.mark.parametrize('data_fields', [False, True])
+@pytest.mark.parametrize('indexes', [False, True])
+def test_redis_storage_scripts(data_fields, indexes):
+    pool, async_pool = fake_redis_pools()
+    state_storage = storage.StateRedisStorage(connection_pool=pool, data_fields=data_fields, indexes=indexes)
+    check_storage(state_storage)
+    # the scripts do not create missing keys
+    assert not state_storage.reset_data(7, 8)
+    assert not state_storage.save(7, 8, {'key': 'value'})
+    assert not state_storage.update_data(7, 8, {'key': 'value'}, [])
+    assert state_storage.redis.exists(state_storage._get_key(7, 8, 'telebot', ':')) == 0
+
+    state_storage.set_state(1, 2, 'state')
+    state_storage.save(1, 2, {'name': 'Bob', 'tags': [], 'age': 2 ** 60})
+    assert state_storage.update_data(1, 2, {'city': 'Paris'}, ['tags', 'missing'])
+    assert state_storage.get_data(1, 2) == {'name': 'Bob', 'age': 2 ** 60, 'city': 'Paris'}
+    fields = state_storage.redis.hgetall(state_storage._get_key(1, 2, 'telebot', ':'))
+    if data_fields:
+        assert set(fields) == {b'state', b'd:name', b'd:age', b'd:city'}
+    else:
+        assert set(fields) == {b'state', b'data'}
+
+    async def run():
+        async_storage = asyncio_storage.StateRedisStorage(
+            connection_pool=async_pool, data_fields=data_fields, indexes=indexes)
+        await async_storage.delete_state(1, 2)
+        await check_async_storage(async_storage)
+        assert not await async_storage.update_data(7, 8, {'key': 'value'}, [])
+        await async_storage.set_state(3, 4, 'state')
+        assert await async_storage.update_data(3, 4, {'key': 'value'}, [])
+        assert state_storage.get_data(3, 4) == {'key': 'value'}
+
+    asyncio.run(run())
+
+
+def test_redis_storage_data_layouts():
+    pool, async_pool = fake_redis_pools()
+    client = storage.StateRedisStorage(connection_pool=pool).redis
+    key = 'telebot:1:2'
+
+    # by default the data is in the "data" field, which older versions read and change
+    state_storage = storage.StateRedisStorage(connection_pool=pool)
+    state_storage.set_state(1, 2, 'state')
+    assert client.hget(key, 'data') == b'{}'
+    state_storage.set_data(1, 2, 'key', 'value')
+    with state_storage.get_interactive_data(1, 2) as data:
+        data['number'] = 42
+    assert json.loads(client.hget(key, 'data')) == {'key': 'value', 'number': 42}
+
+    # data fields are read from a hash written the old way and convert it when writing
+    fields_storage = storage.StateRedisStorage(connection_pool=pool, data_fields=True)
+    assert fields_storage.get_data(1, 2) == {'key': 'value', 'number': 42}
+    fields_storage.set_data(1, 2, 'key', 'changed')
+    assert fields_storage.get_data(1, 2) == {'key': 'changed', 'number': 42}
+    with fields_storage.get_interactive_data(1, 2) as data:
+        del data['number']
+    assert set(client.hgetall(key)) == {b'state', b'd:key'}
+
+    # and back: the default layout moves the data fields into the "data" field
+    assert state_storage.get_data(1, 2) == {'key': 'changed'}
+    state_storage.set_data(1, 2, 'other', [1])
+    assert set(client.hgetall(key)) == {b'state', b'data'}
+    assert json.loads(client.hget(key, 'data')) == {'key': 'changed', 'other': [1]}
+
+    async def run():
+        async_storage = asyncio_storage.StateRedisStorage(connection_pool=async_pool)
+        await async_storage.set_state(3, 4, 'state')
+        async with async_storage.get_interactive_data(3, 4) as data:
+            data['key'] = 'value'
+        assert json.loads(client.hget('telebot:3:4', 'data')) == {'key': 'value'}
+
+    asyncio.run(run())
+
+
+def test_redis_storage_indexes():
+    pool, async_pool = fake_redis_pools()
+    state_storage = storage.StateRedisStorage(connection_pool=pool, indexes=True, cache_size=10)
+    client = state_storage.redis
+    check_bulk_operations(state_storage)
+    assert client.smembers('telebot:any_bot_index') == {b'[2, 1, null, null, 5]'}
+    assert client.smembers('telebot:chat_index:5:2') == {b'[2, 1, null, null, 5]'}
+    # the other sets were emptied, so Redis dropped them
+    assert sorted(client.keys('telebot:*index*')) == [
+        b'telebot:any_bot_chat_index:2', b'telebot:any_bot_index', b'telebot:bot_index:5', b'telebot:chat_index:5:2',
+    ]
+
+    # each state is added to the four sets in the same round trip, and removed from them
+    member = b'[3, 4, "bc", 7, 9]'
+    state_storage.set_state(3, 4, 'state', business_connection_id='bc', message_thread_id=7, bot_id=9)
+    state_storage.set_state(3, 4, 'again', business_connection_id='bc', message_thread_id=7, bot_id=9)
+    index_keys = state_storage._index_keys(3, 9)
+    assert index_keys == (
+        'telebot:chat_index:9:3', 'telebot:bot_index:9', 'telebot:any_bot_chat_index:3', 'telebot:any_bot_index',
+    )
+    assert all(client.smembers(index_key) >= {member} for index_key in index_keys)
+    # data changes do not touch the indexes
+    state_storage.set_data(3, 4, 'key', 'value', business_connection_id='bc', message_thread_id=7, bot_id=9)
+    assert state_storage.count_states(3) == 1
+    assert state_storage.delete_state(3, 4, business_connection_id='bc', message_thread_id=7, bot_id=9)
+    assert not any(client.sismember(index_key, member) for index_key in index_keys)
+    state_storage.set_state(3, 5, 'no bot')
+    assert client.smembers('telebot:chat_index::3') == {b'[3, 5, null, null, null]'}
+    assert list(state_storage.iter_states(3, bot_id=9)) == []
+    assert list(state_storage.iter_states(3)) == [(3, 5, None, None, None, 'no bot')]
+    state_storage.close()
+
+    async def run():
+        async_storage = asyncio_storage.StateRedisStorage(connection_pool=async_pool, indexes=True)
+        await async_storage.set_state(6, 1, 'a', bot_id=9)
+        await async_storage.set_state(6, 2, 'b', bot_id=9)
+        assert await async_storage.count_states(6, bot_id=9) == 2
+        assert await async_storage.delete_state(6, 1, bot_id=9)
+        assert [state async for state in async_storage.iter_states(6)] == [(6, 2, None, None, 9, 'b')]
+        assert await async_storage.delete_states_for_chat(6) == 1
+        assert not client.exists('telebot:chat_index:9:6', 'telebot:any_bot_chat_index:6')
+        assert await async_storage.count_states(bot_id=9) == 0
+
+    asyncio.run(run())
+
+
+def test_redis_storage_invalidation():
+    pool, async_pool = fake_redis_pools()
+    first = storage.StateRedisStorage(connection_pool=pool, cache_size=100)
+    second = storage.StateRedisStorage(connection_pool=pool, cache_size=100, cache_ttl=60)
+
+    def wait_for(condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    wait_for(lambda: first.cache.active and second.cache.active)
+    first.set_state(1, 2, 'first')
+    assert second.get_state(1, 2) == 'first'
+    assert second.get_state(1, 2) == 'first'
+    assert second.cache_stats()['hits'] == 1
+    # every write publishes the key, and the other storage drops it
+    for change in (
+        lambda: first.set_data(1, 2, 'key', 'value'),
+        lambda: first.update_data(1, 2, {'key': 'changed'}, []),
+        lambda: first.reset_data(1, 2),
+        lambda: first.set_state(1, 2, 'second'),
+    ):
+        second.get_data(1, 2)
+        assert second.cache.entries
+        change()
+        wait_for(lambda: not second.cache.entries)
+        assert second.get_data(1, 2) == first.get_data(1, 2)
+    assert second.get_state(1, 2) == 'second'
+    first.delete_state(1, 2)
+    wait_for(lambda: not second.cache.entries)
+    assert second.get_state(1, 2) is None
+    first.close()
+    second.close()
+    assert not first.cache.active
+
+    async def run():
+        async_storage = asyncio_storage.StateRedisStorage(connection_pool=async_pool, cache_size=100)
+        assert await async_storage.get_state(1, 2) is None
+        while not async_storage.cache.active:
+            await asyncio.sleep(0.01)
+        await async_storage.set_state(1, 2, 'async')
+        assert await async_storage.get_state(1, 2) == 'async'
+        await async_storage.set_data(1, 2, 'key', 'value')
+        assert await async_storage.get_data(1, 2) == {'key': 'value'}
+        await async_storage.close()
+
+    asyncio.run(run())
+
+
+def test_redis_near_cache(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(redis_storage.time, 'monotonic', lambda: now[0])
+    cache = NearCache(max_entries=2, ttl=5)
+    cache.put('a', {b'state': b'first'}, cache.generation)
+    assert cache.get('a') is None  # not subscribed yet
+
+    cache.set_active(True)
+    cache.put('a', {b'state': b'first'}, cache.generation)
+    assert decode_state(cache.get('a')) == 'first'
+    assert decode_state({}) is None and decode_state({'state': 'str'}) == 'str'
+
+    # a read that started before an invalidation is not stored
+    generation = cache.generation
+    cache.invalidate(b'b')
+    cache.put('b', {b'state': b'stale'}, generation)
+    assert cache.get('b') is None
+
+    cache.put('b', {}, cache.generation)
+    cache.put('c', {}, cache.generation)
+    assert cache.get('a') is None  # least recently used
+    assert cache.get('b') == {}
+    now[0] += 6
+    assert cache.get('c') is None
+    assert cache.stats() == {'entries': 1, 'hits': 2, 'misses': 3}
+
+    cache.set_active(False)
+    assert cache.get('b') is None
+
+
+class MockPubSub:
+    """
+    Pubsub returning the messages and raising the exceptions put into its queue.
+    """
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.connects = 0
+        self.closed = False
+
+    def on_connect(self, connection):
+        self.connects += 1
+
+    def subscribe(self, channel):
+        self.channel = channel
+
+    def get_message(self, timeout=None):
+        try:
+            message = self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def close(self):
+        self.closed = True
+
+
+def test_redis_near_cache_is_dropped_on_disconnect(monkeypatch):
+    if not redis_storage.redis_installed:
+        pytest.skip('redis is not installed')
+    pubsubs = []
+    monkeypatch.setattr(redis_storage.redis.Redis, 'pubsub', lambda self: pubsubs.append(MockPubSub()) or pubsubs[-1])
+    state_storage = storage.StateRedisStorage(cache_size=10, cache_ttl=60)
+    cache = state_storage.cache
+
+    def wait_for(condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    def fill():
+        pubsubs[-1].messages.put({'type': 'subscribe', 'data': 1})
+        wait_for(lambda: cache.active)
+        cache.put('key', {b'state': b'cached'}, cache.generation)
+        assert cache.get('key') is not None
+
+    wait_for(lambda: pubsubs)
+    assert pubsubs[0].channel == 'telebot:invalidate'
+    fill()
+    # redis-py reconnects and subscribes again by itself, messages sent meanwhile are lost
+    pubsubs[0].on_connect(None)
+    assert pubsubs[0].connects == 1
+    assert not cache.active and not cache.entries
+    fill()
+    pubsubs[0].messages.put({'type': 'unsubscribe', 'data': 0})
+    wait_for(lambda: not cache.active)
+    assert not cache.entries
+
+    fill()
+    pubsubs[0].messages.put(redis_storage.redis.exceptions.ConnectionError('lost'))
+    # dropped right away, not after the pause before subscribing again
+    wait_for(lambda: not cache.active)
+    assert not cache.entries and cache.get('key') is None
+    wait_for(lambda: len(pubsubs) == 2)
+    assert pubsubs[0].closed
+    fill()
+    state_storage.close()
+    assert not cache.active and not cache.entries
+
+
+def test_async_redis_near_cache_is_dropped_on_disconnect(monkeypatch):
+    if not redis_storage.redis_installed:
+        pytest.skip('redis is not installed')
+
+    class AsyncMockPubSub:
+        def __init__(self):
+            self.messages = asyncio.Queue()
+            self.connects = 0
+
+        async def on_connect(self, connection):
+            self.connects += 1
+
+        async def subscribe(self, channel):
+            self.channel = channel
+
+        async def get_message(self, timeout=None):
+            message = await self.messages.get()
+            if isinstance(message, Exception):
+                raise message
+            return message
+
+        async def reset(self):
+            pass
+
+    async def run():
+        pubsubs = []
+        state_storage = asyncio_storage.StateRedisStorage(cache_size=10, cache_ttl=60)
+        monkeypatch.setattr(state_storage.redis, 'pubsub', lambda: pubsubs.append(AsyncMockPubSub()) or pubsubs[-1])
+        cache = state_storage.cache
+        state_storage._start_invalidator()
+
+        async def fill():
+            while not pubsubs:
+                await asyncio.sleep(0.01)
+            pubsubs[-1].messages.put_nowait({'type': 'subscribe', 'data': 1})
+            while not cache.active:
+                await asyncio.sleep(0.01)
+            cache.put('key', {b'state': b'cached'}, cache.generation)
+
+        await fill()
+        await pubsubs[0].on_connect(None)
+        assert pubsubs[0].connects == 1
+        assert not cache.active and not cache.entries
+
+        await fill()
+        pubsubs[0].messages.put_nowait(redis_storage.redis.exceptions.ConnectionError('lost'))
+        await asyncio.sleep(0.1)
+        assert not cache.active and not cache.entries
+        await state_storage.close()
+
+    asyncio.run(run())
+
+
+def test_redis_storage_cache():
+    if not REDIS_TESTS:
+        pytest.skip('please install redis and configure redis server, then enable REDIS_TESTS')
+
+    first = storage.StateRedisStorage(prefix='pyTelegramBotApi_cached', cache_size=100)
+    second = storage.StateRedisStorage(prefix='pyTelegramBotApi_cached', cache_size=100, cache_ttl=60)
+    first.redis.delete(*first.redis.keys('pyTelegramBotApi_cached*') or ['none'])
+    time.sleep(0.5)
+    check_storage(first)
+    first.set_state(1, 2, 'first')
+    assert second.get_state(1, 2) == 'first'
+    assert second.get_data(1, 2) == {}
+    first.set_data(1, 2, 'key', 'value')
+    time.sleep(0.5)
+    assert second.get_data(1, 2) == {'key': 'value'}
+    assert second.cache_stats()['hits'] >= 1
+    first.close()
+    second.close()
+
+    indexed = storage.StateRedisStorage(prefix='pyTelegramBotApi_indexed', indexes=True)
+    indexed.redis.delete(*indexed.redis.keys('pyTelegramBotApi_indexed*') or ['none'])
+    check_bulk_operations(indexed)
+    with pytest.raises(RuntimeError):
+        first.count_states(1)
+
+    async def run():
+        async_storage = asyncio_storage.StateRedisStorage(prefix='pyTelegramBotApi_cached', cache_size=100)
+        await async_storage.delete_state(1, 2)
+        await asyncio.sleep(0.5)
+        await check_async_storage(async_storage)
+        await async_storage.close()
+
+    asyncio.run(run())
+
+
+class WriteRecordingStorage(storage.StateMemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    def save(self, *args, **kwargs):
+        self.writes.append('save')
+        return super().save(*args, **kwargs)
+
+    def update_data(self, chat_id, user_id, changed, removed, *args, **kwargs):
+        self.writes.append((changed, removed))
+        return super().update_data(chat_id, user_id, changed, removed, *args, **kwargs)
+
+
+def test_interactive_data_writes_changes(tmp_path):
+    state_storage = WriteRecordingStorage()
+    state_storage.set_state(1, 2, 'state')
+    state_storage.set_data(1, 2, 'keep', {'nested': [1]})
+    state_storage.set_data(1, 2, 'drop', 1)
+    state_storage.set_data(1, 2, 'flag', 1)
+
+    with state_storage.get_interactive_data(1, 2) as data:
+        assert data == {'keep': {'nested': [1]}, 'drop': 1, 'flag': 1}
+    assert state_storage.writes == []
+
+    with state_storage.get_interactive_data(1, 2) as data:
+        data['keep']['nested'].append(2)
+        data['flag'] = True
+        data['new'] = 'value'
+        del data['drop']
+    assert state_storage.writes == [({'keep': {'nested': [1, 2]}, 'flag': True, 'new': 'value'}, ['drop'])]
+    assert state_storage.get_data(1, 2) == {'keep': {'nested': [1, 2]}, 'flag': True, 'new': 'value'}
+
+    async def run():
+        async_storage = asyncio_storage.StatePickleStorage(str(tmp_path / 'states.pkl'))
+        await async_storage.set_state(1, 2, 'state')
+        await async_storage.set_data(1, 2, 'key', 'value')
+        async with async_storage.get_interactive_data(1, 2) as data:
+            data['other'] = 1
+        async with async_storage.get_interactive_data(1, 2) as data:
+            pass
+        assert await async_storage.get_data(1, 2) == {'key': 'value', 'other': 1}
+        await async_storage.close()
+
+    asyncio.run(run())
+
+
+def test_interactive_data_does_not_swallow_exceptions():
+    state_storage = storage.StateMemoryStorage()
+    state_storage.set_state(1, 2, 'state')
+    with pytest.raises(ValueError):
+        with state_storage.get_interactive_data(1, 2):
+            raise ValueError('handler error')
+    with pytest.raises(ValueError):
+        with state_storage.get_interactive_data(1, 2) as data:
+            data['key'] = 'value'
+            raise ValueError('handler error')
+    assert state_storage.get_data(1, 2) == {'key': 'value'}
+
+    context = state_storage.get_interactive_data(1, 2)
+    with context as data:
+        data['key'] = 'other'
+    assert context.saved is True
+
+    async def run():
+        async_storage = asyncio_storage.StateMemoryStorage()
+        await async_storage.set_state(1, 2, 'state')
+        with pytest.raises(ValueError):
+            async with async_storage.get_interactive_data(1, 2):
+                raise ValueError('handler error')
+        with pytest.raises(ValueError):
+            async with async_storage.get_interactive_data(1, 2) as data:
+                data['key'] = 'value'
+                raise ValueError('handler error')
+
+    asyncio.run(run())
+
+
+def test_sqlite_storage_data_rows(tmp_path):
+    file_path = str(tmp_path / 'states.db')
+    state_storage = storage.StateSQLiteStorage(file_path)
+    state_storage.set_state(1, 2, 'state')
+    state_storage.save(1, 2, {'a': 1, 'b': [2], 'c': '3'})
+    assert state_storage.get_data(1, 2) == {'a': 1, 'b': [2], 'c': '3'}
+    state_storage.set_data(1, 2, 'a', 10)
+    assert state_storage.get_data(1, 2) == {'a': 10, 'b': [2], 'c': '3'}
+
+    with state_storage.get_interactive_data(1, 2) as data:
+        del data['b']
+        data['d'] = {'e': None}
+    assert state_storage.get_data(1, 2) == {'a': 10, 'c': '3', 'd': {'e': None}}
+    rows = state_storage.connection.execute('SELECT name, value FROM telebot_states_data ORDER BY name').fetchall()
+    assert rows == [('a', '10'), ('c', '"3"'), ('d', '{"e": null}')]
+
+    assert not state_storage.update_data(5, 6, {'a': 1}, [])
+    assert state_storage.save(1, 2, {'z': 0})
+    assert state_storage.get_data(1, 2) == {'z': 0}
+    assert state_storage.reset_data(1, 2)
+    assert state_storage.get_data(1, 2) == {}
+    assert not state_storage.reset_data(5, 6)
+    assert state_storage.delete_state(1, 2)
+    assert state_storage.connection.execute('SELECT COUNT(*) FROM telebot_states_data').fetchone()[0] == 0
+    state_storage.close()
+
+
+def test_redis_data_changes():
+    assert encode_data_changes({'a': 1}, ['b', 'c']) == [2, 'd:b', 'd:c', 'd:a', '1']
+    assert encode_data_changes({}, []) == [0]
+
+
+class CountingStorage(storage.StateMemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def get_state(self, *args, **kwargs):
+        self.reads += 1
+        return super().get_state(*args, **kwargs)
+
+
+def make_state_update(update_id, text):
+    chat = types.Chat(id=11, type='private')
+    user = types.User(id=10, is_bot=False, first_name='Some User')
+    message = types.Message(1, user, None, chat, 'text', {'text': text}, '')
+    return types.Update(update_id, **dict(dict.fromkeys(types.Update._field_types), message=message))
+
+
+def test_state_is_read_once_per_update():
+    state_storage = CountingStorage()
+    bot = telebot.TeleBot('1234:test', threaded=False, state_storage=state_storage, use_class_middlewares=True)
+    bot.add_custom_filter(custom_filters.StateFilter(bot))
+    bot.setup_middleware(StateMiddleware(bot))
+    calls = []
+
+    for number in range(40):
+        bot.register_message_handler(lambda message, number=number: calls.append(number), state='state{0}'.format(number))
+
+    @bot.message_handler(state=Form.name)
+    def name(message, state: StateContext):
+        calls.append(state.get())
+        state.set(Form.age)
+        calls.append(state.get())
+
+    bot.set_state(10, Form.name, 11)
+    bot.process_new_updates([make_state_update(1, 'Bob')])
+    assert calls == [Form.name.name, Form.age.name]
+    # one read for all filters and the first get(), one after set()
+    assert state_storage.reads == 2
+
+    bot.process_new_updates([make_state_update(2, 'Bob')])
+    assert state_storage.reads == 3
+
+
+def test_async_state_is_read_once_per_update():
+    state_storage = asyncio_storage.StateMemoryStorage()
+    reads = []
+    get_state = state_storage.get_state
+
+    async def counting_get_state(*args, **kwargs):
+        reads.append(args)
+        return await get_state(*args, **kwargs)
+
+    state_storage.get_state = counting_get_state
+    bot = AsyncTeleBot('1234:test', state_storage=state_storage)
+    bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+    calls = []
+
+    for number in range(40):
+        async def handler(message, number=number):
+            calls.append(number)
+        bot.register_message_handler(handler, state='state{0}'.format(number))
+
+    async def run():
+        await bot.set_state(10, 'state39', 11)
+        await bot.process_new_updates([make_state_update(1, 'Bob')])
+
+    asyncio.run(run())
+    assert calls == [39]
+    assert len(reads) == 1
@@ -0,0 +1,330 @@
+import sys
+
+sys.path.append('../')
+
+import functools
+import random
+import threading
+import time
+
+import pytest
+
+import telebot
+from telebot import types, util
+
+
+def make_message(chat_id, text='hi'):
+    chat = types.Chat(id=chat_id, type='private')
+    user = types.User(id=chat_id, is_bot=False, first_name='Some User')
+    return types.Message(
+        message_id=1, from_user=user, date=None, chat=chat, content_type='text', options={'text': text}, json_string=""
+    )
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_extract_shard_key():
+    message = make_message(5)
+    assert util.extract_shard_key(message) == 5
+
+    callback_query = types.CallbackQuery(1, message.from_user, 'data', 'instance', '', message=message)
+    assert util.extract_shard_key(callback_query) == 5
+
+    inline_query = types.InlineQuery(1, types.User(7, False, 'User'), 'query', '')
+    assert util.extract_shard_key(inline_query) == 7
+    assert util.extract_shard_key([message]) is None
+
+
+def test_sharded_pool_keeps_order_per_chat():
+    bot = telebot.TeleBot('1234:test', num_threads=4, worker_pool_class=util.ShardedThreadPool)
+    pool = bot.worker_pool
+    assert isinstance(pool, util.ShardedThreadPool)
+    processed = {chat_id: [] for chat_id in range(8)}
+    lock = threading.Lock()
+
+    def task(message, number):
+        time.sleep(random.random() / 500)
+        with lock:
+            processed[message.chat.id].append(number)
+
+    for number in range(25):
+        for chat_id in processed:
+            bot._exec_task(task, make_message(chat_id), number)
+
+    wait_for(lambda: all(len(numbers) == 25 for numbers in processed.values()))
+    assert all(numbers == list(range(25)) for numbers in processed.values())
+    pool.close()
+
+
+def test_sharded_pool_reports_exceptions():
+    bot = telebot.TeleBot('1234:test', num_threads=2, worker_pool_class=util.ShardedThreadPool)
+
+    def fail(message):
+        raise ValueError('failed')
+
+    bot._exec_task(fail, make_message(1))
+    wait_for(bot.worker_pool.exception_event.is_set)
+    with pytest.raises(ValueError):
+        bot.worker_pool.raise_exceptions()
+    bot.worker_pool.clear_exceptions()
+    bot.worker_pool.close()
+
+
+def test_sharded_pool_applies_next_step_to_following_message():
+    bot = telebot.TeleBot('1234:test', num_threads=2, worker_pool_class=util.ShardedThreadPool)
+    handled = []
+    started = threading.Event()
+
+    def answer(message):
+        handled.append(('step', message.text))
+
+    @bot.message_handler(commands=['start'])
+    def start(message):
+        started.set()
+        time.sleep(0.05)
+        bot.register_next_step_handler(message, answer)
+
+    @bot.message_handler(func=lambda message: True)
+    def other(message):
+        handled.append(('other', message.text))
+
+    bot.process_new_messages([make_message(1, '/start')])
+    assert started.wait(5)
+    bot.process_new_messages([make_message(1, 'answer')])
+
+    wait_for(lambda: handled)
+    time.sleep(0.05)
+    assert handled == [('step', 'answer')]
+    bot.worker_pool.close()
+
+
+def test_bounded_queue_blocks_and_collects_stats():
+    bot = telebot.TeleBot('1234:test', num_threads=1, max_queue_size=2)
+    pool = bot.worker_pool
+    assert pool.high_water_mark == 2
+    release = threading.Event()
+    done = []
+
+    bot._exec_task(lambda message: release.wait(5), make_message(1))
+    wait_for(lambda: pool.stats.started_count == 1)
+    bot._exec_task(done.append, 1)
+    bot._exec_task(done.append, 2)
+    assert pool.is_saturated()
+    assert not pool.wait_for_capacity(timeout=0.01)
+
+    producer = threading.Thread(target=bot._exec_task, args=(done.append, 3))
+    producer.start()
+    time.sleep(0.05)
+    assert producer.is_alive()
+    assert pool.stats.blocked_count == 1
+
+    release.set()
+    producer.join(5)
+    wait_for(lambda: done == [1, 2, 3])
+    stats = pool.stats.as_dict()
+    assert stats['depth'] == 0
+    assert stats['max_depth'] == 2
+    assert stats['put_count'] == stats['started_count'] == 4
+    assert stats['max_wait'] >= 0.05
+    pool.close()
+
+
+def test_workers_do_not_block_on_full_queue():
+    bot = telebot.TeleBot('1234:test', num_threads=1, max_queue_size=1)
+    done = threading.Event()
+
+    def spawn(message):
+        bot._exec_task(lambda m: None, message)
+        bot._exec_task(lambda m: done.set(), message)
+
+    bot._exec_task(spawn, make_message(1))
+    assert done.wait(5)
+    bot.worker_pool.close()
+
+
+def test_elastic_pool_grows_and_retires_workers():
+    bot = telebot.TeleBot('1234:test', num_threads=1, worker_pool_class=functools.partial(
+        util.ElasticThreadPool, max_threads=3, target_wait=0.02, idle_timeout=0.2))
+    pool = bot.worker_pool
+    assert len(pool.workers) == 1
+    release = threading.Event()
+    started = []
+
+    for number in range(4):
+        bot._exec_task(lambda number: started.append(number) or release.wait(5), number)
+    wait_for(lambda: len(pool.workers) == 3 and len(started) == 3)
+    assert sorted(started) == [0, 1, 2]
+
+    release.set()
+    wait_for(lambda: len(started) == 4)
+    wait_for(lambda: len(pool.workers) == 1)
+    pool.close()
+
+
+def test_elastic_pool_retired_worker_runs_last_task():
+    bot = telebot.TeleBot('1234:test', num_threads=1, worker_pool_class=functools.partial(
+        util.ElasticThreadPool, max_queue_size=1, idle_timeout=3600))
+    pool = bot.worker_pool
+    in_worker = []
+
+    # a retired worker is no longer in pool.workers, but can still take a task from the queue
+    pool.stats.task_put()
+    task = (time.monotonic(), lambda: in_worker.append(pool._in_worker()), (), {})
+    retired = threading.Thread(target=pool._run_task, args=task)
+    retired.start()
+    retired.join()
+    assert in_worker == [True]
+    assert retired not in pool._last_active and not pool._busy
+    assert not pool._in_worker()
+    pool.close()
+
+
+def test_elastic_pool_reports_exceptions():
+    bot = telebot.TeleBot('1234:test', worker_pool_class=util.ElasticThreadPool)
+
+    def fail():
+        raise ValueError('failed')
+
+    bot._exec_task(fail)
+    wait_for(bot.worker_pool.exception_event.is_set)
+    with pytest.raises(ValueError):
+        bot.worker_pool.raise_exceptions()
+    bot.worker_pool.clear_exceptions()
+    bot.worker_pool.close()
+
+
+@pytest.mark.parametrize('pool_class', [util.ThreadPool, util.ElasticThreadPool, util.FuturesThreadPool])
+def test_add_threads(pool_class):
+    bot = telebot.TeleBot('1234:test', num_threads=1, worker_pool_class=pool_class)
+    pool = bot.worker_pool
+    pool.add_threads(2)
+    wait_for(lambda: len(pool.workers) == 3)
+    release = threading.Event()
+    started = []
+    for number in range(3):
+        bot._exec_task(lambda number: started.append(number) or release.wait(5), number)
+    wait_for(lambda: len(started) == 3)
+    release.set()
+    pool.close()
+
+
+def test_pipelined_polling():
+    bot = telebot.TeleBot('1234:test', num_threads=2, max_queue_size=50)
+    bot._user = types.User(1, True, 'Bot', username='bot')
+    requests = []
+    received = []
+    lock = threading.Lock()
+
+    accepted = [0]
+    process_new_updates = bot.process_new_updates
+
+    def record_accepted(updates):
+        process_new_updates(updates)
+        accepted[0] = max([accepted[0]] + [update.update_id for update in updates])
+
+    def get_updates(offset=None, limit=None, **kwargs):
+        # updates below the offset are confirmed, they must be in the worker pool already
+        assert offset == accepted[0] + 1
+        requests.append((offset, limit))
+        if offset > 300:
+            bot.stop_polling()
+            return []
+        last = min(offset + limit, 301)
+        return [types.Update(update_id, make_message(update_id % 7), *([None] * 25)) for update_id in range(offset, last)]
+
+    def handle(message):
+        with lock:
+            received.append(message.chat.id)
+
+    bot.get_updates = get_updates
+    bot.process_new_updates = record_accepted
+    bot.register_message_handler(handle, func=lambda message: True)
+    bot.polling(pipelined=True)
+
+    offsets = [offset for offset, _ in requests]
+    assert offsets == sorted(offsets)
+    assert offsets[0] == 1 and offsets[-1] == 301
+    assert all(1 <= limit <= 50 for _, limit in requests)
+    wait_for(lambda: len(received) == 300)
+    bot.worker_pool.close()
+
+
+def test_futures_pool_runs_tasks_and_futures():
+    bot = telebot.TeleBot('1234:test', num_threads=2, worker_pool_class=util.FuturesThreadPool)
+    pool = bot.worker_pool
+    done = threading.Event()
+    bot._exec_task(lambda message: done.set(), make_message(1))
+    assert done.wait(5)
+
+    assert pool.submit(pow, 2, 10).result(5) == 1024
+    with pytest.raises(ZeroDivisionError):
+        pool.submit(lambda: 1 / 0).result(5)
+    assert not pool.exception_event.is_set()
+
+    def fail(message):
+        raise ValueError('failed')
+
+    bot._exec_task(fail, make_message(1))
+    wait_for(pool.exception_event.is_set)
+    with pytest.raises(ValueError):
+        pool.raise_exceptions()
+    pool.clear_exceptions()
+
+    pool.close()
+    assert not any(worker.is_alive() for worker in pool.workers)
+    with pytest.raises(RuntimeError):
+        pool.submit(pow, 2, 10)
+
+
+def test_futures_pool_shutdown_cancels_futures():
+    bot = telebot.TeleBot('1234:test', num_threads=1, worker_pool_class=util.FuturesThreadPool)
+    pool = bot.worker_pool
+    release = threading.Event()
+    running = pool.submit(release.wait, 5)
+    wait_for(running.running)
+    waiting = [pool.submit(pow, 2, number) for number in range(3)]
+
+    pool.shutdown(wait=False, cancel_futures=True)
+    assert all(future.cancelled() for future in waiting)
+    release.set()
+    assert running.result(5) is True
+    for worker in pool.workers:
+        worker.join(5)
+    assert not any(worker.is_alive() for worker in pool.workers)
+
+
+def test_futures_pool_shutdown_with_blocked_submit(caplog):
+    bot = telebot.TeleBot('1234:test', num_threads=1, max_queue_size=1, worker_pool_class=util.FuturesThreadPool)
+    pool = bot.worker_pool
+    release = threading.Event()
+    running = pool.submit(release.wait, 5)
+    wait_for(running.running)
+    bot._exec_task(lambda message: None, make_message(1))
+    errors = []
+
+    def produce():
+        try:
+            pool.submit(pow, 2, 10)
+        except RuntimeError as e:
+            errors.append(e)
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    wait_for(lambda: pool.stats.blocked_count == 1)
+
+    with caplog.at_level('WARNING', logger='TeleBot'):
+        shutdown = threading.Thread(target=pool.shutdown, kwargs={'wait': False, 'cancel_futures': True})
+        shutdown.start()
+        shutdown.join(5)
+    assert not shutdown.is_alive()
+    assert 'dropped 1 waiting tasks' in caplog.text
+    producer.join(5)
+    assert not producer.is_alive()
+    assert [str(e) for e in errors] == ['cannot schedule new futures after shutdown']
+    release.set()
+    assert running.result(5) is True